@@ -0,0 +1,318 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import asyncio
+import logging
+import ssl
+from urllib import parse
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from observabilityclient.prometheus_client import BufferedResponse
+from observabilityclient.prometheus_client import MAX_RANGE_POINTS
+from observabilityclient.prometheus_client import PrometheusAPIClient
+from observabilityclient.prometheus_client import PrometheusAPIClientError
+from observabilityclient.prometheus_client import PrometheusMetric
+from observabilityclient.prometheus_client import range_windows
+from observabilityclient.prometheus_client import RangeResult
+from observabilityclient.prometheus_client import to_seconds
+
+
+LOG = logging.getLogger(__name__)
+
+
+def _encode_params(params):
+    # aiohttp doesn't accept lists as values, nor drops None
+    # values like requests does.
+    encoded = []
+    for key, value in (params or {}).items():
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            encoded.extend((key, str(v)) for v in value)
+        else:
+            encoded.append((key, str(value)))
+    return encoded
+
+
+class AsyncPrometheusAPIClient:
+    """Asyncio variant of PrometheusAPIClient.
+
+    It requires the aiohttp library. The session is created on first
+    use inside of the running event loop, close it with close() or use
+    the client as an async context manager.
+
+    :param host: Prometheus host and port
+    :type host: str
+    :param limit: Maximum number of concurrent connections
+    :type limit: int
+    :param limit_per_host: Maximum number of concurrent connections
+                           to the same endpoint, 0 for no limit
+    :type limit_per_host: int
+    :param timeout: Total timeout of a request in seconds
+    :type timeout: float
+    :param post_threshold: Length of the encoded parameters, above which
+                           read requests are sent as form encoded POST
+    :type post_threshold: int
+    """
+
+    def __init__(self, host, limit=100, limit_per_host=0, timeout=None,
+                 max_range_points=MAX_RANGE_POINTS,
+                 range_split_interval=None, post_threshold=4096):
+        if aiohttp is None:
+            raise ImportError("AsyncPrometheusAPIClient requires aiohttp")
+        self._host = host
+        self._limit = limit
+        self._limit_per_host = limit_per_host
+        self._timeout = timeout
+        self._max_range_points = max_range_points
+        self._range_split_interval = range_split_interval
+        self._post_threshold = post_threshold
+        self._ca_cert = None
+        self._client_cert = None
+        self._client_key = None
+        self._auth = None
+        self._session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def set_ca_cert(self, ca_cert):
+        self._ca_cert = ca_cert
+
+    def set_client_cert(self, client_cert, client_key):
+        self._client_cert = client_cert
+        self._client_key = client_key
+
+    def set_basic_auth(self, auth_user, auth_password):
+        self._auth = aiohttp.BasicAuth(auth_user, auth_password)
+
+    def _ssl_context(self):
+        if not self._ca_cert:
+            return False
+        if self._ca_cert is True:
+            context = ssl.create_default_context()
+        else:
+            context = ssl.create_default_context(cafile=self._ca_cert)
+        if self._client_cert is not None:
+            context.load_cert_chain(self._client_cert, self._client_key)
+        return context
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self._limit,
+                limit_per_host=self._limit_per_host,
+                ssl=self._ssl_context())
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                auth=self._auth,
+                timeout=aiohttp.ClientTimeout(total=self._timeout))
+        return self._session
+
+    async def close(self):
+        """Close the underlying session and its connections."""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def _request(self, method, endpoint, params=None, form=None):
+        url = (f"{'https' if self._ca_cert else 'http'}://"
+               f"{self._host}/api/v1/{endpoint}")
+        session = self._get_session()
+        kwargs = {}
+        if form is not None:
+            kwargs['data'] = form
+        async with session.request(method, url,
+                                   params=_encode_params(params),
+                                   headers={'Accept': 'application/json'},
+                                   **kwargs) as resp:
+            body = await resp.text()
+            return BufferedResponse(resp.status, resp.reason, body)
+
+    async def _get(self, endpoint, params=None):
+        encoded = _encode_params(params)
+        if (endpoint in PrometheusAPIClient.POST_ENDPOINTS and
+                len(parse.urlencode(encoded)) > self._post_threshold):
+            LOG.debug("Sending %s request as POST", endpoint)
+            resp = await self._request('POST', endpoint, form=encoded)
+        else:
+            resp = await self._request('GET', endpoint, params)
+        if resp.status_code != 200:
+            raise PrometheusAPIClientError(resp)
+        decoded = resp.json()
+        if decoded['status'] != 'success':
+            raise PrometheusAPIClientError(resp)
+
+        return decoded
+
+    async def _post(self, endpoint, params=None):
+        resp = await self._request('POST', endpoint, params)
+        if resp.status_code != 200:
+            raise PrometheusAPIClientError(resp)
+        decoded = resp.json()
+        if 'status' in decoded and decoded['status'] != 'success':
+            raise PrometheusAPIClientError(resp)
+        return decoded
+
+    async def query(self, query, time=None):
+        """Send custom queries to Prometheus.
+
+        :param query: the query to send
+        :type query: str
+        :param time: Evaluation time, None for the current server time
+        :type time: rfc3339 or unix_timestamp
+        """
+        LOG.debug("Querying prometheus with query: %s", query)
+        params = dict(query=query)
+        if time is not None:
+            params['time'] = time
+        decoded = await self._get("query", params)
+
+        if decoded['data']['resultType'] == 'vector':
+            schemas = {}
+            result = [PrometheusMetric(i, schemas)
+                      for i in decoded['data']['result']]
+        elif decoded['data']['resultType'] == 'matrix':
+            result = RangeResult(decoded['data']['result'])
+        else:
+            # scalar and string results are a single [time, value]
+            result = [PrometheusMetric({'metric': {},
+                                        'value': decoded['data']['result']})]
+        return result
+
+    async def query_range(self, query, start, end, step):
+        """Send custom range queries to Prometheus.
+
+        Long ranges are split into windows the same way as in
+        PrometheusAPIClient.query_range() and fetched concurrently.
+
+        :param query: the query to send
+        :type query: str
+        :param start: Timestamp of the first evaluation
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp of the last evaluation
+        :type end: rfc3339 or unix_timestamp
+        :param step: Evaluation step, duration or number of seconds
+        :type step: str or float
+        """
+        LOG.debug("Querying prometheus with range query: %s", query)
+        windows = range_windows(start, end, step, self._max_range_points,
+                                self._range_split_interval)
+        if len(windows) <= 1:
+            windows = [(start, end)]
+        else:
+            step = to_seconds(step)
+        responses = await asyncio.gather(*[
+            self._get("query_range", dict(query=query, start=window[0],
+                                          end=window[1], step=step))
+            for window in windows])
+        result = RangeResult()
+        for decoded in responses:
+            result.extend(decoded['data']['result'])
+        return result
+
+    async def series(self, matches):
+        """Query the /series/ endpoint of prometheus.
+
+        :param matches: List of matches to send as parameters
+        :type matches: [str]
+        """
+        LOG.debug("Querying prometheus for series with matches: %s", matches)
+        decoded = await self._get("series", {"match[]": matches})
+
+        return decoded['data']
+
+    async def labels(self, matches=None, start=None, end=None):
+        """Query the /labels/ endpoint of prometheus.
+
+        See PrometheusAPIClient.labels() for the parameters.
+        """
+        LOG.debug("Querying prometheus for labels")
+        decoded = await self._get("labels", {"match[]": matches,
+                                             "start": start,
+                                             "end": end})
+
+        return decoded['data']
+
+    async def label_values(self, label, matches=None, start=None, end=None):
+        """Query prometheus for values of a specified label.
+
+        :param label: Name of label for which to return values
+        :type label: str
+        :param matches: List of matches, that restrict the series
+                        from which the values are read
+        :type matches: [str]
+        :param start: Timestamp from which to look for the values
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp until which to look for the values
+        :type end: rfc3339 or unix_timestamp
+        """
+        LOG.debug("Querying prometheus for the values of label: %s", label)
+        decoded = await self._get(f"label/{label}/values",
+                                  {"match[]": matches,
+                                   "start": start,
+                                   "end": end})
+
+        return decoded['data']
+
+    # ---------
+    # admin api
+    # ---------
+
+    async def delete(self, matches, start=None, end=None):
+        """Delete some metrics from prometheus.
+
+        :param matches: List of matches, that specify which metrics to delete
+        :type matches [str]
+        :param start: Timestamp from which to start deleting.
+                      None for as early as possible.
+        :type start: timestamp
+        :param end: Timestamp until which to delete.
+                    None for as late as possible.
+        :type end: timestamp
+        """
+        LOG.debug("Deleting metrics from prometheus matching: %s", matches)
+        try:
+            await self._post("admin/tsdb/delete_series", {"match[]": matches,
+                                                          "start": start,
+                                                          "end": end})
+        except PrometheusAPIClientError as exc:
+            # The 204 is allowed here. 204 is "No Content",
+            # which is expected on a successful call
+            if exc.resp.status_code != 204:
+                raise exc
+
+    async def clean_tombstones(self):
+        """Ask prometheus to clean tombstones."""
+        LOG.debug("Cleaning tombstones from prometheus")
+        try:
+            await self._post("admin/tsdb/clean_tombstones")
+        except PrometheusAPIClientError as exc:
+            # The 204 is allowed here. 204 is "No Content",
+            # which is expected on a successful call
+            if exc.resp.status_code != 204:
+                raise exc
+
+    async def snapshot(self):
+        """Create a snapshot and return the file name containing the data."""
+        LOG.debug("Taking prometheus data snapshot")
+        ret = await self._post("admin/tsdb/snapshot")
+        return ret["data"]["name"]
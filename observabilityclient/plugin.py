@@ -14,8 +14,6 @@
 
 """OpenStackClient Plugin interface."""
 
-from osc_lib import utils
-
 
 DEFAULT_API_VERSION = '1'
 API_NAME = 'observabilityclient'
@@ -33,16 +31,27 @@ def make_client(instance):
 
     :param ClientManager instance: The ClientManager that owns the new client
     """
+    # NOTE The plugin is loaded by every openstack command, so anything
+    #      not needed to register the commands is imported here.
+    from osc_lib import utils
+
+    from observabilityclient.utils import metric_utils
+
     observability_client = utils.get_client_class(
         API_NAME,
         instance._api_version[API_NAME],
         API_VERSIONS)
 
-    client = observability_client(session=instance.session,
-                                  adapter_options={
-                                      'interface': instance.interface,
-                                      'region_name': instance.region_name
-                                  })
+    # NOTE Every CLI command runs in a new process, the disk cache
+    #      saves fetching all metric names for each of them. Cached
+    #      names can be stale, so it's enabled only if it's configured.
+    client = observability_client(
+        session=instance.session,
+        adapter_options={
+            'interface': instance.interface,
+            'region_name': instance.region_name
+        },
+        disk_cache_options=metric_utils.get_disk_cache_options())
     return client
 
 
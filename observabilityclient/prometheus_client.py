@@ -12,13 +12,98 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+from array import array
+import bisect
+import codecs
+from concurrent import futures
+import datetime
+import json
 import logging
+import math
+import re
+import sys
+import time
+from urllib import parse
 
 import requests
+import urllib3
+
+from observabilityclient.utils.cache import TTLCache
 
 
 LOG = logging.getLogger(__name__)
 
+# Prometheus refuses range queries with more points per series
+MAX_RANGE_POINTS = 11000
+
+DURATION_UNITS = {
+    'ms': 0.001,
+    's': 1,
+    'm': 60,
+    'h': 60 * 60,
+    'd': 24 * 60 * 60,
+    'w': 7 * 24 * 60 * 60,
+    'y': 365 * 24 * 60 * 60,
+}
+DURATION_REGEX = re.compile(r'(\d+)(ms|s|m|h|d|w|y)')
+
+
+def to_timestamp(value):
+    """Convert a rfc3339 or unix timestamp to seconds since the epoch."""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    value = value.replace('Z', '+00:00').replace('z', '+00:00')
+    return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def to_seconds(value):
+    """Convert a prometheus duration or a number of seconds to seconds."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    seconds = 0
+    end = 0
+    for match in DURATION_REGEX.finditer(value):
+        if match.start() != end:
+            break
+        seconds += int(match.group(1)) * DURATION_UNITS[match.group(2)]
+        end = match.end()
+    if end == 0 or end != len(value):
+        raise ValueError(f"Invalid duration: {value}")
+    return seconds
+
+
+def split_range(start, end, step, max_points=MAX_RANGE_POINTS,
+                interval=None):
+    """Split a range query into sub-windows.
+
+    The evaluation timestamps of all windows are the same as the ones
+    of the whole range, i.e. start + k * step. The windows end at
+    multiples of the interval, so that the same window is produced
+    for overlapping ranges. No window has more than max_points points.
+
+    :returns: List of (start, end) tuples
+    """
+    window = max_points * step
+    if interval is not None:
+        window = min(window, max(interval, step))
+    last_index = math.floor((end - start) / step)
+    windows = []
+    index = 0
+    while index <= last_index:
+        window_start = start + index * step
+        boundary = (window_start // window + 1) * window
+        points = max(math.ceil((boundary - window_start) / step), 1)
+        window_last_index = min(index + points - 1, last_index)
+        windows.append((window_start, start + window_last_index * step))
+        index = window_last_index + 1
+    return windows
+
 
 class PrometheusAPIClientError(Exception):
     def __init__(self, response):
@@ -33,7 +118,9 @@ class PrometheusAPIClientError(Exception):
             return f'[{self.resp.status_code}] {self.resp.reason}'
         else:
             decoded = self.resp.json()
-            return f'[{decoded.status}]'
+            if 'error' in decoded:
+                return f'[{self.resp.status_code}] {decoded["error"]}'
+            return f'[{decoded["status"]}]'
 
     def __repr__(self) -> str:
         if self.resp.status_code != requests.codes.ok:
@@ -44,22 +131,464 @@ class PrometheusAPIClientError(Exception):
             return f'[{self.resp.status_code}] {self.resp.reason}'
         else:
             decoded = self.resp.json()
-            return f'[{decoded.status}]'
+            if 'error' in decoded:
+                return f'[{self.resp.status_code}] {decoded["error"]}'
+            return f'[{decoded["status"]}]'
+
+
+class BufferedResponse:
+    """Response, which body was already read.
+
+    It provides the parts of the requests.Response interface, which
+    PrometheusAPIClientError relies on.
+    """
+
+    def __init__(self, status_code, reason, body):
+        self.status_code = status_code
+        self.reason = reason
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body)
+
+
+STREAM_CHUNK_SIZE = 64 * 1024
+_STATUS_REGEX = re.compile(r'"status"\s*:\s*"(\w+)"')
+_RESULT_TYPE_REGEX = re.compile(r'"resultType"\s*:\s*"(\w+)"')
+_RESULT_REGEX = re.compile(r'"result"\s*:\s*\[')
+_DATA_REGEX = re.compile(r'"data"\s*:\s*\[')
+
+
+def iter_json_array(resp, marker):
+    """Decode items of a JSON array in a streamed response one at a time.
+
+    Only the part of the body, which wasn't decoded yet is kept
+    in memory.
+
+    :param resp: Response of a request sent with stream=True
+    :type resp: requests.Response
+    :param marker: Regex matching the key and the opening bracket
+                   of the array, like the '"result":[' string
+    :type marker: re.Pattern
+    :returns: Generator, which first yields the part of the body
+              preceding the array and then the decoded items
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = resp.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    buffer = ''
+    match = None
+    for chunk in chunks:
+        buffer += text.decode(chunk)
+        match = marker.search(buffer)
+        if match is not None:
+            break
+    if match is None:
+        # Not the expected document, e.g. an error response
+        buffer += text.decode(b'', final=True)
+        raise PrometheusAPIClientError(
+            BufferedResponse(resp.status_code, resp.reason, buffer))
+    yield buffer[:match.start()]
+
+    pos = match.end()
+    exhausted = False
+    while True:
+        while pos < len(buffer) and buffer[pos] in ' \t\r\n,':
+            pos += 1
+        if pos < len(buffer) and buffer[pos] == ']':
+            return
+        try:
+            if pos == len(buffer):
+                raise ValueError("Need more data")
+            item, end = decoder.raw_decode(buffer, pos)
+            # NOTE An item is complete only once the delimiter following
+            #      it was received. A number split between chunks, like
+            #      "1." and "5", decodes as a shorter number.
+            after = end
+            while after < len(buffer) and buffer[after] in ' \t\r\n':
+                after += 1
+            if after == len(buffer) or buffer[after] not in ',]':
+                raise ValueError("Expecting ',' or ']' after an item")
+            pos = end
+        except ValueError:
+            if exhausted:
+                raise
+            chunk = next(chunks, None)
+            if chunk is None:
+                exhausted = True
+                buffer += text.decode(b'', final=True)
+            else:
+                # Drop the decoded part of the buffer
+                buffer = buffer[pos:] + text.decode(chunk)
+                pos = 0
+            continue
+        yield item
 
 
 class PrometheusMetric:
-    def __init__(self, input):
+    """Single sample of a vector result.
+
+    The labels are stored as a tuple of keys and a tuple of values with
+    all strings interned. Metrics created with the same schemas dict
+    share the tuples of keys, so a row only stores its label values.
+
+    :param input: Item of the "result" list of a vector response
+    :type input: dict
+    :param schemas: Table of label key tuples shared between metrics
+    :type schemas: dict
+    """
+
+    __slots__ = ('timestamp', 'value', 'label_keys', 'label_values')
+
+    def __init__(self, input, schemas=None):
         self.timestamp = input['value'][0]
-        self.labels = input['metric']
         self.value = input['value'][1]
+        self._set_labels(input['metric'], schemas)
+
+    def _set_labels(self, labels, schemas=None):
+        keys = tuple(labels)
+        shared_keys = None if schemas is None else schemas.get(keys)
+        if shared_keys is None:
+            shared_keys = tuple(sys.intern(key) for key in keys)
+            if schemas is not None:
+                schemas[shared_keys] = shared_keys
+        self.label_keys = shared_keys
+        self.label_values = tuple(sys.intern(value)
+                                  for value in labels.values())
+
+    @property
+    def labels(self):
+        return dict(zip(self.label_keys, self.label_values))
+
+    @labels.setter
+    def labels(self, labels):
+        self._set_labels(labels)
+
+
+_numpy = False
+
+
+def _import_numpy():
+    """Return the numpy module, or None if it isn't installed.
+
+    numpy is imported on the first use of a view, so the commands,
+    which don't use them, don't pay for loading it.
+    """
+    global _numpy
+    if _numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        _numpy = numpy
+    return _numpy
+
+
+def float_array(values):
+    """Convert numbers or prometheus sample strings to float64 values.
+
+    A numpy array is returned when numpy is installed, array('d')
+    otherwise. Strings like "NaN" and "+Inf" are understood by both.
+    """
+    numpy = _import_numpy()
+    if numpy is not None:
+        return numpy.array(values, dtype=numpy.float64)
+    return array('d', map(float, values))
+
+
+class VectorView:
+    """Columnar view of a vector result.
+
+    The timestamps and values of all metrics are converted to floats
+    at once and kept in contiguous float64 arrays, so aggregates can be
+    computed without looping over the metrics.
+
+    :param metrics: Result of a vector query
+    :type metrics: [PrometheusMetric]
+    """
+
+    def __init__(self, metrics):
+        self.metrics = list(metrics)
+        self.timestamps = float_array([m.timestamp for m in self.metrics])
+        self.values = float_array([m.value for m in self.metrics])
+
+    def __len__(self):
+        return len(self.metrics)
+
+    def labels(self, index):
+        """Return the labels of the metric at index."""
+        return self.metrics[index].labels
+
+
+def range_windows(start, end, step, max_points=MAX_RANGE_POINTS,
+                  interval=None):
+    """Split a range query given in any format prometheus understands.
+
+    Same as split_range(), but an empty list is returned for values,
+    which can't be converted to numbers.
+    """
+    try:
+        start = to_timestamp(start)
+        end = to_timestamp(end)
+        step = to_seconds(step)
+    except (TypeError, ValueError):
+        # Let prometheus deal with values we don't understand
+        return []
+    if step <= 0 or end < start:
+        return []
+    return split_range(start, end, step, max_points, interval)
+
+
+class RangeSeries:
+    """Samples of a single series stored in two columns.
+
+    The timestamps and values are kept in array('d') buffers instead
+    of lists of python objects.
+    """
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.timestamps = array('d')
+        self.values = array('d')
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def extend(self, samples):
+        """Append samples as returned by prometheus.
+
+        :param samples: List of [timestamp, "value"] pairs
+        :type samples: list
+        """
+        if self.timestamps and samples:
+            last = self.timestamps[-1]
+            if samples[0][0] <= last:
+                samples = [sample for sample in samples if sample[0] > last]
+        self.timestamps.extend([sample[0] for sample in samples])
+        self.values.extend([float(sample[1]) for sample in samples])
+
+    def samples(self):
+        """Return an iterator over (timestamp, value) pairs."""
+        return zip(self.timestamps, self.values)
+
+    def slice(self, start, end):
+        """Return a copy with the samples from start to end inclusive."""
+        first = bisect.bisect_left(self.timestamps, start)
+        last = bisect.bisect_right(self.timestamps, end)
+        series = RangeSeries(self.labels)
+        series.timestamps = self.timestamps[first:last]
+        series.values = self.values[first:last]
+        return series
+
+
+class RangeResult:
+    """Columnar representation of a matrix result.
+
+    :param result: The "result" list of a matrix response
+    :type result: list
+    """
+
+    def __init__(self, result=None):
+        self.series = []
+        self._series_by_labels = {}
+        if result is not None:
+            self.extend(result)
+
+    def __iter__(self):
+        return iter(self.series)
+
+    def __len__(self):
+        return len(self.series)
+
+    def __getitem__(self, index):
+        return self.series[index]
+
+    def extend(self, result):
+        """Add the series of a matrix result.
+
+        Samples of a series, which is already part of this result
+        are appended to the existing series. Samples, which aren't
+        newer than the last sample of the series are skipped.
+        """
+        for item in result:
+            key = tuple(sorted(item['metric'].items()))
+            series = self._series_by_labels.get(key)
+            if series is None:
+                series = RangeSeries(item['metric'])
+                self._series_by_labels[key] = series
+                self.series.append(series)
+            series.extend(item['values'])
+
+    def merge(self, other):
+        """Add the series of another RangeResult.
+
+        Same as extend(), but the samples are copied between the arrays
+        without converting them back to prometheus lists.
+        """
+        for other_series in other:
+            key = tuple(sorted(other_series.labels.items()))
+            series = self._series_by_labels.get(key)
+            if series is None:
+                series = RangeSeries(other_series.labels)
+                self._series_by_labels[key] = series
+                self.series.append(series)
+            first = 0
+            if series.timestamps:
+                first = bisect.bisect_right(other_series.timestamps,
+                                            series.timestamps[-1])
+            series.timestamps.extend(other_series.timestamps[first:])
+            series.values.extend(other_series.values[first:])
+
+    def slice(self, start, end):
+        """Return a copy with the samples from start to end inclusive.
+
+        Series without any samples in the interval are left out.
+        """
+        result = RangeResult()
+        for series in self.series:
+            sliced = series.slice(start, end)
+            if len(sliced):
+                result.merge([sliced])
+        return result
+
+
+def result_nbytes(result):
+    """Estimate the memory used by a query result in bytes.
+
+    Label strings are interned and label key tuples are shared between
+    metrics, so only the tuples of label values are counted.
+    """
+    size = sys.getsizeof(result)
+    if isinstance(result, RangeResult):
+        for series in result.series:
+            size += (sys.getsizeof(series.labels) +
+                     sys.getsizeof(series.timestamps) +
+                     sys.getsizeof(series.values))
+        return size
+    for metric in result:
+        size += (sys.getsizeof(metric) +
+                 sys.getsizeof(metric.value) +
+                 sys.getsizeof(metric.label_values))
+    return size
+
+
+def accept_encoding():
+    """Return the Accept-Encoding header value for compressed responses.
+
+    gzip is always requested, zstd only when urllib3 is able to decode
+    it, which depends on the zstandard library being installed.
+    """
+    # NOTE urllib3 advertises only encodings, it's able to decode
+    supported = urllib3.util.request.ACCEPT_ENCODING.split(',')
+    return ", ".join(['gzip'] + [e for e in ('zstd',) if e in supported])
+
+
+class TimeoutHTTPAdapter(requests.adapters.HTTPAdapter):
+    """HTTPAdapter, which applies a default timeout to every request.
+
+    :param timeout: Seconds or (connect, read) tuple, None to wait forever
+    :type timeout: float or tuple
+    """
+
+    def __init__(self, timeout=None, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        return super().send(request, **kwargs)
 
 
 class PrometheusAPIClient:
-    def __init__(self, host):
+    """Client for the prometheus HTTP API.
+
+    :param host: Prometheus host and port
+    :type host: str
+    :param max_range_points: Maximum number of points per series
+                             of a single range query request
+    :type max_range_points: int
+    :param range_split_interval: Seconds after which range queries
+                                 are split into multiple requests
+    :type range_split_interval: float
+    :param max_workers: Maximum number of concurrent requests of
+                        a single range query
+    :type max_workers: int
+    :param pool_connections: Number of connection pools to cache
+    :type pool_connections: int
+    :param pool_maxsize: Maximum number of connections in a pool
+    :type pool_maxsize: int
+    :param timeout: Seconds or (connect, read) tuple, None to wait forever
+    :type timeout: float or tuple
+    :param retries: Number of retries of failed GET requests
+    :type retries: int
+    :param backoff_factor: Factor of the exponential backoff between
+                           retries in seconds
+    :type backoff_factor: float
+    :param compression: Request compressed responses if set to True
+    :type compression: boolean
+    :param keep_alive: Keep connections open between requests
+    :type keep_alive: boolean
+    :param post_threshold: Length of the encoded parameters, above which
+                           read requests are sent as form encoded POST
+    :type post_threshold: int
+    :param range_cache_size: Number of range queries, whose results are
+                             cached and extended incrementally.
+                             0 disables the cache.
+    :type range_cache_size: int
+    :param range_cache_freshness: Seconds before now, which aren't
+                                  cached, because prometheus may still
+                                  ingest samples for them
+    :type range_cache_freshness: float
+    """
+
+    # Responses of overloaded or restarting servers worth retrying
+    RETRY_STATUSES = (502, 503, 504)
+
+    # Read endpoints, which accept form encoded POST requests as well
+    POST_ENDPOINTS = frozenset(['query', 'query_range', 'series', 'labels'])
+
+    def __init__(self, host, max_range_points=MAX_RANGE_POINTS,
+                 range_split_interval=None, max_workers=4,
+                 pool_connections=10, pool_maxsize=10, timeout=None,
+                 retries=0, backoff_factor=0.5, compression=True,
+                 keep_alive=True, post_threshold=4096, range_cache_size=0,
+                 range_cache_freshness=60):
         self._host = host
+        self._range_cache = None
+        if range_cache_size:
+            self._range_cache = TTLCache(maxsize=range_cache_size)
+        self._range_cache_freshness = range_cache_freshness
+        self._clock = time.time
+        self._post_threshold = post_threshold
+        self._max_range_points = max_range_points
+        self._range_split_interval = range_split_interval
+        self._max_workers = max_workers
         self._session = requests.Session()
         self._session.verify = False
 
+        retry = urllib3.util.Retry(total=retries,
+                                   backoff_factor=backoff_factor,
+                                   status_forcelist=self.RETRY_STATUSES,
+                                   allowed_methods=frozenset(['GET']),
+                                   raise_on_status=False)
+        adapter = TimeoutHTTPAdapter(timeout=timeout,
+                                     pool_connections=pool_connections,
+                                     pool_maxsize=pool_maxsize,
+                                     max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if compression:
+            self._session.headers['Accept-Encoding'] = accept_encoding()
+        else:
+            self._session.headers['Accept-Encoding'] = 'identity'
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
+    @property
+    def host(self):
+        return self._host
+
     def set_ca_cert(self, ca_cert):
         self._session.verify = ca_cert
 
@@ -70,11 +599,35 @@ class PrometheusAPIClient:
     def set_basic_auth(self, auth_user, auth_password):
         self._session.auth = (auth_user, auth_password)
 
+    def close(self):
+        """Close the pooled connections.
+
+        The client stays usable, new connections are opened on demand.
+        """
+        self._session.close()
+
+    def _url(self, endpoint):
+        return (f"{'https' if self._session.verify else 'http'}://"
+                f"{self._host}/api/v1/{endpoint}")
+
+    def _send_get(self, endpoint, params=None, **kwargs):
+        # NOTE Long queries, especially after the rbac enrichment, and
+        #      long lists of matches could exceed URL length limits
+        #      of proxies, so they're sent in the body instead.
+        url = self._url(endpoint)
+        if (params and endpoint in self.POST_ENDPOINTS and
+                len(parse.urlencode(params, doseq=True)) >
+                self._post_threshold):
+            LOG.debug("Sending %s request as POST", endpoint)
+            return self._session.post(url, data=params,
+                                      headers={'Accept': 'application/json'},
+                                      **kwargs)
+        return self._session.get(url, params=params,
+                                 headers={'Accept': 'application/json'},
+                                 **kwargs)
+
     def _get(self, endpoint, params=None):
-        url = (f"{'https' if self._session.verify else 'http'}://"
-               f"{self._host}/api/v1/{endpoint}")
-        resp = self._session.get(url, params=params,
-                                 headers={'Accept': 'application/json'})
+        resp = self._send_get(endpoint, params)
         if resp.status_code != requests.codes.ok:
             raise PrometheusAPIClientError(resp)
         decoded = resp.json()
@@ -83,9 +636,21 @@ class PrometheusAPIClient:
 
         return decoded
 
+    def _get_stream(self, endpoint, params=None):
+        """Send a GET request and return the response without reading it.
+
+        The caller is responsible for closing the response.
+        """
+        resp = self._send_get(endpoint, params, stream=True)
+        if resp.status_code != requests.codes.ok:
+            try:
+                raise PrometheusAPIClientError(resp)
+            finally:
+                resp.close()
+        return resp
+
     def _post(self, endpoint, params=None):
-        url = (f"{'https' if self._session.verify else 'http'}://"
-               f"{self._host}/api/v1/{endpoint}")
+        url = self._url(endpoint)
         resp = self._session.post(url, params=params,
                                   headers={'Accept': 'application/json'})
         if resp.status_code != requests.codes.ok:
@@ -95,21 +660,184 @@ class PrometheusAPIClient:
             raise PrometheusAPIClientError(resp)
         return decoded
 
-    def query(self, query):
+    def query(self, query, time=None):
         """Send custom queries to Prometheus.
 
         :param query: the query to send
         :type query: str
+        :param time: Evaluation time, None for the current server time
+        :type time: rfc3339 or unix_timestamp
         """
         LOG.debug("Querying prometheus with query: %s", query)
-        decoded = self._get("query", dict(query=query))
+        params = dict(query=query)
+        if time is not None:
+            params['time'] = time
+        decoded = self._get("query", params)
 
         if decoded['data']['resultType'] == 'vector':
-            result = [PrometheusMetric(i) for i in decoded['data']['result']]
+            schemas = {}
+            result = [PrometheusMetric(i, schemas)
+                      for i in decoded['data']['result']]
+        elif decoded['data']['resultType'] == 'matrix':
+            result = RangeResult(decoded['data']['result'])
+        else:
+            # scalar and string results are a single [time, value]
+            result = [PrometheusMetric({'metric': {},
+                                        'value': decoded['data']['result']})]
+        return result
+
+    def query_iter(self, query):
+        """Send custom queries to Prometheus and stream the result.
+
+        The response is decoded incrementally and the result is
+        yielded one item at a time, so the whole response is never
+        held in memory. Items of vector results are PrometheusMetric,
+        items of matrix results are RangeSeries.
+
+        :param query: the query to send
+        :type query: str
+        """
+        LOG.debug("Streaming prometheus query: %s", query)
+        resp = self._get_stream("query", dict(query=query))
+        try:
+            items = iter_json_array(resp, _RESULT_REGEX)
+            head = next(items)
+            self._check_stream_status(resp, head)
+            result_type = _RESULT_TYPE_REGEX.search(head)
+            result_type = result_type and result_type.group(1)
+            if result_type == 'vector':
+                schemas = {}
+                for item in items:
+                    yield PrometheusMetric(item, schemas)
+            elif result_type == 'matrix':
+                for item in items:
+                    series = RangeSeries(item['metric'])
+                    series.extend(item['values'])
+                    yield series
+            else:
+                # scalar and string results are a single [time, value]
+                yield PrometheusMetric({'metric': {}, 'value': list(items)})
+        finally:
+            resp.close()
+
+    def _check_stream_status(self, resp, head):
+        status = _STATUS_REGEX.search(head)
+        if status is not None and status.group(1) != 'success':
+            raise PrometheusAPIClientError(
+                BufferedResponse(resp.status_code, resp.reason, head))
+
+    def query_range(self, query, start, end, step):
+        """Send custom range queries to Prometheus.
+
+        Ranges with more points than max_range_points, or longer
+        than range_split_interval are split into sub-windows, which
+        are fetched concurrently and merged into a single result.
+
+        With the range cache enabled, results are cached per query,
+        step and step alignment of start. Repeated queries fetch only
+        the parts of the range, which aren't cached yet.
+
+        :param query: the query to send
+        :type query: str
+        :param start: Timestamp of the first evaluation
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp of the last evaluation
+        :type end: rfc3339 or unix_timestamp
+        :param step: Evaluation step, duration or number of seconds
+        :type step: str or float
+        """
+        LOG.debug("Querying prometheus with range query: %s", query)
+        if self._range_cache is not None:
+            try:
+                start_ts = to_timestamp(start)
+                end_ts = to_timestamp(end)
+                step_s = to_seconds(step)
+            except (TypeError, ValueError):
+                # Let prometheus deal with values we don't understand
+                pass
+            else:
+                if step_s > 0 and end_ts >= start_ts:
+                    return self._cached_query_range(query, start_ts, end_ts,
+                                                    step_s)
+        return self._query_range(query, start, end, step)
+
+    def _cached_query_range(self, query, start, end, step):
+        def grid_point(timestamp):
+            # Last evaluation time not after timestamp
+            points = math.floor((timestamp - start) / step)
+            return round(start + points * step, 3)
+
+        end = grid_point(end)
+        key = (query, step, round(start % step, 3))
+        entry = self._range_cache.get(key)
+        parts = []
+        if entry is not None and entry[0] <= end and entry[1] >= start:
+            cached_start, cached_end, cached = entry
+            if start < cached_start:
+                parts.append(self._query_range(query, start,
+                                               cached_start - step, step))
+            parts.append(cached)
+            if end > cached_end:
+                parts.append(self._query_range(query, cached_end + step,
+                                               end, step))
+            cache_end = max(end, cached_end)
+        else:
+            parts.append(self._query_range(query, start, end, step))
+            cache_end = end
+        LOG.debug("Range query fetched in %d parts", len(parts))
+
+        result = RangeResult()
+        for part in parts:
+            result.merge(part)
+
+        # Samples before start are dropped from the cache, recent
+        # samples might still change, so they're fetched every time.
+        cache_end = min(cache_end,
+                        grid_point(self._clock() -
+                                   self._range_cache_freshness))
+        if cache_end >= start:
+            self._range_cache.put(key, (start, cache_end,
+                                        result.slice(start, cache_end)))
         else:
-            result = [PrometheusMetric(decoded)]
+            self._range_cache.invalidate(key)
+        return result.slice(start, end)
+
+    def invalidate_range_cache(self):
+        """Drop all cached range query results."""
+        if self._range_cache is not None:
+            self._range_cache.invalidate()
+
+    def _query_range(self, query, start, end, step):
+        windows = self._split_range(start, end, step)
+        if len(windows) <= 1:
+            decoded = self._get("query_range", dict(query=query,
+                                                    start=start,
+                                                    end=end,
+                                                    step=step))
+            return RangeResult(decoded['data']['result'])
+
+        LOG.debug("Splitting range query into %d windows", len(windows))
+        step = to_seconds(step)
+
+        def fetch(window):
+            return self._get("query_range", dict(query=query,
+                                                 start=window[0],
+                                                 end=window[1],
+                                                 step=step))
+
+        workers = min(self._max_workers, len(windows))
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # map() returns the responses in the order of the windows
+            responses = executor.map(fetch, windows)
+            result = RangeResult()
+            for decoded in responses:
+                result.extend(decoded['data']['result'])
         return result
 
+    def _split_range(self, start, end, step):
+        return range_windows(start, end, step, self._max_range_points,
+                             self._range_split_interval)
+
     def series(self, matches):
         """Query the /series/ endpoint of prometheus.
 
@@ -121,26 +849,88 @@ class PrometheusAPIClient:
 
         return decoded['data']
 
-    def labels(self):
+    def series_iter(self, matches, start=None, end=None):
+        """Query the /series/ endpoint of prometheus and stream the result.
+
+        The response is decoded incrementally and the label sets
+        of the series are yielded one at a time.
+
+        :param matches: List of matches to send as parameters
+        :type matches: [str]
+        :param start: Timestamp from which to look for the series
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp until which to look for the series
+        :type end: rfc3339 or unix_timestamp
+        """
+        LOG.debug("Streaming prometheus series with matches: %s", matches)
+        params = {"match[]": matches}
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        resp = self._get_stream("series", params)
+        try:
+            items = iter_json_array(resp, _DATA_REGEX)
+            self._check_stream_status(resp, next(items))
+            yield from items
+        finally:
+            resp.close()
+
+    def labels(self, matches=None, start=None, end=None):
         """Query the /labels/ endpoint of prometheus, returns list of labels.
 
-        There isn't a way to tell prometheus to restrict
-        which labels to return. It's not possible to enforce
-        rbac with this for example.
+        Long lists of matches are sent as POST like for the series.
+
+        :param matches: List of matches, that restrict the series
+                        from which the label names are read
+        :type matches: [str]
+        :param start: Timestamp from which to look for the labels
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp until which to look for the labels
+        :type end: rfc3339 or unix_timestamp
         """
         LOG.debug("Querying prometheus for labels")
-        decoded = self._get("labels")
+        params = {}
+        if matches is not None:
+            params["match[]"] = matches
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        if params:
+            decoded = self._get("labels", params)
+        else:
+            decoded = self._get("labels")
 
         return decoded['data']
 
-    def label_values(self, label):
+    def label_values(self, label, matches=None, start=None, end=None):
         """Query prometheus for values of a specified label.
 
         :param label: Name of label for which to return values
         :type label: str
+        :param matches: List of matches, that restrict the series
+                        from which the values are read
+        :type matches: [str]
+        :param start: Timestamp from which to look for the values
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp until which to look for the values
+        :type end: rfc3339 or unix_timestamp
         """
         LOG.debug("Querying prometheus for the values of label: %s", label)
-        decoded = self._get(f"label/{label}/values")
+        # NOTE Prometheus accepts only GET requests for label values,
+        #      so long lists of matches can't be sent as POST.
+        params = {}
+        if matches is not None:
+            params["match[]"] = matches
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        if params:
+            decoded = self._get(f"label/{label}/values", params)
+        else:
+            decoded = self._get(f"label/{label}/values")
 
         return decoded['data']
 
@@ -0,0 +1,212 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import asyncio
+import json
+from unittest import mock
+
+import testtools
+
+from observabilityclient import async_prometheus_client as client
+from observabilityclient.prometheus_client import PrometheusAPIClientError
+from observabilityclient.prometheus_client import RangeResult
+
+
+class FakeResponse(object):
+    def __init__(self, status, body, reason="OK"):
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        pass
+
+    async def text(self):
+        return self.body
+
+
+class FakeSession(object):
+    def __init__(self, response):
+        self.response = response
+        self.request = mock.Mock(return_value=response)
+
+
+@testtools.skipIf(client.aiohttp is None, "aiohttp isn't installed")
+class AsyncPrometheusAPIClientTest(testtools.TestCase):
+    def setUp(self):
+        super(AsyncPrometheusAPIClientTest, self).setUp()
+        self.client = client.AsyncPrometheusAPIClient("localhost:9090")
+
+    def _set_response(self, status, body):
+        session = FakeSession(FakeResponse(status, body))
+        self.client._get_session = mock.Mock(return_value=session)
+        return session
+
+    def test_get(self):
+        body = json.dumps({"status": "success", "data": []})
+        session = self._set_response(200, body)
+
+        ret = asyncio.run(self.client._get("series",
+                                           {"match[]": ["up", "down"],
+                                            "start": None,
+                                            "end": 10}))
+
+        self.assertEqual({"status": "success", "data": []}, ret)
+        session.request.assert_called_with(
+            'GET', "http://localhost:9090/api/v1/series",
+            params=[("match[]", "up"), ("match[]", "down"), ("end", "10")],
+            headers={'Accept': 'application/json'})
+
+    def test_get_long_params(self):
+        body = json.dumps({"status": "success", "data": []})
+        session = self._set_response(200, body)
+        self.client._post_threshold = 20
+        matches = ["metric_a", "metric_b"]
+
+        asyncio.run(self.client._get("series", {"match[]": matches}))
+
+        session.request.assert_called_with(
+            'POST', "http://localhost:9090/api/v1/series",
+            params=[], headers={'Accept': 'application/json'},
+            data=[("match[]", "metric_a"), ("match[]", "metric_b")])
+
+    def test_labels_long_matches(self):
+        body = json.dumps({"status": "success", "data": ["job"]})
+        session = self._set_response(200, body)
+        self.client._post_threshold = 20
+
+        ret = asyncio.run(self.client.labels(["metric_a", "metric_b"]))
+
+        self.assertEqual(["job"], ret)
+        session.request.assert_called_with(
+            'POST', "http://localhost:9090/api/v1/labels",
+            params=[], headers={'Accept': 'application/json'},
+            data=[("match[]", "metric_a"), ("match[]", "metric_b")])
+
+    def test_get_error(self):
+        body = json.dumps({"status": "error", "error": "test_error"})
+        self._set_response(500, body)
+
+        exc = self.assertRaises(PrometheusAPIClientError, asyncio.run,
+                                self.client._get("query"))
+        self.assertEqual("[500] test_error", str(exc))
+
+    def test_https(self):
+        body = json.dumps({"status": "success", "data": []})
+        session = self._set_response(200, body)
+        self.client.set_ca_cert(True)
+
+        asyncio.run(self.client._get("labels"))
+
+        session.request.assert_called_with(
+            'GET', "https://localhost:9090/api/v1/labels",
+            params=[], headers={'Accept': 'application/json'})
+
+    def test_query(self):
+        result = [{"metric": {"__name__": "up"}, "value": [1, "1"]}]
+        decoded = {"status": "success",
+                   "data": {"resultType": "vector", "result": result}}
+
+        with mock.patch.object(client.AsyncPrometheusAPIClient, '_get',
+                               new=mock.AsyncMock(return_value=decoded)) as m:
+            ret = asyncio.run(self.client.query("up"))
+
+        m.assert_called_with("query", {"query": "up"})
+        self.assertEqual(1, len(ret))
+        self.assertEqual({"__name__": "up"}, ret[0].labels)
+        self.assertEqual("1", ret[0].value)
+
+        with mock.patch.object(client.AsyncPrometheusAPIClient, '_get',
+                               new=mock.AsyncMock(return_value=decoded)) as m:
+            asyncio.run(self.client.query("up", time=1234.5))
+
+        m.assert_called_with("query", {"query": "up", "time": 1234.5})
+
+    def test_query_scalar(self):
+        decoded = {"status": "success",
+                   "data": {"resultType": "scalar", "result": [103254, "2"]}}
+
+        with mock.patch.object(client.AsyncPrometheusAPIClient, '_get',
+                               new=mock.AsyncMock(return_value=decoded)):
+            ret = asyncio.run(self.client.query("1+1"))
+
+        self.assertEqual(1, len(ret))
+        self.assertEqual({}, ret[0].labels)
+        self.assertEqual(103254, ret[0].timestamp)
+        self.assertEqual("2", ret[0].value)
+
+    def test_query_range_split(self):
+        async def get(endpoint, params):
+            start = int(params["start"])
+            end = int(params["end"])
+            values = [[t, str(t)] for t in range(start, end + 1, 10)]
+            return {"status": "success",
+                    "data": {"resultType": "matrix",
+                             "result": [{"metric": {"a": "b"},
+                                         "values": values}]}}
+
+        self.client._max_range_points = 4
+        with mock.patch.object(client.AsyncPrometheusAPIClient, '_get',
+                               side_effect=get) as m:
+            ret = asyncio.run(self.client.query_range("up", 0, 100, 10))
+
+        self.assertEqual(3, m.call_count)
+        self.assertIsInstance(ret, RangeResult)
+        self.assertEqual(list(range(0, 101, 10)), list(ret[0].timestamps))
+
+    def test_label_values(self):
+        decoded = {"status": "success", "data": ["a", "b"]}
+
+        with mock.patch.object(client.AsyncPrometheusAPIClient, '_get',
+                               new=mock.AsyncMock(return_value=decoded)) as m:
+            ret = asyncio.run(self.client.label_values("__name__",
+                                                       matches="{a='b'}"))
+
+        m.assert_called_with("label/__name__/values",
+                             {"match[]": "{a='b'}",
+                              "start": None,
+                              "end": None})
+        self.assertEqual(["a", "b"], ret)
+
+    def test_delete(self):
+        self._set_response(204, "")
+
+        # The 204 is expected to be swallowed by delete()
+        asyncio.run(self.client.delete(["up"], 1, 2))
+
+    def test_delete_error(self):
+        body = json.dumps({"status": "error", "error": "admin apis disabled"})
+        self._set_response(500, body)
+
+        self.assertRaises(PrometheusAPIClientError, asyncio.run,
+                          self.client.delete(["up"]))
+
+    def test_snapshot(self):
+        body = json.dumps({"status": "success",
+                           "data": {"name": "somefilename"}})
+        self._set_response(200, body)
+
+        ret = asyncio.run(self.client.snapshot())
+        self.assertEqual("somefilename", ret)
+
+
+class AsyncPrometheusAPIClientNoAiohttpTest(testtools.TestCase):
+    def test_missing_aiohttp(self):
+        with mock.patch.object(client, 'aiohttp', None):
+            self.assertRaises(ImportError,
+                              client.AsyncPrometheusAPIClient,
+                              "localhost:9090")
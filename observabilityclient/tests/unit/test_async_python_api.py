@@ -0,0 +1,122 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import asyncio
+from unittest import mock
+
+import testtools
+
+from observabilityclient.utils import cache
+from observabilityclient.v1 import async_python_api
+from observabilityclient.v1 import query_optimizer
+from observabilityclient.v1 import rbac
+
+
+class AsyncQueryManagerTest(testtools.TestCase):
+    def setUp(self):
+        super(AsyncQueryManagerTest, self).setUp()
+        self.client = mock.Mock()
+        self.client.metric_name_cache = cache.TTLCache(ttl=60)
+        self.client.query_optimizer = None
+
+        self.rbac = rbac.Rbac(self.client, mock.Mock())
+        self.rbac.default_labels = {'project': 'project_id'}
+        self.client.rbac = self.rbac
+
+        self.prom = mock.Mock()
+        self.prom.label_values = mock.AsyncMock(return_value=['metric1'])
+        self.prom.query = mock.AsyncMock(return_value=[])
+        self.prom.query_range = mock.AsyncMock(return_value=[])
+        self.manager = async_python_api.AsyncQueryManager(self.client,
+                                                          self.prom)
+
+    def test_list(self):
+        ret1 = asyncio.run(self.manager.list())
+        ret2 = asyncio.run(self.manager.list())
+
+        self.assertEqual(['metric1'], ret1)
+        self.assertEqual(['metric1'], ret2)
+        self.prom.label_values.assert_called_once_with(
+            "__name__", matches="{project='project_id'}")
+
+    def test_query(self):
+        asyncio.run(self.manager.query("sum(metric1)"))
+        self.prom.query.assert_called_with(
+            "sum(metric1{project='project_id'})", time=None)
+
+        asyncio.run(self.manager.query("sum(metric1)", disable_rbac=True,
+                                       time=1234.5))
+        self.prom.query.assert_called_with("sum(metric1)", time=1234.5)
+
+    def test_query_many(self):
+        error = ValueError("bad query")
+
+        async def query(q):
+            if q.startswith("bad"):
+                raise error
+            return [q]
+
+        self.prom.query = mock.AsyncMock(side_effect=query)
+        ret = asyncio.run(self.manager.query_many(["metric1",
+                                                   "bad(metric1)",
+                                                   "sum(metric1)"],
+                                                  max_concurrency=2))
+
+        self.prom.label_values.assert_called_once()
+        self.assertEqual([["metric1{project='project_id'}"],
+                          None,
+                          ["sum(metric1{project='project_id'})"]],
+                         [r.result for r in ret])
+        self.assertEqual([None, error, None], [r.error for r in ret])
+
+    def test_query_range(self):
+        asyncio.run(self.manager.query_range("metric1", 0, 10, 1))
+        self.prom.query_range.assert_called_with(
+            "metric1{project='project_id'}", 0, 10, 1)
+
+    def test_show(self):
+        asyncio.run(self.manager.show("metric1"))
+        self.prom.query.assert_called_with(
+            "last_over_time(metric1{project='project_id'}[5m])", time=None)
+
+        asyncio.run(self.manager.show("metric1", time=1234.5))
+        self.prom.query.assert_called_with(
+            "last_over_time(metric1{project='project_id'}[5m])", time=1234.5)
+
+    def test_admin_api(self):
+        self.prom.delete = mock.AsyncMock()
+        self.prom.clean_tombstones = mock.AsyncMock()
+        self.prom.snapshot = mock.AsyncMock(return_value="name")
+
+        asyncio.run(self.manager.delete(["metric1"], 0, 10))
+        asyncio.run(self.manager.clean_tombstones())
+        ret = asyncio.run(self.manager.snapshot())
+
+        self.prom.delete.assert_called_with(["metric1"], 0, 10)
+        self.prom.clean_tombstones.assert_called_once()
+        self.assertEqual("name", ret)
+
+    def test_query_optimized(self):
+        optimizer = query_optimizer.QueryOptimizer(mock.Mock(), max_series=15)
+        optimizer.estimate = mock.Mock(return_value=10)
+        self.client.query_optimizer = optimizer
+
+        asyncio.run(self.manager.query("m{b='1', a='2'}",
+                                       disable_rbac=True))
+        self.prom.query.assert_called_once_with('m{a="2", b="1"}', time=None)
+
+        ret = asyncio.run(self.manager.query_many(["m / m"],
+                                                  disable_rbac=True))
+        self.assertIsInstance(ret[0].error, query_optimizer.QueryBudgetError)
+        self.prom.query.assert_called_once()
@@ -0,0 +1,125 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import testtools
+
+from observabilityclient.utils import cache
+
+
+class FakeTimer(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class TTLCacheTest(testtools.TestCase):
+    def setUp(self):
+        super(TTLCacheTest, self).setUp()
+        self.timer = FakeTimer()
+        self.cache = cache.TTLCache(maxsize=2, ttl=10, timer=self.timer)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.put('key', 'value')
+        self.assertEqual('value', self.cache.get('key'))
+        self.assertEqual('default', self.cache.get('other', 'default'))
+
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+        self.assertEqual(1, stats['size'])
+
+    def test_expiration(self):
+        self.cache.put('key', 'value')
+        self.timer.now = 9
+        self.assertEqual('value', self.cache.get('key'))
+        self.timer.now = 10
+        self.assertIsNone(self.cache.get('key'))
+        self.assertEqual(0, len(self.cache))
+
+    def test_lru_eviction(self):
+        self.cache.put('key1', 'value1')
+        self.cache.put('key2', 'value2')
+        # key1 becomes the most recently used entry
+        self.cache.get('key1')
+        self.cache.put('key3', 'value3')
+
+        self.assertIn('key1', self.cache)
+        self.assertNotIn('key2', self.cache)
+        self.assertIn('key3', self.cache)
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_invalidate(self):
+        self.cache.put('key1', 'value1')
+        self.cache.put('key2', 'value2')
+        self.cache.invalidate('key1')
+        self.assertNotIn('key1', self.cache)
+        self.assertIn('key2', self.cache)
+
+        self.cache.invalidate()
+        self.assertEqual(0, len(self.cache))
+
+    def test_on_remove(self):
+        removed = []
+        c = cache.TTLCache(maxsize=2, ttl=10, timer=self.timer,
+                           on_remove=lambda key, value:
+                           removed.append((key, value)))
+        c.put('key1', 'value1')
+        c.put('key2', 'value2')
+        c.put('key3', 'value3')
+        self.assertEqual([('key1', 'value1')], removed)
+
+        self.timer.now = 10
+        self.assertIsNone(c.get('key2'))
+        self.assertEqual(('key2', 'value2'), removed[-1])
+
+        c.invalidate()
+        self.assertEqual(('key3', 'value3'), removed[-1])
+        self.assertEqual(3, len(removed))
+
+    def test_invalid_maxsize(self):
+        self.assertRaises(ValueError, cache.TTLCache, maxsize=0)
+
+    def test_max_bytes(self):
+        c = cache.TTLCache(maxsize=10, max_bytes=10, weigher=len)
+        c.put('key1', 'aaaa')
+        c.put('key2', 'bbbb')
+        c.put('key3', 'cccc')
+
+        self.assertNotIn('key1', c)
+        self.assertIn('key2', c)
+        self.assertIn('key3', c)
+        self.assertEqual(8, c.stats()['bytes'])
+
+        # Values over the budget aren't stored at all
+        c.put('key2', 'x' * 11)
+        self.assertNotIn('key2', c)
+        self.assertIn('key3', c)
+        self.assertEqual(4, c.stats()['bytes'])
+
+        c.invalidate()
+        self.assertEqual(0, c.stats()['bytes'])
+
+
+class QueryCacheTest(testtools.TestCase):
+    def test_eval_time(self):
+        c = cache.QueryCache(align=15, clock=lambda: 1000.5)
+        self.assertEqual(990, c.eval_time())
+        self.assertEqual(60, c.eval_time(74.9))
+
+        c = cache.QueryCache()
+        self.assertIsNone(c.eval_time())
+        self.assertEqual(74.9, c.eval_time(74.9))
@@ -0,0 +1,55 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import os
+import tempfile
+
+import testtools
+
+from observabilityclient.utils.checkpoint import Checkpoint
+
+
+class CheckpointTest(testtools.TestCase):
+    def setUp(self):
+        super(CheckpointTest, self).setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.path = os.path.join(tmp.name, "checkpoint.json")
+
+    def test_resume(self):
+        checkpoint = Checkpoint(self.path, ['a', 1])
+        self.assertEqual(set(), checkpoint.load())
+        checkpoint.add(3)
+        checkpoint.add(1)
+
+        self.assertEqual({1, 3}, Checkpoint(self.path, ['a', 1]).load())
+        self.assertEqual([], [name for name in os.listdir(
+            os.path.dirname(self.path)) if name.endswith(".tmp")])
+
+    def test_different_key(self):
+        Checkpoint(self.path, ['a', 1]).add(3)
+        self.assertEqual(set(), Checkpoint(self.path, ['a', 2]).load())
+
+    def test_invalid_file(self):
+        with open(self.path, 'w') as f:
+            f.write("{not json")
+        self.assertEqual(set(), Checkpoint(self.path, 'key').load())
+
+    def test_remove(self):
+        checkpoint = Checkpoint(self.path, 'key')
+        checkpoint.add(1)
+        checkpoint.remove()
+        checkpoint.remove()
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(set(), Checkpoint(self.path, 'key').load())
@@ -14,11 +14,15 @@
 
 from unittest import mock
 
+from osc_lib import exceptions
 import testtools
 
 from observabilityclient.prometheus_client import PrometheusMetric
+from observabilityclient.prometheus_client import RangeResult
+from observabilityclient.prometheus_client import RangeSeries
 from observabilityclient.utils import metric_utils
 from observabilityclient.v1 import cli
+from observabilityclient.v1 import python_api
 
 
 class CliTest(testtools.TestCase):
@@ -49,8 +53,10 @@ class CliTest(testtools.TestCase):
         self.assertEqual(ret2, expected)
 
     def test_show(self):
-        args_enabled = {'name': 'metric_name', 'disable_rbac': False}
-        args_disabled = {'name': 'metric_name', 'disable_rbac': True}
+        args_enabled = {'name': 'metric_name', 'disable_rbac': False,
+                        'stream': False}
+        args_disabled = {'name': 'metric_name', 'disable_rbac': True,
+                         'stream': False}
 
         metric = {
             'value': [123456, 12],
@@ -78,8 +84,10 @@ class CliTest(testtools.TestCase):
     def test_query(self):
         query = ("some_query{label!~'not_this_value'} - "
                  "sum(second_metric{label='this'})")
-        args_enabled = {'query': query, 'disable_rbac': False}
-        args_disabled = {'query': query, 'disable_rbac': True}
+        args_enabled = {'query': query, 'disable_rbac': False,
+                        'range': False, 'stream': False}
+        args_disabled = {'query': query, 'disable_rbac': True,
+                         'range': False, 'stream': False}
 
         metric = {
             'value': [123456, 12],
@@ -105,9 +113,127 @@ class CliTest(testtools.TestCase):
         self.assertEqual(ret1, expected)
         self.assertEqual(ret2, expected)
 
+    def test_query_matrix(self):
+        args = {'query': 'up[5m]', 'disable_rbac': False, 'range': False,
+                'stream': False}
+        result = RangeResult([
+            {'metric': {'job': 'a'}, 'values': [[1, '2']]},
+            {'metric': {'instance': 'x', 'job': 'b'}, 'values': [[1, '3']]},
+        ])
+
+        cli_query = cli.Query(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'query',
+                                return_value=result)):
+            ret = cli_query.take_action(args)
+
+        self.assertEqual((['job', 'instance', 'timestamp', 'value'],
+                          [['a', '', 1.0, 2.0], ['b', 'x', 1.0, 3.0]]), ret)
+
+    def test_query_range(self):
+        query = "rate(some_query[5m])"
+        args = {'query': query, 'disable_rbac': False, 'range': True,
+                'start': '0', 'end': '60', 'step': '30s', 'stream': False}
+
+        result = RangeResult([{
+            'metric': {'label1': 'value1'},
+            'values': [[0, '1'], [30, '2'], [60, '3']]
+        }])
+        expected = (['label1', 'timestamp', 'value'],
+                    [['value1', 0.0, 1.0],
+                     ['value1', 30.0, 2.0],
+                     ['value1', 60.0, 3.0]])
+
+        cli_query = cli.Query(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'query_range',
+                                return_value=result) as m):
+            ret = cli_query.take_action(args)
+            m.assert_called_with(query, '0', '60', '30s', disable_rbac=False)
+
+        self.assertEqual(expected, ret)
+
+    def test_query_range_missing_arguments(self):
+        args = {'query': "some_query", 'disable_rbac': False, 'range': True,
+                'start': '0', 'end': None, 'step': '30s', 'stream': False}
+
+        cli_query = cli.Query(mock.Mock(), mock.Mock())
+
+        with mock.patch.object(metric_utils, 'get_client',
+                               return_value=self.client):
+            self.assertRaises(exceptions.CommandError,
+                              cli_query.take_action, args)
+
+            args.update(end='60', stream=True)
+            self.assertRaises(exceptions.CommandError,
+                              cli_query.take_action, args)
+
+    def test_query_stream(self):
+        query = "some_query"
+        args = {'query': query, 'disable_rbac': False, 'range': False,
+                'stream': True}
+        metrics = iter([
+            PrometheusMetric({'value': [1, '1'], 'metric': {'a': 'x'}}),
+            PrometheusMetric({'value': [1, '2'], 'metric': {'a': 'y'}}),
+        ])
+
+        cli_query = cli.Query(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'query_iter',
+                                return_value=metrics) as m):
+            columns, rows = cli_query.take_action(args)
+            m.assert_called_with(query, disable_rbac=False)
+
+        self.assertEqual(['a', 'value'], columns)
+        self.assertEqual([['x', '1'], ['y', '2']], list(rows))
+
+    def test_query_stream_matrix(self):
+        args = {'query': 'up[5m]', 'disable_rbac': False, 'range': False,
+                'stream': True}
+        series = RangeSeries({'a': 'x'})
+        series.extend([[1, '1'], [2, '2']])
+
+        cli_query = cli.Query(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'query_iter',
+                                return_value=iter([series]))):
+            columns, rows = cli_query.take_action(args)
+
+        self.assertEqual(['a', 'timestamp', 'value'], columns)
+        self.assertEqual([['x', 1.0, 1.0], ['x', 2.0, 2.0]], list(rows))
+
+    def test_show_stream(self):
+        args = {'name': 'metric_name', 'disable_rbac': True, 'stream': True}
+        metrics = iter([
+            PrometheusMetric({'value': [1, '1'], 'metric': {'a': 'x'}}),
+        ])
+
+        cli_show = cli.Show(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'show_iter',
+                                return_value=metrics) as m):
+            columns, rows = cli_show.take_action(args)
+            m.assert_called_with('metric_name', disable_rbac=True)
+
+        self.assertEqual(['a', 'value'], columns)
+        self.assertEqual([['x', '1']], list(rows))
+
     def test_delete(self):
-        matches = "some_label_name"
-        args = {'matches': matches, 'start': 0, 'end': 10}
+        args = {'matches': [['some_label_name', 'other'], ['third']],
+                'start': 0, 'end': 10,
+                'batch_size': 100, 'parallel': 4, 'time_chunk': None,
+                'checkpoint': None, 'dry_run': False, 'count_only': False,
+                'scrape_interval': None}
 
         cli_delete = cli.Delete(mock.Mock(), mock.Mock())
 
@@ -116,7 +242,135 @@ class CliTest(testtools.TestCase):
               mock.patch.object(self.client.query, 'delete') as m):
 
             cli_delete.take_action(args)
-            m.assert_called_with(matches, 0, 10)
+            m.assert_called_with(['some_label_name', 'other', 'third'],
+                                 0, 10)
+        self.client.query.bulk_delete.assert_not_called()
+
+    def test_delete_defaults(self):
+        cli_delete = cli.Delete(mock.Mock(), mock.Mock())
+        parser = cli_delete.get_parser('delete')
+
+        args = vars(parser.parse_args(['a', 'b']))
+
+        self.assertEqual([['a', 'b']], args['matches'])
+        self.assertEqual(100, args['batch_size'])
+        self.assertEqual(4, args['parallel'])
+
+    def test_delete_invalid_batches(self):
+        cli_delete = cli.Delete(mock.Mock(), mock.Mock())
+        for option in ('batch_size', 'parallel'):
+            for value in (0, -1):
+                args = {'matches': [['a']], 'start': None, 'end': None,
+                        'batch_size': 100, 'parallel': 4,
+                        'time_chunk': None, 'checkpoint': None,
+                        'dry_run': False, 'count_only': False,
+                        'scrape_interval': None, option: value}
+                with mock.patch.object(metric_utils, 'get_client',
+                                       return_value=self.client):
+                    self.assertRaises(exceptions.CommandError,
+                                      cli_delete.take_action, args)
+        self.client.query.delete.assert_not_called()
+        self.client.query.bulk_delete.assert_not_called()
+
+    def test_delete_bulk(self):
+        args = {'matches': [['a', 'b'], ['c']], 'start': 0, 'end': 10,
+                'batch_size': 2, 'parallel': 4, 'time_chunk': None,
+                'checkpoint': None, 'dry_run': False,
+                'count_only': False, 'scrape_interval': None}
+        results = [python_api.DeleteResult(['a', 'b'], 0, 10, None),
+                   python_api.DeleteResult(['c'], 0, 10, None)]
+
+        cli_delete = cli.Delete(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'bulk_delete',
+                                return_value=results) as m):
+            cli_delete.take_action(args)
+
+        m.assert_called_once_with(['a', 'b', 'c'], 0, 10, batch_size=2,
+                                  parallel=4, time_chunk=None,
+                                  checkpoint=None, progress=mock.ANY)
+
+    def test_delete_bulk_errors(self):
+        args = {'matches': [['a', 'b']], 'start': None, 'end': None,
+                'batch_size': 1, 'parallel': 2, 'time_chunk': None,
+                'checkpoint': None, 'dry_run': False, 'count_only': False,
+                'scrape_interval': None}
+        results = [python_api.DeleteResult(['a'], None, None, None),
+                   python_api.DeleteResult(['b'], None, None,
+                                           Exception("timeout"))]
+
+        cli_delete = cli.Delete(mock.Mock(), mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'bulk_delete',
+                                return_value=results)):
+            self.assertRaises(exceptions.CommandError,
+                              cli_delete.take_action, args)
+
+            args['time_chunk'] = '1h'
+            self.assertRaises(exceptions.CommandError,
+                              cli_delete.take_action, args)
+
+    def test_delete_invalid_options(self):
+        cli_delete = cli.Delete(mock.Mock(), mock.Mock())
+        test_cases = [
+            {'count_only': True},
+            {'scrape_interval': '5s'},
+            {'dry_run': True, 'batch_size': 10},
+            {'dry_run': True, 'parallel': 8},
+            {'dry_run': True, 'time_chunk': '1h'},
+            {'dry_run': True, 'checkpoint': 'delete.json'},
+        ]
+        for options in test_cases:
+            args = {'matches': [['a']], 'start': 0, 'end': 10,
+                    'batch_size': 100, 'parallel': 4, 'time_chunk': None,
+                    'checkpoint': None, 'dry_run': False,
+                    'count_only': False, 'scrape_interval': None}
+            args.update(options)
+            with mock.patch.object(metric_utils, 'get_client',
+                                   return_value=self.client):
+                self.assertRaises(exceptions.CommandError,
+                                  cli_delete.take_action, args)
+        self.client.query.delete.assert_not_called()
+        self.client.query.bulk_delete.assert_not_called()
+
+    def test_delete_dry_run(self):
+        args = {'matches': [['a', 'b']], 'start': 0, 'end': 10,
+                'batch_size': 100, 'parallel': 4, 'time_chunk': None,
+                'checkpoint': None, 'dry_run': True, 'count_only': True,
+                'scrape_interval': '5s'}
+        estimates = [python_api.DeleteEstimate('a', 3, 6),
+                     python_api.DeleteEstimate('b', 1, 2)]
+        app = mock.Mock()
+        cli_delete = cli.Delete(app, mock.Mock())
+
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'delete',
+                                return_value=estimates) as m):
+            cli_delete.take_action(args)
+
+        m.assert_called_once_with(['a', 'b'], 0, 10, dry_run=True,
+                                  count_only=True, scrape_interval='5s')
+        self.client.query.bulk_delete.assert_not_called()
+        self.assertEqual([mock.call("a: 3 series, ~6 samples\n"),
+                          mock.call("b: 1 series, ~2 samples\n"),
+                          mock.call("Total: 4 series, ~8 samples\n")],
+                         app.stdout.write.call_args_list)
+
+        app.stdout.write.reset_mock()
+        estimates = [python_api.DeleteEstimate('a', 3, None)]
+        with (mock.patch.object(metric_utils, 'get_client',
+                                return_value=self.client),
+              mock.patch.object(self.client.query, 'delete',
+                                return_value=estimates)):
+            cli_delete.take_action(args)
+        self.assertEqual([mock.call("a: 3 series, unknown samples\n"),
+                          mock.call("Total: 3 series, unknown samples\n")],
+                         app.stdout.write.call_args_list)
 
     def test_clean_combstones(self):
         cli_clean_tombstones = cli.CleanTombstones(mock.Mock(), mock.Mock())
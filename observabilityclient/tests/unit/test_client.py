@@ -0,0 +1,37 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+from unittest import mock
+
+import testtools
+
+from observabilityclient.v1 import client
+
+
+class ClientTest(testtools.TestCase):
+    def test_options_not_changed(self):
+        metric_name_cache_options = {'ttl': 10}
+        query_cache_options = {'ttl': 30}
+
+        with (mock.patch.object(client, 'get_prometheus_client'),
+              mock.patch.object(client, 'rbac')):
+            c = client.Client(
+                mock.Mock(),
+                metric_name_cache_options=metric_name_cache_options,
+                query_cache_options=query_cache_options)
+
+        self.assertEqual({'ttl': 10}, metric_name_cache_options)
+        self.assertEqual({'ttl': 30}, query_cache_options)
+        self.assertEqual(10, c.metric_name_cache.ttl)
+        self.assertEqual(30, c.query_cache.ttl)
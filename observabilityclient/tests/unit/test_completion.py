@@ -0,0 +1,84 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import io
+import os
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+import testtools
+
+from observabilityclient.utils import completion
+from observabilityclient.utils import metric_utils
+
+
+class CompletionTest(testtools.TestCase):
+    def test_main(self):
+        stdout = io.StringIO()
+        with (mock.patch.object(metric_utils, 'complete_metric_names',
+                                return_value=["sum(up", "sum(upper"]) as m,
+              mock.patch('sys.stdout', stdout)):
+            self.assertEqual(0, completion.main(['--', 'sum(up']))
+
+        m.assert_called_once_with('sum(up')
+        self.assertEqual("sum(up\nsum(upper\n", stdout.getvalue())
+
+    def test_main_bash(self):
+        stdout = io.StringIO()
+        with mock.patch('sys.stdout', stdout):
+            self.assertEqual(0, completion.main(['--bash']))
+        script = stdout.getvalue()
+        self.assertIn("complete -F _observabilityclient_openstack openstack",
+                      script)
+        self.assertIn("observabilityclient-complete --", script)
+
+    def test_bash_completion(self):
+        # Run the completion function in bash with a fake
+        # observabilityclient-complete on the PATH.
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        fake = os.path.join(tmp.name, "observabilityclient-complete")
+        with open(fake, 'w') as f:
+            f.write('#!/bin/sh\necho "$2"_cpu\necho "$2"_load1\n')
+        os.chmod(fake, 0o755)
+        script = completion.BASH_COMPLETION + """
+_openstack() { COMPREPLY=( fallback ); }
+COMP_WORDS=( openstack metric show node )
+COMP_CWORD=3
+_observabilityclient_openstack
+echo "${COMPREPLY[@]}"
+COMP_WORDS=( openstack metric list )
+COMP_CWORD=2
+_observabilityclient_openstack
+echo "${COMPREPLY[@]}"
+"""
+        env = dict(os.environ, PATH=tmp.name + os.pathsep + os.environ['PATH'])
+        try:
+            out = subprocess.run(['bash', '-c', script], env=env, check=True,
+                                 capture_output=True, text=True).stdout
+        except FileNotFoundError:
+            self.skipTest("bash isn't available")
+        self.assertEqual("node_cpu node_load1\nfallback\n", out)
+
+    def test_entry_point_imports(self):
+        # The completion must not load the openstack client
+        code = ("import sys; from observabilityclient.utils import "
+                "completion; print(sorted(m for m in sys.modules "
+                "if m.split('.')[0] in ('osc_lib', 'cliff', 'keystoneauth1',"
+                " 'requests')))")
+        out = subprocess.run([sys.executable, '-c', code], check=True,
+                             capture_output=True, text=True).stdout
+        self.assertEqual("[]\n", out)
@@ -0,0 +1,98 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import os
+import tempfile
+from unittest import mock
+
+import testtools
+
+from observabilityclient.utils import disk_cache
+
+
+class DiskCacheTest(testtools.TestCase):
+    def setUp(self):
+        super(DiskCacheTest, self).setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.directory = os.path.join(tmp.name, "observabilityclient")
+        self.now = 1000
+        self.cache = disk_cache.DiskCache(self.directory, ttl=60,
+                                          clock=lambda: self.now)
+
+    def test_store_load(self):
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+        self.cache.store("__name__", "host:9090", None, ["a", "b"])
+        self.cache.store("__name__", "host:9090", "{project='p'}", ["a"])
+
+        self.assertEqual(["a", "b"],
+                         self.cache.load("__name__", "host:9090"))
+        self.assertEqual(["a"], self.cache.load("__name__", "host:9090",
+                                                "{project='p'}"))
+        self.assertIsNone(self.cache.load("__name__", "other:9090"))
+        self.assertIsNone(self.cache.load("job", "host:9090"))
+        # Only the entries are left in the directory
+        self.assertEqual(2, len(os.listdir(self.directory)))
+
+    def test_expiration(self):
+        self.cache.store("__name__", "host:9090", None, ["a"])
+        self.now = 1059
+        self.assertEqual(["a"], self.cache.load("__name__", "host:9090"))
+        self.now = 1060
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+
+    def test_invalid_file(self):
+        self.cache.store("__name__", "host:9090", None, ["a", "b"])
+        path = self.cache._path("__name__", "host:9090", None)
+        with open(path) as f:
+            header = f.readline()
+        with open(path, "w") as f:
+            f.write(header + '["a"]\n')
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+
+        with open(path, "w") as f:
+            f.write("garbage")
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+
+    def test_load_all(self):
+        self.assertEqual([], self.cache.load_all("__name__", "host:9090"))
+        self.cache.store("__name__", "host:9090", None, ["a", "b"])
+        self.cache.store("__name__", "host:9090", "{project='p'}", ["c"])
+        self.cache.store("__name__", "other:9090", None, ["d"])
+        self.cache.store("job", "host:9090", None, ["e"])
+
+        self.assertEqual(["a", "b", "c"],
+                         sorted(self.cache.load_all("__name__",
+                                                    "host:9090")))
+
+    def test_invalidate(self):
+        self.cache.store("__name__", "host:9090", None, ["a"])
+        self.cache.invalidate("__name__", "host:9090")
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+        self.cache.invalidate("__name__", "host:9090")
+
+    def test_store_error(self):
+        with mock.patch.object(disk_cache.os, 'makedirs',
+                               side_effect=PermissionError):
+            self.cache.store("__name__", "host:9090", None, ["a"])
+        self.assertIsNone(self.cache.load("__name__", "host:9090"))
+
+    def test_default_cache_dir(self):
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "/xdg"}):
+            self.assertEqual("/xdg/observabilityclient",
+                             disk_cache.default_cache_dir())
+        with mock.patch.dict(os.environ, {"XDG_CACHE_HOME": "",
+                                          "HOME": "/home/user"}):
+            self.assertEqual("/home/user/.cache/observabilityclient",
+                             disk_cache.default_cache_dir())
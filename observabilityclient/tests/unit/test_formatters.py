@@ -0,0 +1,41 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import io
+import json
+
+import testtools
+
+from observabilityclient.utils import formatters
+
+
+class NDJSONFormatterTest(testtools.TestCase):
+    def test_emit_list(self):
+        stdout = io.StringIO()
+        written = []
+
+        def rows():
+            yield ["x", "1"]
+            # The first row is written before the next one is produced
+            written.append(stdout.getvalue())
+            yield ["y", "2"]
+
+        formatters.NDJSONFormatter().emit_list(["a", "value"], rows(),
+                                               stdout, None)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual([{"a": "x", "value": "1"},
+                          {"a": "y", "value": "2"}],
+                         [json.loads(line) for line in lines])
+        self.assertEqual(lines[0] + "\n", written[0])
@@ -0,0 +1,72 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import os
+import subprocess
+import sys
+
+import testtools
+
+
+# Modules, which must be imported only once a metric command runs
+DEFERRED_MODULES = frozenset([
+    'yaml', 'requests', 'urllib3', 'numpy', 'aiohttp', 'keystoneauth1',
+    'osc_lib.utils', 'observabilityclient.prometheus_client',
+    'observabilityclient.v1.client', 'observabilityclient.v1.rbac',
+])
+
+
+def import_times(statement, env=None):
+    """Run statement in a new interpreter with -X importtime.
+
+    :returns: dict of the imported modules and their cumulative
+              import time in microseconds
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                           statement],
+                          capture_output=True, text=True, env=env,
+                          check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if not fields[1].strip().isdigit():
+            # The header line
+            continue
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+
+class ImportTimeTest(testtools.TestCase):
+    def _assert_deferred(self, statement, env=None):
+        times = import_times(statement, env)
+        self.assertEqual(set(), DEFERRED_MODULES & set(times))
+        return times
+
+    def test_plugin(self):
+        times = self._assert_deferred('import observabilityclient.plugin')
+        self.assertIn('observabilityclient.plugin', times)
+
+    def test_commands(self):
+        self._assert_deferred('import observabilityclient.v1.cli')
+
+    def test_no_home(self):
+        env = {k: v for k, v in os.environ.items() if k != 'HOME'}
+        self._assert_deferred('import observabilityclient.v1.cli', env)
+
+    def test_prometheus_client(self):
+        # numpy is loaded only by the views of results
+        times = import_times('import observabilityclient.prometheus_client')
+        self.assertNotIn('numpy', times)
@@ -12,6 +12,9 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+from array import array
+import json
+import math
 from unittest import mock
 
 import requests
@@ -118,6 +121,34 @@ class PrometheusAPIClientTest(PrometheusAPIClientTestBase):
             self.assertRaises(client.PrometheusAPIClientError,
                               c._get, url, params)
 
+    def test_get_long_params(self):
+        url = "query"
+        expected_url = "http://localhost:9090/api/v1/query"
+        params = {"query": "sum(" + " + ".join(["metric"] * 20) + ")"}
+
+        return_value = self.GoodResponse()
+        with (mock.patch.object(requests.Session, 'get',
+                                return_value=return_value) as get,
+              mock.patch.object(requests.Session, 'post',
+                                return_value=return_value) as post):
+            c = client.PrometheusAPIClient("localhost:9090",
+                                           post_threshold=100)
+            c._get(url, params)
+
+            post.assert_called_with(expected_url,
+                                    data=params,
+                                    headers={'Accept': 'application/json'})
+            get.assert_not_called()
+
+            # Only the read endpoints are allowed to switch to POST
+            c._get("label/__name__/values", params)
+            get.assert_called_once()
+
+            # Short requests stay GET
+            c._get(url, {"query": "metric"})
+            self.assertEqual(2, get.call_count)
+            self.assertEqual(1, post.call_count)
+
     def test_post(self):
         url = "test"
         expected_url = "http://localhost:9090/api/v1/test"
@@ -154,6 +185,130 @@ class PrometheusAPIClientTest(PrometheusAPIClientTestBase):
                               c._post, url, params)
 
 
+class PrometheusMetricTest(testtools.TestCase):
+    def test_metric(self):
+        metric = client.PrometheusMetric({
+            "metric": {"__name__": "up", "job": "prometheus"},
+            "value": [103254, "1"]
+        })
+
+        self.assertEqual(103254, metric.timestamp)
+        self.assertEqual("1", metric.value)
+        self.assertEqual({"__name__": "up", "job": "prometheus"},
+                         metric.labels)
+        self.assertFalse(hasattr(metric, '__dict__'))
+
+        metric.labels = {"job": "node"}
+        self.assertEqual({"job": "node"}, metric.labels)
+
+    def test_shared_schema(self):
+        schemas = {}
+        # The values are built at runtime to not be interned already
+        metrics = [client.PrometheusMetric({
+            "metric": {"__name__": "up", "job": "".join(["no", "de"])},
+            "value": [103254, str(i)]
+        }, schemas) for i in range(3)]
+        other = client.PrometheusMetric({
+            "metric": {"job": "node"},
+            "value": [103254, "1"]
+        }, schemas)
+
+        self.assertEqual(2, len(schemas))
+        self.assertIs(metrics[0].label_keys, metrics[1].label_keys)
+        self.assertIs(metrics[0].label_keys, metrics[2].label_keys)
+        self.assertIsNot(metrics[0].label_keys, other.label_keys)
+        self.assertIs(metrics[0].label_values[1], metrics[2].label_values[1])
+
+
+class VectorViewTest(testtools.TestCase):
+    def setUp(self):
+        super(VectorViewTest, self).setUp()
+        self.metrics = [client.PrometheusMetric({
+            "metric": {"instance": str(i)},
+            "value": [1000 + i, value]
+        }) for i, value in enumerate(["1.5", "NaN", "+Inf", "-Inf", "2"])]
+
+    def _check_view(self, view):
+        self.assertEqual(5, len(view))
+        self.assertEqual([1000, 1001, 1002, 1003, 1004],
+                         list(view.timestamps))
+        self.assertEqual(1.5, view.values[0])
+        self.assertTrue(math.isnan(view.values[1]))
+        self.assertEqual(math.inf, view.values[2])
+        self.assertEqual(-math.inf, view.values[3])
+        self.assertEqual({"instance": "4"}, view.labels(4))
+
+    @testtools.skipIf(client._import_numpy() is None,
+                      "numpy isn't installed")
+    def test_view_numpy(self):
+        numpy = client._import_numpy()
+        view = client.VectorView(self.metrics)
+
+        self.assertIsInstance(view.values, numpy.ndarray)
+        self.assertEqual(numpy.float64, view.values.dtype)
+        self._check_view(view)
+
+    def test_view_array(self):
+        with mock.patch.object(client, '_numpy', None):
+            view = client.VectorView(self.metrics)
+
+        self.assertIsInstance(view.values, array)
+        self._check_view(view)
+
+
+class PrometheusAPIClientTransportTest(testtools.TestCase):
+    def test_defaults(self):
+        c = client.PrometheusAPIClient("localhost:9090")
+        adapter = c._session.get_adapter("http://localhost:9090")
+
+        self.assertIsInstance(adapter, client.TimeoutHTTPAdapter)
+        self.assertIs(adapter, c._session.get_adapter("https://localhost"))
+        self.assertIsNone(adapter.timeout)
+        self.assertEqual(0, adapter.max_retries.total)
+        self.assertIn('gzip',
+                      c._session.headers['Accept-Encoding'].split(', '))
+        self.assertEqual('keep-alive', c._session.headers['Connection'])
+
+    def test_options(self):
+        c = client.PrometheusAPIClient("localhost:9090",
+                                       pool_connections=2,
+                                       pool_maxsize=50,
+                                       timeout=(1, 30),
+                                       retries=3,
+                                       backoff_factor=0.1,
+                                       compression=False,
+                                       keep_alive=False)
+        adapter = c._session.get_adapter("http://localhost:9090")
+
+        self.assertEqual(2, adapter._pool_connections)
+        self.assertEqual(50, adapter._pool_maxsize)
+        self.assertEqual((1, 30), adapter.timeout)
+        self.assertEqual(3, adapter.max_retries.total)
+        self.assertEqual(0.1, adapter.max_retries.backoff_factor)
+        self.assertEqual(frozenset(['GET']),
+                         adapter.max_retries.allowed_methods)
+        self.assertEqual('identity', c._session.headers['Accept-Encoding'])
+        self.assertEqual('close', c._session.headers['Connection'])
+
+    def test_default_timeout(self):
+        adapter = client.TimeoutHTTPAdapter(timeout=(1, 30))
+        with mock.patch.object(requests.adapters.HTTPAdapter,
+                               'send') as m:
+            adapter.send("request")
+            m.assert_called_with("request", timeout=(1, 30))
+
+            adapter.send("request", timeout=5)
+            m.assert_called_with("request", timeout=5)
+
+    def test_accept_encoding(self):
+        with mock.patch.object(client.urllib3.util.request,
+                               'ACCEPT_ENCODING', 'gzip,deflate,zstd'):
+            self.assertEqual('gzip, zstd', client.accept_encoding())
+        with mock.patch.object(client.urllib3.util.request,
+                               'ACCEPT_ENCODING', 'gzip,deflate'):
+            self.assertEqual('gzip', client.accept_encoding())
+
+
 class PrometheusAPIClientQueryTest(PrometheusAPIClientTestBase):
     def setUp(self):
         super().setUp()
@@ -210,6 +365,7 @@ class PrometheusAPIClientQueryTest(PrometheusAPIClientTestBase):
             ret = c.query(query)
 
             m.assert_called_with("query", {"query": query})
+            self.assertIs(ret[0].label_keys, ret[1].label_keys)
             self.assertThat(ret, matcher)
 
         return_value = self.EmptyQueryResponse().json()
@@ -220,6 +376,36 @@ class PrometheusAPIClientQueryTest(PrometheusAPIClientTestBase):
 
             self.assertEqual(self.EmptyQueryResponse().expected, ret)
 
+            c.query(query, time=1234.5)
+            m.assert_called_with("query", {"query": query, "time": 1234.5})
+
+    def test_query_scalar(self):
+        return_value = {
+            "status": "success",
+            "data": {"resultType": "scalar", "result": [103254, "2"]}
+        }
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               return_value=return_value):
+            c = client.PrometheusAPIClient("localhost:9090")
+            ret = c.query("1+1")
+
+        self.assertEqual(1, len(ret))
+        self.assertEqual({}, ret[0].labels)
+        self.assertEqual(103254, ret[0].timestamp)
+        self.assertEqual("2", ret[0].value)
+
+    def test_result_nbytes(self):
+        metrics = [client.PrometheusMetric({"metric": {"a": str(i)},
+                                            "value": [1, "1"]})
+                   for i in range(10)]
+        self.assertGreater(client.result_nbytes(metrics),
+                           client.result_nbytes(metrics[:5]))
+
+        matrix = client.RangeResult([{"metric": {"a": "1"},
+                                      "values": [[i, "1"]
+                                                 for i in range(100)]}])
+        self.assertGreater(client.result_nbytes(matrix), 1600)
+
     def test_query_error(self):
         query = "ceilometer_image_size{publisher='localhost.localdomain'}"
         client_exception = client.PrometheusAPIClientError(self.BadResponse())
@@ -231,6 +417,411 @@ class PrometheusAPIClientQueryTest(PrometheusAPIClientTestBase):
             self.assertRaises(client.PrometheusAPIClientError, c.query, query)
 
 
+class PrometheusAPIClientQueryRangeTest(PrometheusAPIClientTestBase):
+    def setUp(self):
+        super().setUp()
+
+    class GoodQueryRangeResponse(PrometheusAPIClientTestBase.GoodResponse):
+        def __init__(self):
+            super().__init__()
+            self.result = [{
+                "metric": {
+                    "__name__": "test1",
+                },
+                "values": [[100, "1"], [115, "NaN"], [130, "+Inf"]]
+            }, {
+                "metric": {
+                    "__name__": "test2",
+                },
+                "values": [[115, "2.5"]]
+            }]
+
+        def json(self):
+            return {
+                "status": "success",
+                "data": {
+                    "resultType": "matrix",
+                    "result": self.result
+                }
+            }
+
+    def test_query_range(self):
+        query = "rate(ceilometer_image_size[5m])"
+
+        return_value = self.GoodQueryRangeResponse().json()
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               return_value=return_value) as m:
+            c = client.PrometheusAPIClient("localhost:9090")
+            ret = c.query_range(query, 100, 130, "15s")
+
+            m.assert_called_with("query_range", {"query": query,
+                                                 "start": 100,
+                                                 "end": 130,
+                                                 "step": "15s"})
+
+        self.assertIsInstance(ret, client.RangeResult)
+        self.assertEqual(2, len(ret))
+        self.assertEqual({"__name__": "test1"}, ret[0].labels)
+        self.assertEqual(array('d', [100, 115, 130]), ret[0].timestamps)
+        self.assertEqual(1.0, ret[0].values[0])
+        self.assertTrue(math.isnan(ret[0].values[1]))
+        self.assertEqual(math.inf, ret[0].values[2])
+        self.assertEqual([(115.0, 2.5)], list(ret[1].samples()))
+
+    def test_query_matrix(self):
+        query = "ceilometer_image_size[5m]"
+
+        return_value = self.GoodQueryRangeResponse().json()
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               return_value=return_value):
+            c = client.PrometheusAPIClient("localhost:9090")
+            ret = c.query(query)
+
+        self.assertIsInstance(ret, client.RangeResult)
+        self.assertEqual(["test1", "test2"],
+                         [s.labels["__name__"] for s in ret])
+
+    def test_range_result_extend(self):
+        result = client.RangeResult([{"metric": {"a": "1"},
+                                      "values": [[1, "1"]]}])
+        result.extend([{"metric": {"a": "1"}, "values": [[2, "2"]]},
+                       {"metric": {"a": "2"}, "values": [[2, "3"]]}])
+
+        self.assertEqual(2, len(result))
+        self.assertEqual([(1.0, 1.0), (2.0, 2.0)], list(result[0].samples()))
+
+    def test_query_range_split(self):
+        query = "ceilometer_image_size"
+
+        def get(endpoint, params):
+            # Every window returns one sample more at its end, which
+            # must not end up duplicated in the merged result.
+            start = int(params["start"])
+            end = int(params["end"])
+            values = [[t, str(t)] for t in range(start, end + 11, 10)]
+            return {"data": {"resultType": "matrix",
+                             "result": [{"metric": {"a": "b"},
+                                         "values": values}]}}
+
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               side_effect=get) as m:
+            c = client.PrometheusAPIClient("localhost:9090",
+                                           max_range_points=4)
+            ret = c.query_range(query, 0, 100, "10s")
+
+        self.assertEqual(3, m.call_count)
+        m.assert_any_call("query_range", {"query": query, "start": 40,
+                                          "end": 70, "step": 10})
+        self.assertEqual(1, len(ret))
+        self.assertEqual(array('d', range(0, 111, 10)), ret[0].timestamps)
+        self.assertEqual(ret[0].timestamps, ret[0].values)
+
+    def test_query_range_split_interval(self):
+        query = "ceilometer_image_size"
+        return_value = self.GoodQueryRangeResponse().json()
+
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               return_value=return_value) as m:
+            c = client.PrometheusAPIClient("localhost:9090",
+                                           range_split_interval=3600)
+            c.query_range(query, "1970-01-01T00:30:00Z", 9000, "5m")
+
+        self.assertEqual([mock.call("query_range", {"query": query,
+                                                    "start": 1800.0,
+                                                    "end": 3300.0,
+                                                    "step": 300}),
+                          mock.call("query_range", {"query": query,
+                                                    "start": 3600.0,
+                                                    "end": 6900.0,
+                                                    "step": 300}),
+                          mock.call("query_range", {"query": query,
+                                                    "start": 7200.0,
+                                                    "end": 9000.0,
+                                                    "step": 300})],
+                         m.call_args_list)
+
+    @staticmethod
+    def _fake_query_range(endpoint, params):
+        # Every evaluation returns its own timestamp as the value
+        points = []
+        t = params["start"]
+        while t <= params["end"]:
+            points.append([t, str(t)])
+            t += params["step"]
+        return {"status": "success",
+                "data": {"resultType": "matrix",
+                         "result": [{"metric": {"__name__": "test1"},
+                                     "values": points}]}}
+
+    def test_query_range_cached(self):
+        query = "ceilometer_image_size"
+
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               side_effect=self._fake_query_range) as m:
+            c = client.PrometheusAPIClient("localhost:9090",
+                                           range_cache_size=4,
+                                           range_cache_freshness=60)
+            c._clock = lambda: 1000
+            ret = c.query_range(query, 0, 1000, 100)
+            self.assertEqual(list(range(0, 1001, 100)),
+                             list(ret[0].timestamps))
+
+            # The window slides, only the tail and the samples
+            # within the freshness window are fetched again
+            c._clock = lambda: 1300
+            ret = c.query_range(query, 300, 1300, 100)
+            self.assertEqual(list(range(300, 1301, 100)),
+                             list(ret[0].timestamps))
+            self.assertEqual(list(ret[0].timestamps), list(ret[0].values))
+            self.assertEqual(mock.call("query_range",
+                                       {"query": query, "start": 1000,
+                                        "end": 1300, "step": 100}),
+                             m.call_args)
+
+            # Fully cached ranges don't send any request
+            ret = c.query_range(query, 400, 1100, 100)
+            self.assertEqual(2, m.call_count)
+            self.assertEqual(list(range(400, 1101, 100)),
+                             list(ret[0].timestamps))
+
+            # The cache starts at the last start, a missing head
+            # is fetched as well
+            c.query_range(query, 100, 1100, 100)
+            self.assertEqual(mock.call("query_range",
+                                       {"query": query, "start": 100,
+                                        "end": 300, "step": 100}),
+                             m.call_args)
+
+            # A different alignment of start isn't served from the cache
+            c.query_range(query, 450, 1050, 100)
+            self.assertEqual(mock.call("query_range",
+                                       {"query": query, "start": 450,
+                                        "end": 1050, "step": 100}),
+                             m.call_args)
+
+            c.invalidate_range_cache()
+            c.query_range(query, 400, 1100, 100)
+            self.assertEqual(5, m.call_count)
+
+    def test_query_range_error(self):
+        query = "ceilometer_image_size"
+        client_exception = client.PrometheusAPIClientError(self.BadResponse())
+
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               side_effect=client_exception):
+            c = client.PrometheusAPIClient("localhost:9090")
+
+            self.assertRaises(client.PrometheusAPIClientError,
+                              c.query_range, query, 0, 10, 1)
+
+
+class RangeHelpersTest(testtools.TestCase):
+    def test_range_result_merge_slice(self):
+        first = client.RangeResult([
+            {"metric": {"a": "1"}, "values": [[1, "1"], [2, "2"]]}])
+        second = client.RangeResult([
+            {"metric": {"a": "1"}, "values": [[2, "2"], [3, "3"]]},
+            {"metric": {"a": "2"}, "values": [[3, "3"]]}])
+        first.merge(second)
+
+        self.assertEqual([1, 2, 3], list(first[0].timestamps))
+        self.assertEqual([3], list(first[1].timestamps))
+
+        sliced = first.slice(1.5, 2)
+        self.assertEqual(1, len(sliced))
+        self.assertEqual([2], list(sliced[0].values))
+        # Slices are copies
+        self.assertEqual(3, len(first[0]))
+
+    def test_to_timestamp(self):
+        self.assertEqual(12.5, client.to_timestamp(12.5))
+        self.assertEqual(12.5, client.to_timestamp("12.5"))
+        self.assertEqual(1672531200.0,
+                         client.to_timestamp("2023-01-01T00:00:00Z"))
+        self.assertEqual(1672531200.5,
+                         client.to_timestamp("2023-01-01T01:00:00.5+01:00"))
+
+    def test_to_seconds(self):
+        self.assertEqual(30, client.to_seconds(30))
+        self.assertEqual(30, client.to_seconds("30"))
+        self.assertEqual(30, client.to_seconds("30s"))
+        self.assertEqual(5400, client.to_seconds("1h30m"))
+        self.assertEqual(0.5, client.to_seconds("500ms"))
+        self.assertRaises(ValueError, client.to_seconds, "30x")
+        self.assertRaises(ValueError, client.to_seconds, "1h 30m")
+
+    def test_split_range(self):
+        self.assertEqual([(0, 30), (40, 70), (80, 100)],
+                         client.split_range(0, 100, 10, max_points=4))
+        self.assertEqual([(5, 25), (35, 55), (65, 85), (95, 95)],
+                         client.split_range(5, 100, 10, interval=30))
+        self.assertEqual([(0, 100)], client.split_range(0, 100, 10))
+
+    def test_split_range_limit(self):
+        windows = client.split_range(0, 30 * 24 * 3600, 30)
+        self.assertEqual(8, len(windows))
+        for start, end in windows:
+            self.assertLessEqual((end - start) / 30 + 1,
+                                 client.MAX_RANGE_POINTS)
+
+
+class StreamResponse(object):
+    def __init__(self, body, status_code=200, chunk_size=7):
+        self.status_code = status_code
+        self.reason = "OK"
+        self.body = body.encode('utf-8')
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def iter_content(self, chunk_size):
+        for i in range(0, len(self.body), self.chunk_size):
+            yield self.body[i:i + self.chunk_size]
+
+    def json(self):
+        return json.loads(self.body)
+
+    def close(self):
+        self.closed = True
+
+
+class PrometheusAPIClientStreamTest(PrometheusAPIClientTestBase):
+    def _stream(self, body, status_code=200):
+        resp = StreamResponse(body, status_code)
+        patcher = mock.patch.object(requests.Session, 'get',
+                                    return_value=resp)
+        self.get = patcher.start()
+        self.addCleanup(patcher.stop)
+        return resp
+
+    def test_query_iter(self):
+        result = [{"metric": {"__name__": "test1", "unicode": "ěščř"},
+                   "value": [103254, "1"]},
+                  {"metric": {"__name__": "test2", "text": "a], {b"},
+                   "value": [103255, "2"]}]
+        resp = self._stream(json.dumps({
+            "status": "success",
+            "data": {"resultType": "vector", "result": result},
+            "warnings": ["some warning"]
+        }))
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        ret = list(c.query_iter("test"))
+
+        self.get.assert_called_with("http://localhost:9090/api/v1/query",
+                                    params={"query": "test"},
+                                    headers={'Accept': 'application/json'},
+                                    stream=True)
+        self.assertEqual([r["metric"] for r in result],
+                         [m.labels for m in ret])
+        self.assertEqual(["1", "2"], [m.value for m in ret])
+        self.assertIs(ret[0].label_keys, ret[0].label_keys)
+        self.assertTrue(resp.closed)
+
+    def test_query_iter_matrix(self):
+        self._stream(json.dumps({
+            "status": "success",
+            "data": {"resultType": "matrix", "result": [
+                {"metric": {"a": "b"}, "values": [[1, "1"], [2, "2"]]}
+            ]}
+        }))
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        ret = list(c.query_iter("test[1m]"))
+
+        self.assertEqual(1, len(ret))
+        self.assertIsInstance(ret[0], client.RangeSeries)
+        self.assertEqual([(1.0, 1.0), (2.0, 2.0)], list(ret[0].samples()))
+
+    def test_query_iter_scalar(self):
+        self._stream(json.dumps({
+            "status": "success",
+            "data": {"resultType": "scalar", "result": [103254, "42"]}
+        }))
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        ret = list(c.query_iter("42"))
+
+        self.assertEqual(1, len(ret))
+        self.assertEqual({}, ret[0].labels)
+        self.assertEqual("42", ret[0].value)
+
+    def test_iter_json_array_chunk_boundaries(self):
+        # Numbers split between chunks, e.g. at "." or "e", must not
+        # be decoded before the rest of them arrives.
+        items = [1700000000.125, -2.5e-3, 10, 1E+2, 0.5, "1.5", 3]
+        body = ('{"status":"success","data":{"resultType":"vector",'
+                '"result":[ ' + ' , '.join(json.dumps(i) for i in items) +
+                ' ]}}')
+        for chunk_size in range(1, len(body) + 1):
+            resp = StreamResponse(body, chunk_size=chunk_size)
+            ret = list(client.iter_json_array(resp, client._RESULT_REGEX))
+            self.assertEqual(items, ret[1:], f"chunk size: {chunk_size}")
+
+    def test_query_iter_scalar_chunk_boundaries(self):
+        body = json.dumps({
+            "status": "success",
+            "data": {"resultType": "scalar", "result": [1.5, "42"]}
+        })
+        c = client.PrometheusAPIClient("localhost:9090")
+        for chunk_size in (1, 2, 4, 17, 34):
+            resp = StreamResponse(body, chunk_size=chunk_size)
+            with mock.patch.object(requests.Session, 'get',
+                                   return_value=resp):
+                ret = list(c.query_iter("42"))
+            self.assertEqual(1.5, ret[0].timestamp)
+            self.assertEqual("42", ret[0].value)
+
+    def test_query_iter_error(self):
+        resp = self._stream(json.dumps({"status": "error",
+                                        "error": "test_error"}), 400)
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        self.assertRaises(client.PrometheusAPIClientError,
+                          list, c.query_iter("test"))
+        self.assertTrue(resp.closed)
+
+        self._stream(json.dumps({"status": "error",
+                                 "error": "test_error"}))
+        exc = self.assertRaises(client.PrometheusAPIClientError,
+                                list, c.query_iter("test"))
+        self.assertEqual("[200] test_error", str(exc))
+
+    def test_query_iter_truncated(self):
+        resp = self._stream('{"status":"success","data":{"resultType":'
+                            '"vector","result":[{"metric":{},"value":[1,')
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        self.assertRaises(ValueError, list, c.query_iter("test"))
+        self.assertTrue(resp.closed)
+
+    def test_series_iter(self):
+        data = [{"__name__": "up", "job": "prometheus"},
+                {"__name__": "up", "job": "node"}]
+        self._stream(json.dumps({"status": "success", "data": data}))
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        ret = c.series_iter(["up"])
+
+        self.assertEqual(data[0], next(ret))
+        self.assertEqual(data[1], next(ret))
+        self.assertRaises(StopIteration, next, ret)
+        self.get.assert_called_with("http://localhost:9090/api/v1/series",
+                                    params={"match[]": ["up"]},
+                                    headers={'Accept': 'application/json'},
+                                    stream=True)
+
+    def test_series_iter_range(self):
+        self._stream(json.dumps({"status": "success", "data": []}))
+
+        c = client.PrometheusAPIClient("localhost:9090")
+        self.assertEqual([], list(c.series_iter(["up"], start=0, end=10)))
+        self.get.assert_called_with("http://localhost:9090/api/v1/series",
+                                    params={"match[]": ["up"], "start": 0,
+                                            "end": 10},
+                                    headers={'Accept': 'application/json'},
+                                    stream=True)
+
+
 class PrometheusAPIClientSeriesTest(PrometheusAPIClientTestBase):
     def setUp(self):
         super().setUp()
@@ -330,6 +921,23 @@ class PrometheusAPIClientLabelsTest(PrometheusAPIClientTestBase):
             m.assert_called_with("labels")
             self.assertEqual(ret, self.GoodLabelsResponse().labels)
 
+    def test_labels_long_matches(self):
+        matches = [f"metric_{i}{{project='p'}}" for i in range(20)]
+        return_value = self.GoodLabelsResponse()
+        with (mock.patch.object(requests.Session, 'get') as get,
+              mock.patch.object(requests.Session, 'post',
+                                return_value=return_value) as post):
+            c = client.PrometheusAPIClient("localhost:9090",
+                                           post_threshold=100)
+            ret = c.labels(matches, end=10)
+
+        get.assert_not_called()
+        post.assert_called_once_with(
+            "http://localhost:9090/api/v1/labels",
+            data={"match[]": matches, "end": 10},
+            headers={'Accept': 'application/json'})
+        self.assertEqual(self.GoodLabelsResponse().labels, ret)
+
     def test_labels_error(self):
         client_exception = client.PrometheusAPIClientError(self.BadResponse())
         with mock.patch.object(client.PrometheusAPIClient, '_get',
@@ -386,6 +994,25 @@ class PrometheusAPIClientLabelValuesTest(PrometheusAPIClientTestBase):
             m.assert_called_with(f"label/{label_name}/values")
             self.assertEqual(ret, self.EmptyLabelValuesResponse().values)
 
+    def test_label_values_with_selectors(self):
+        label_name = "__name__"
+        matches = ["{project='some_project'}"]
+        start = 1
+        end = 12
+
+        return_value = self.GoodLabelValuesResponse().json()
+        with mock.patch.object(client.PrometheusAPIClient, '_get',
+                               return_value=return_value) as m:
+            c = client.PrometheusAPIClient("localhost:9090")
+            ret = c.label_values(label_name, matches=matches,
+                                 start=start, end=end)
+
+            m.assert_called_with(f"label/{label_name}/values",
+                                 {"match[]": matches,
+                                  "start": start,
+                                  "end": end})
+            self.assertEqual(ret, self.GoodLabelValuesResponse().values)
+
     def test_label_values_error(self):
         label_name = "job"
         client_exception = client.PrometheusAPIClientError(self.BadResponse())
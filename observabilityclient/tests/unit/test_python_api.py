@@ -12,6 +12,8 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import os
+import tempfile
 from unittest import mock
 
 import testtools
@@ -20,7 +22,10 @@ from observabilityclient import prometheus_client
 from observabilityclient.tests.unit.test_prometheus_client import (
     MetricListMatcher
 )
+from observabilityclient.utils import cache
+from observabilityclient.utils import disk_cache
 from observabilityclient.v1 import python_api
+from observabilityclient.v1 import query_optimizer
 from observabilityclient.v1 import rbac
 
 
@@ -30,6 +35,10 @@ class QueryManagerTest(testtools.TestCase):
         self.client = mock.Mock()
         prom_client = prometheus_client.PrometheusAPIClient("somehost")
         self.client.prometheus_client = prom_client
+        self.client.metric_name_cache = cache.TTLCache(ttl=60)
+        self.client.query_cache = None
+        self.client.disk_cache = None
+        self.client.query_optimizer = None
 
         self.rbac = mock.Mock(wraps=rbac.Rbac(self.client, mock.Mock()))
         self.rbac.default_labels = {'project': 'project_id'}
@@ -52,18 +61,78 @@ class QueryManagerTest(testtools.TestCase):
         self.assertEqual(expected, ret1)
         self.assertEqual(expected, ret2)
 
+    def test_list_cached(self):
+        returned_by_prom = {'data': ['metric1', 'test42', 'abc2']}
+
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               return_value=returned_by_prom) as m:
+            self.manager.list(disable_rbac=True)
+            ret = self.manager.list(disable_rbac=True)
+            m.assert_called_once()
+
+            self.manager.invalidate_metric_names()
+            self.manager.list(disable_rbac=True)
+            self.assertEqual(2, m.call_count)
+
+        self.assertEqual(['abc2', 'metric1', 'test42'], ret)
+        stats = self.manager.metric_name_cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(2, stats['misses'])
+
+    def test_list_disk_cache(self):
+        returned_by_prom = {'data': ['metric1', 'test42', 'abc2']}
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.client.disk_cache = disk_cache.DiskCache(tmp.name)
+
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               return_value=returned_by_prom) as m:
+            self.manager.list(disable_rbac=True)
+            # A new process starts with an empty metric name cache
+            self.client.metric_name_cache.invalidate()
+            ret = self.manager.list(disable_rbac=True)
+            m.assert_called_once()
+
+            self.manager.invalidate_metric_names()
+            self.manager.list(disable_rbac=True)
+            self.assertEqual(2, m.call_count)
+
+            self.assertEqual(['abc2', 'metric1', 'test42'],
+                             self.manager.label_values('__name__',
+                                                       disable_rbac=True))
+            self.assertEqual(2, m.call_count)
+
+        self.assertEqual(['abc2', 'metric1', 'test42'], ret)
+
+    def test_metric_name_index_rbac(self):
+        returned_by_prom = {'data': ['metric1', 'abc2']}
+        self.rbac.disable_rbac = False
+
+        with (mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                '_get', return_value=returned_by_prom) as m,
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'query') as q):
+            index = self.manager.metric_name_index()
+            self.manager.query('metric1')
+            m.assert_called_once_with('label/__name__/values',
+                                      {'match[]': "{project='project_id'}"})
+            q.assert_called_once()
+
+        # The index is fetched once and reused by the rbac enrichment
+        self.assertEqual(('abc2', 'metric1'), index.names)
+        self.assertIn('metric1', index)
+        self.assertNotIn('metric2', index)
+
     def test_show(self):
         query = 'some_metric'
         returned_by_prom = {
             'data': {
-                'resultType': 'non-vector'
-            },
-            'value': [1234567, 42],
-            'metric': {
-                'label': 'label_value'
+                'resultType': 'scalar',
+                'result': [1234567, 42]
             }
         }
-        expected = [prometheus_client.PrometheusMetric(returned_by_prom)]
+        expected = [prometheus_client.PrometheusMetric(
+            {'metric': {}, 'value': [1234567, 42]})]
         expected_matcher = MetricListMatcher(expected)
         with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
                                return_value=returned_by_prom):
@@ -82,14 +151,12 @@ class QueryManagerTest(testtools.TestCase):
         query = 'some_metric'
         returned_by_prom = {
             'data': {
-                'resultType': 'non-vector'
-            },
-            'value': [1234567, 42],
-            'metric': {
-                'label': 'label_value'
+                'resultType': 'scalar',
+                'result': [1234567, 42]
             }
         }
-        expected = [prometheus_client.PrometheusMetric(returned_by_prom)]
+        expected = [prometheus_client.PrometheusMetric(
+            {'metric': {}, 'value': [1234567, 42]})]
         expected_matcher = MetricListMatcher(expected)
         with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
                                return_value=returned_by_prom):
@@ -104,6 +171,191 @@ class QueryManagerTest(testtools.TestCase):
         self.assertThat(ret1, expected_matcher)
         self.assertThat(ret2, expected_matcher)
 
+    def test_query_cached(self):
+        self.client.query_cache = cache.QueryCache(align=15,
+                                                   clock=lambda: 1000)
+        self.rbac.disable_rbac = False
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'query', return_value=[]) as m:
+            ret1 = self.manager.query('metric1', disable_rbac=True)
+            ret2 = self.manager.query('metric1', disable_rbac=True)
+            m.assert_called_once_with('metric1', time=990)
+            self.assertIs(ret1, ret2)
+
+            self.manager.query('metric1', disable_rbac=True, time=1100)
+            m.assert_called_with('metric1', time=1095)
+            self.manager.show('metric1', disable_rbac=True)
+            self.assertEqual(3, m.call_count)
+
+        stats = self.manager.query_cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(3, stats['misses'])
+
+        self.manager.invalidate_query_cache()
+        self.assertEqual(0, self.manager.query_cache_stats()['size'])
+
+    def test_query_optimized(self):
+        self.client.query_optimizer = query_optimizer.QueryOptimizer(
+            self.client.prometheus_client, max_series=15)
+        self.rbac.enrich_query = mock.Mock(side_effect=lambda q, **kw: q)
+        count = {'data': {'resultType': 'vector', 'result': [
+            {'metric': {}, 'value': [1234567, '10']}]}}
+        result = {'data': {'resultType': 'vector', 'result': []}}
+
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               side_effect=[count, result]) as m:
+            self.manager.query("m{b='1', a='2'}")
+            self.assertRaises(query_optimizer.QueryBudgetError,
+                              self.manager.query,
+                              "m{a=\"2\", b=\"1\"} / m{a='2',b='1'}")
+
+        self.assertEqual(2, m.call_count)
+        self.assertEqual('count(m{a="2", b="1"})',
+                         m.call_args_list[0][0][1]['query'])
+        self.assertEqual('m{a="2", b="1"}',
+                         m.call_args_list[1][0][1]['query'])
+
+    def test_query_budget_all_paths(self):
+        self.client.query_optimizer = query_optimizer.QueryOptimizer(
+            self.client.prometheus_client, max_series=15)
+        self.rbac.enrich_query = mock.Mock(side_effect=lambda q, **kw: q)
+        self.rbac.append_rbac = mock.Mock(side_effect=lambda q, **kw: q)
+        count = {'data': {'resultType': 'vector', 'result': [
+            {'metric': {}, 'value': [1234567, '10']}]}}
+        query = "m{a='2'} / m{a='2'}"
+
+        with (mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                                return_value=count),
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'query_iter') as query_iter,
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'query_range') as query_range):
+            self.assertRaises(query_optimizer.QueryBudgetError,
+                              self.manager.query_iter, query)
+            self.assertRaises(query_optimizer.QueryBudgetError,
+                              self.manager.query_range, query, 0, 60, 15)
+            ret = self.manager.query_many([query], disable_rbac=True)
+            self.manager.show_iter("m{a='2'}")
+
+        query_iter.assert_called_once_with(
+            'last_over_time(m{a="2"}[5m])')
+        query_range.assert_not_called()
+        self.assertIsNone(ret[0].result)
+        self.assertIsInstance(ret[0].error, query_optimizer.QueryBudgetError)
+
+    def test_explain(self):
+        self.rbac.enrich_query = mock.Mock(side_effect=lambda q, **kw: q)
+        count = {'data': {'resultType': 'vector', 'result': [
+            {'metric': {}, 'value': [1234567, '3']}]}}
+
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               return_value=count):
+            plan = self.manager.explain("rate(m[5m]) / rate(m[5m] offset 1h)")
+
+        self.rbac.enrich_query.assert_called_with(
+            "rate(m[5m]) / rate(m[5m] offset 1h)", disable_rbac=False)
+        self.assertEqual([query_optimizer.SelectorEstimate('m', 2, 3)],
+                         plan.selectors)
+        self.assertEqual(6, plan.series)
+
+    def test_query_cache_project(self):
+        self.client.query_cache = cache.QueryCache()
+        self.rbac.disable_rbac = False
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'query', return_value=[]) as m:
+            self.manager._cached_query('metric1')
+            self.rbac.default_labels = {'project': 'other_project'}
+            self.manager._cached_query('metric1')
+            self.assertEqual(2, m.call_count)
+
+    def test_query_iter(self):
+        query = 'some_metric'
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'query_iter',
+                               return_value=iter([])) as m:
+            self.manager.query_iter(query, disable_rbac=True)
+            self.rbac.enrich_query.assert_called_with(query,
+                                                      disable_rbac=True)
+            m.assert_called_with(query)
+
+    def test_show_iter(self):
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'query_iter',
+                               return_value=iter([])) as m:
+            self.manager.show_iter('some_metric', disable_rbac=True)
+            self.rbac.append_rbac.assert_called_with('some_metric',
+                                                     disable_rbac=True)
+            m.assert_called_with("last_over_time(some_metric[5m])")
+
+    def test_query_many(self):
+        returned_by_prom = {'data': ['metric1', 'metric2']}
+        self.rbac.disable_rbac = False
+        client_exception = prometheus_client.PrometheusAPIClientError(
+            mock.Mock(status_code=400))
+
+        def query(q):
+            if q.startswith("bad"):
+                raise client_exception
+            return [q]
+
+        with (mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                '_get', return_value=returned_by_prom) as m,
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'query', side_effect=query)):
+            ret = self.manager.query_many(["sum(metric1)",
+                                           "bad(metric2)",
+                                           "metric2"],
+                                          max_concurrency=2)
+
+        # The metric names are fetched only once for the whole batch
+        m.assert_called_once()
+        self.assertEqual(["sum(metric1)", "bad(metric2)", "metric2"],
+                         [r.query for r in ret])
+        self.assertIsNone(ret[0].error)
+        self.assertEqual(1, len(ret[0].result))
+        self.assertTrue(ret[0].result[0].startswith("sum(metric1{project="))
+        self.assertIsNone(ret[1].result)
+        self.assertIs(client_exception, ret[1].error)
+        self.assertTrue(ret[2].result[0].startswith("metric2{project="))
+
+    def test_query_many_disable_rbac(self):
+        with (mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                '_get') as m,
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'query', side_effect=lambda q: [q])):
+            ret = self.manager.query_many(["metric1", "metric2"],
+                                          disable_rbac=True)
+
+        m.assert_not_called()
+        self.assertEqual([["metric1"], ["metric2"]],
+                         [r.result for r in ret])
+        self.assertEqual([], self.manager.query_many([]))
+
+    def test_query_range(self):
+        query = 'some_metric'
+        returned_by_prom = {
+            'data': {
+                'resultType': 'matrix',
+                'result': [{
+                    'metric': {'label': 'label_value'},
+                    'values': [[1234567, '42'], [1234582, '43']]
+                }]
+            }
+        }
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               return_value=returned_by_prom) as m:
+            ret = self.manager.query_range(query, 1234567, 1234582, 15,
+                                           disable_rbac=True)
+            self.rbac.enrich_query.assert_called_with(query,
+                                                      disable_rbac=True)
+            m.assert_called_with('query_range', {'query': query,
+                                                 'start': 1234567,
+                                                 'end': 1234582,
+                                                 'step': 15})
+
+        self.assertEqual(1, len(ret))
+        self.assertEqual([42.0, 43.0], list(ret[0].values))
+
     def test_delete(self):
         matches = "some_metric"
         start = 0
@@ -113,6 +365,114 @@ class QueryManagerTest(testtools.TestCase):
             self.manager.delete(matches, start, end)
         m.assert_called_with(matches, start, end)
 
+    def test_delete_dry_run(self):
+        series = {'a': [{'__name__': 'a', 'job': 'x'},
+                        {'__name__': 'a', 'job': 'y'}],
+                  'b': []}
+
+        def series_iter(matches, start=None, end=None):
+            return iter(series[matches[0]])
+
+        with (mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'series_iter',
+                                side_effect=series_iter) as m,
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'delete') as delete):
+            ret = self.manager.delete(['a', 'b'], 0, 600, dry_run=True,
+                                      scrape_interval='30s')
+
+        delete.assert_not_called()
+        m.assert_has_calls([mock.call(['a'], start=0, end=600),
+                            mock.call(['b'], start=0, end=600)],
+                           any_order=True)
+        self.assertEqual([python_api.DeleteEstimate('a', 2, 40),
+                          python_api.DeleteEstimate('b', 0, 0)], ret)
+
+    def test_delete_dry_run_count_only(self):
+        returned_by_prom = {'data': {'resultType': 'vector', 'result': [
+            {'metric': {}, 'value': [1234567, '1000']}]}}
+        with mock.patch.object(prometheus_client.PrometheusAPIClient, '_get',
+                               return_value=returned_by_prom) as m:
+            ret = self.manager.delete(['a{job="x"}'], dry_run=True,
+                                      count_only=True)
+
+        m.assert_called_once_with("query", {'query': 'count(a{job="x"})'})
+        self.assertEqual([python_api.DeleteEstimate('a{job="x"}', 1000,
+                                                    None)], ret)
+
+    def test_estimate_samples(self):
+        self.assertIsNone(python_api.estimate_samples(10))
+        self.assertEqual(600, python_api.estimate_samples(10, 0, 3600))
+        self.assertEqual(20, python_api.estimate_samples(
+            2, '1970-01-01T00:00:00Z', '1970-01-01T00:05:00Z', '30s'))
+        self.assertEqual(0, python_api.estimate_samples(10, 100, 0))
+        with mock.patch('time.time', return_value=120):
+            self.assertEqual(4, python_api.estimate_samples(2, 0))
+
+    def test_delete_chunks(self):
+        self.assertEqual([(['a', 'b'], None, None), (['c'], None, None)],
+                         python_api.delete_chunks(['a', 'b', 'c'],
+                                                  batch_size=2))
+        self.assertEqual([(['a'], 0, 10), (['a'], 10, 20), (['a'], 20, 25)],
+                         python_api.delete_chunks(['a'], 0, 25,
+                                                  time_chunk=10))
+        self.assertEqual([(['a'], 0, 60), (['a'], 60, 90)],
+                         python_api.delete_chunks(['a'], '0', '90',
+                                                  time_chunk='1m'))
+        self.assertRaises(ValueError, python_api.delete_chunks, ['a'],
+                          time_chunk=10)
+        self.assertRaises(ValueError, python_api.delete_chunks, ['a'],
+                          batch_size=0)
+
+    def test_bulk_delete(self):
+        matches = [f"metric_{i}" for i in range(5)]
+        progress = mock.Mock()
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'delete') as m:
+            results = self.manager.bulk_delete(matches, 0, 100, batch_size=2,
+                                               parallel=3, progress=progress)
+
+        self.assertEqual(3, m.call_count)
+        m.assert_has_calls([mock.call(matches[0:2], 0, 100),
+                            mock.call(matches[2:4], 0, 100),
+                            mock.call(matches[4:], 0, 100)], any_order=True)
+        self.assertEqual([python_api.DeleteResult(matches[0:2], 0, 100, None),
+                          python_api.DeleteResult(matches[2:4], 0, 100, None),
+                          python_api.DeleteResult(matches[4:], 0, 100, None)],
+                         results)
+        self.assertEqual([1, 2, 3],
+                         sorted(c[0][1] for c in progress.call_args_list))
+        self.assertEqual({3}, {c[0][2] for c in progress.call_args_list})
+
+    def test_bulk_delete_checkpoint(self):
+        matches = ['a', 'b', 'c']
+        error = prometheus_client.PrometheusAPIClientError(mock.Mock())
+
+        def delete(chunk, start, end):
+            if chunk == ['b']:
+                raise error
+
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        checkpoint = os.path.join(tmp.name, "delete.json")
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'delete', side_effect=delete) as m:
+            results = self.manager.bulk_delete(matches, batch_size=1,
+                                               checkpoint=checkpoint)
+        self.assertEqual(3, m.call_count)
+        self.assertEqual([None, error, None], [r.error for r in results])
+
+        # Only the failed chunk is deleted again, the checkpoint is
+        # removed once it succeeds.
+        with mock.patch.object(prometheus_client.PrometheusAPIClient,
+                               'delete') as m:
+            results = self.manager.bulk_delete(matches, batch_size=1,
+                                               checkpoint=checkpoint)
+        m.assert_called_once_with(['b'], None, None)
+        self.assertEqual([python_api.DeleteResult(['b'], None, None, None)],
+                         results)
+        self.assertFalse(os.path.exists(checkpoint))
+
     def test_clean_tombstones(self):
         with mock.patch.object(prometheus_client.PrometheusAPIClient,
                                'clean_tombstones') as m:
@@ -0,0 +1,144 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+from unittest import mock
+
+import testtools
+
+from observabilityclient import prometheus_client
+from observabilityclient.v1 import query_optimizer
+from observabilityclient.v1 import rbac
+
+
+def count_result(value):
+    return [prometheus_client.PrometheusMetric(
+        {'metric': {}, 'value': [1700000000, str(value)]})]
+
+
+class NormalizeSelectorTest(testtools.TestCase):
+    def normalize(self, selector):
+        tree = rbac._parse(selector)
+        return query_optimizer.normalize_selector(tree)
+
+    def test_normalize_selector(self):
+        test_cases = [
+            ("up", "up"),
+            ("up{}", "up"),
+            ("up{job='x'}", 'up{job="x"}'),
+            ("up{job='x', instance=~\"a.*\", job='x'}",
+             'up{instance=~"a.*", job="x"}'),
+            ("{job='x', __name__='up'}", 'up{job="x"}'),
+            ("{__name__='up'}", "up"),
+            ('{"metric.name"}', '{__name__="metric.name"}'),
+            ("{__name__='sum'}", '{__name__="sum"}'),
+            ("{__name__=~'up|down'}", '{__name__=~"up|down"}'),
+            ("{__name__='up', __name__='down'}",
+             '{__name__="down", __name__="up"}'),
+            ("up{job=`a\\.b`}", 'up{job="a\\\\.b"}'),
+            ("up{job='say \"hi\"'}", 'up{job="say \\"hi\\""}'),
+            ('up{"dotted.label"="x"}', 'up{"dotted.label"="x"}'),
+            ('up{a="\\x41"}', 'up{a="A"}'),
+            ('up{a="\\u00e9"}', 'up{a="\u00e9"}'),
+            ('up{a="\\101"}', 'up{a="A"}'),
+            ('up{a="\\xff\\x01"}', 'up{a="\\xff\\u0001"}'),
+        ]
+        for selector, expected in test_cases:
+            self.assertEqual(expected, self.normalize(selector), selector)
+
+    def test_normalized_selector_matches_same(self):
+        def matchers(selector):
+            tree = rbac._parse(selector)
+            ret = {(m.label, m.op, m.value) for m in tree.matchers}
+            if tree.name is not None:
+                ret.add(('__name__', '=', tree.name))
+            return ret
+
+        for selector in ["up{job='x', instance=~\"a.*\"}",
+                         "up{job=`a\\.b`}",
+                         "{job='x', __name__='up'}",
+                         "up{job='new\\nline', job='x'}",
+                         'up{a="\\x41\\u00e9\\101\\U0001f600"}',
+                         'up{a="\\xc3\\xa9\\xff\\x07"}']:
+            self.assertEqual(matchers(selector),
+                             matchers(self.normalize(selector)))
+
+
+class QueryOptimizerTest(testtools.TestCase):
+    def setUp(self):
+        super(QueryOptimizerTest, self).setUp()
+        self.prom = mock.Mock()
+        self.prom.query.return_value = count_result(10)
+
+    def test_optimize(self):
+        optimizer = query_optimizer.QueryOptimizer(self.prom)
+        query = ("rate(x{project='p', job=\"a\"}[5m]) / "
+                 "rate(x{job='a',project='p'}[5m] offset 1h) # ratio")
+        expected = ('rate(x{job="a", project="p"}[5m]) / '
+                    'rate(x{job="a", project="p"}[5m] offset 1h) # ratio')
+
+        plan = optimizer.optimize(query)
+
+        self.assertEqual(expected, plan.query)
+        self.assertEqual([query_optimizer.SelectorEstimate(
+            'x{job="a", project="p"}', 2, None)], plan.selectors)
+        self.assertIsNone(plan.series)
+        self.prom.query.assert_not_called()
+
+    def test_optimize_adjacent_identifiers(self):
+        optimizer = query_optimizer.QueryOptimizer(self.prom)
+        test_cases = [
+            ('{__name__="up"}offset 5m', 'up offset 5m'),
+            ('{__name__="up"}and{__name__="x"}', 'up and x'),
+            ('sum({__name__="up"})', 'sum(up)'),
+            ('{__name__="up", job="a"}offset 5m', 'up{job="a"}offset 5m'),
+        ]
+        for query, expected in test_cases:
+            plan = optimizer.optimize(query)
+            self.assertEqual(expected, plan.query, query)
+            self.assertEqual(plan.query, optimizer.optimize(plan.query).query)
+
+    def test_optimize_estimate(self):
+        optimizer = query_optimizer.QueryOptimizer(self.prom,
+                                                   estimate_series=True)
+        self.prom.query.side_effect = [count_result(10), []]
+
+        plan = optimizer.optimize("x + x + y{job='a'}")
+        plan2 = optimizer.optimize("y{job=\"a\"} * 2")
+
+        self.assertEqual([
+            query_optimizer.SelectorEstimate('x', 2, 10),
+            query_optimizer.SelectorEstimate('y{job="a"}', 1, 0),
+        ], plan.selectors)
+        self.assertEqual(20, plan.series)
+        self.assertEqual(0, plan2.series)
+        # The estimates are cached
+        self.assertEqual([mock.call('count(x)'),
+                          mock.call('count(y{job="a"})')],
+                         self.prom.query.call_args_list)
+
+    def test_optimize_budget(self):
+        optimizer = query_optimizer.QueryOptimizer(self.prom, max_series=25)
+
+        plan = optimizer.optimize("x + x")
+        self.assertEqual(20, plan.series)
+
+        error = self.assertRaises(query_optimizer.QueryBudgetError,
+                                  optimizer.optimize, "x + x + x")
+        self.assertEqual(30, error.plan.series)
+        self.assertEqual(1, self.prom.query.call_count)
+
+    def test_optimize_parse_error(self):
+        optimizer = query_optimizer.QueryOptimizer(self.prom)
+        self.assertRaises(rbac.ObservabilityRbacError,
+                          optimizer.optimize, "sum(x")
@@ -12,6 +12,7 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import random
 from unittest import mock
 
 from keystoneauth1.exceptions.auth_plugins import MissingAuthPlugin
@@ -19,9 +20,209 @@ from keystoneauth1 import session
 
 import testtools
 
+from observabilityclient.utils import metric_utils
 from observabilityclient.v1 import rbac
 
 
+# Reference implementation of the enrichment by string splicing, which
+# was used before the queries were parsed. It's kept to fuzz test, that
+# the parser enriches queries the same way, where splicing was correct.
+
+_REFERENCE_GROUPING_KEYWORDS = frozenset([
+    'by', 'without', 'on', 'ignoring', 'group_left', 'group_right'
+])
+
+_REFERENCE_KEYWORDS = _REFERENCE_GROUPING_KEYWORDS | frozenset([
+    'and', 'or', 'unless', 'bool', 'offset', 'atan2', 'inf', 'nan',
+    'sum', 'min', 'max', 'avg', 'group', 'stddev', 'stdvar', 'count',
+    'count_values', 'bottomk', 'topk', 'quantile', 'limitk', 'limit_ratio'
+])
+
+
+def _reference_next_significant(tokens, pos):
+    while pos < len(tokens):
+        if tokens[pos].kind not in ('space', 'comment'):
+            return pos
+        pos += 1
+    return None
+
+
+def _reference_previous_significant(tokens, pos):
+    while pos >= 0:
+        if tokens[pos].kind not in ('space', 'comment'):
+            return pos
+        pos -= 1
+    return None
+
+
+def _reference_find_metric_names(tokens, metric_names):
+    brace_depth = 0
+    bracket_depth = 0
+    grouping_depth = 0
+    expect_grouping = False
+    for pos, token in enumerate(tokens):
+        kind = token.kind
+        if kind in ('space', 'comment'):
+            continue
+        if grouping_depth:
+            if kind == '(':
+                grouping_depth += 1
+            elif kind == ')':
+                grouping_depth -= 1
+            continue
+        if expect_grouping:
+            expect_grouping = False
+            if kind == '(':
+                grouping_depth = 1
+                continue
+        if kind == '{':
+            brace_depth += 1
+        elif kind == '}':
+            brace_depth = max(brace_depth - 1, 0)
+        elif kind == '[':
+            bracket_depth += 1
+        elif kind == ']':
+            bracket_depth = max(bracket_depth - 1, 0)
+        elif kind == 'ident' and not brace_depth and not bracket_depth:
+            lowered = token.text.lower()
+            if lowered in _REFERENCE_GROUPING_KEYWORDS:
+                expect_grouping = True
+            elif (lowered in _REFERENCE_KEYWORDS or
+                    token.text not in metric_names):
+                continue
+            else:
+                next_pos = _reference_next_significant(tokens, pos + 1)
+                if next_pos is None or tokens[next_pos].kind != '(':
+                    yield pos
+
+
+def reference_enrich(query, labels, metric_names):
+    tokens = rbac._tokenize(query)
+    parts = []
+    copied = 0
+    for name_pos in _reference_find_metric_names(tokens, metric_names):
+        name = tokens[name_pos]
+        next_pos = _reference_next_significant(tokens, name_pos + 1)
+        if next_pos is not None and tokens[next_pos].kind == '{':
+            close_pos = next_pos + 1
+            while (close_pos < len(tokens) and
+                   tokens[close_pos].kind != '}'):
+                close_pos += 1
+            last_pos = _reference_previous_significant(tokens,
+                                                       close_pos - 1)
+            if tokens[last_pos].kind in ('{', ','):
+                injected = labels
+            else:
+                injected = f", {labels}"
+            insert_at = tokens[close_pos].start
+        else:
+            injected = f"{{{labels}}}"
+            insert_at = name.end
+        parts.append(query[copied:insert_at])
+        parts.append(injected)
+        copied = insert_at
+    parts.append(query[copied:])
+    return "".join(parts)
+
+
+class QueryGenerator(object):
+    """Generator of random PromQL queries."""
+
+    NAMES = ['up', 'http_requests_total', 'node_cpu', 'unknown_metric',
+             'job:rate5m']
+    LABELS = ['job', 'instance', 'mode', 'le']
+    FUNCTIONS = ['abs', 'ceil', 'vector', 'absent', 'timestamp']
+    RANGE_FUNCTIONS = ['rate', 'increase', 'max_over_time', 'delta']
+    AGGREGATORS = ['sum', 'min', 'max', 'avg', 'count', 'SUM']
+    OPERATORS = ['+', '-', '*', '/', '%', '^', '==', '!=', '>', '<=',
+                 'and', 'or', 'unless', 'atan2', '> bool']
+
+    def __init__(self, seed, project_matchers=False, nameless=False):
+        self.random = random.Random(seed)
+        self.project_matchers = project_matchers
+        self.nameless = nameless
+
+    def space(self):
+        return self.random.choice(['', ' ', '  ', '\n'])
+
+    def string(self):
+        quote = self.random.choice(['"', "'"])
+        value = self.random.choice(['a', 'b.*', 'x{y}', 'up', 'a,b', ''])
+        return f"{quote}{value}{quote}"
+
+    def matchers(self):
+        labels = self.random.sample(self.LABELS, self.random.randint(0, 2))
+        if self.project_matchers and self.random.random() < 0.5:
+            labels.append('project')
+        if self.nameless and self.random.random() < 0.3:
+            labels.append('__name__')
+        self.random.shuffle(labels)
+        matchers = [
+            f"{label}{self.random.choice(['=', '!=', '=~', '!~'])}"
+            f"{self.string()}"
+            for label in labels]
+        text = f",{self.space()}".join(matchers)
+        if matchers and self.random.random() < 0.2:
+            text += ","
+        return text
+
+    def selector(self):
+        if self.nameless and self.random.random() < 0.2:
+            return f"{{job={self.string()}, {self.matchers()}}}"
+        name = self.random.choice(self.NAMES)
+        if self.random.random() < 0.5:
+            name += f"{self.space()}{{{self.matchers()}}}"
+        return name
+
+    def modifiers(self, expr):
+        if self.random.random() < 0.2:
+            expr += f" offset {self.random.choice(['5m', '-1h', '1h30m'])}"
+        if self.random.random() < 0.1:
+            expr += f" @ {self.random.choice(['123', 'start()', 'end()'])}"
+        return expr
+
+    def grouping(self):
+        labels = ", ".join(self.random.sample(self.LABELS + self.NAMES, 2))
+        return f"{self.random.choice(['by', 'without'])} ({labels})"
+
+    def expr(self, depth=0):
+        choice = self.random.randint(0, 8 if depth < 3 else 1)
+        if choice == 0:
+            return self.modifiers(self.selector())
+        if choice == 1:
+            return self.random.choice(['1', '2.5', '1e3', 'Inf', '0x1f'])
+        if choice == 2:
+            matrix = self.modifiers(
+                f"{self.selector()}[{self.random.choice(['5m', '1h'])}]")
+            return f"{self.random.choice(self.RANGE_FUNCTIONS)}({matrix})"
+        if choice == 3:
+            return (f"{self.random.choice(self.FUNCTIONS)}"
+                    f"({self.space()}{self.expr(depth + 1)})")
+        if choice == 4:
+            aggregator = self.random.choice(self.AGGREGATORS)
+            if self.random.random() < 0.5:
+                return (f"{aggregator} {self.grouping()} "
+                        f"({self.expr(depth + 1)})")
+            return f"{aggregator}({self.expr(depth + 1)}) {self.grouping()}"
+        if choice == 5:
+            matching = self.random.choice([
+                '', ' on(job)', ' ignoring(instance, up)',
+                ' on(job) group_left(mode)', ' on(job) group_right'])
+            op = self.random.choice(self.OPERATORS)
+            if op in ('and', 'or', 'unless'):
+                matching = matching.split(' group_')[0]
+            return (f"{self.expr(depth + 1)} {op}{matching} "
+                    f"{self.expr(depth + 1)}")
+        if choice == 6:
+            return f"({self.space()}{self.expr(depth + 1)}{self.space()})"
+        if choice == 7:
+            return (f"max_over_time(({self.expr(depth + 1)})"
+                    f"[{self.random.choice(['30m:1m', '1h:', '5m:30s'])}])")
+        return (f"topk({self.random.randint(1, 5)}, "
+                f"{self.expr(depth + 1)}) # {self.random.choice(self.NAMES)}"
+                "\n")
+
+
 class RbacTest(testtools.TestCase):
     def setUp(self):
         super(RbacTest, self).setUp()
@@ -40,6 +241,47 @@ class RbacTest(testtools.TestCase):
                 "project": "123"
             })
 
+    def test_enrich_query_cached(self):
+        index = metric_utils.MetricNameIndex(["metric1", "metric2"])
+        query = "sum(metric1) / sum(metric2)"
+        expected = ("sum(metric1{project='secret_id'}) / "
+                    "sum(metric2{project='secret_id'})")
+
+        with mock.patch.object(rbac, '_tokenize',
+                               wraps=rbac._tokenize) as m:
+            self.assertEqual(expected, self.rbac.enrich_query(
+                query, metric_names=index))
+            self.assertEqual(expected, self.rbac.enrich_query(
+                query, metric_names=index))
+            m.assert_called_once()
+
+            # A new index or other labels produce a new result
+            new_index = metric_utils.MetricNameIndex(["metric1"])
+            self.assertEqual("sum(metric1{project='secret_id'}) / "
+                             "sum(metric2)",
+                             self.rbac.enrich_query(query,
+                                                    metric_names=new_index))
+            self.rbac.default_labels = {"project": "other_id"}
+            self.assertEqual(expected.replace("secret_id", "other_id"),
+                             self.rbac.enrich_query(query,
+                                                    metric_names=index))
+            self.assertEqual(3, m.call_count)
+
+            # Plain collections of names aren't cached
+            self.rbac.enrich_query(query, metric_names=["metric1"])
+            self.assertEqual(4, m.call_count)
+
+        stats = self.rbac.enrich_cache_stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(3, stats['size'])
+
+    def test_enrich_query_cache_disabled(self):
+        r = rbac.Rbac(mock.Mock(), mock.Mock(), enrich_cache_size=0)
+        self.assertIsNone(r.enrich_cache_stats())
+        index = metric_utils.MetricNameIndex(["metric1"])
+        self.assertTrue(r.enrich_query("metric1", metric_names=index)
+                        .startswith("metric1{project="))
+
     def test_constructor_error(self):
         with mock.patch.object(session.Session, 'get_project_id',
                                side_effect=MissingAuthPlugin()):
@@ -88,9 +330,8 @@ class RbacTest(testtools.TestCase):
             )
         ]
 
-        self.rbac.client.query.list = lambda disable_rbac: ['test_query',
-                                                            'cpu_temp_celsius',
-                                                            'http_requests']
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['test_query', 'cpu_temp_celsius', 'http_requests'])
 
         for query, expected in test_cases:
             ret = self.rbac.enrich_query(query)
@@ -126,9 +367,8 @@ class RbacTest(testtools.TestCase):
             )
         ]
 
-        self.rbac.client.query.list = lambda disable_rbac: ['test_query',
-                                                            'cpu_temp_celsius',
-                                                            'http_requests']
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['test_query', 'cpu_temp_celsius', 'http_requests'])
         for query, expected in test_cases:
             ret = self.rbac.enrich_query(query, disable_rbac=True)
             self.assertEqual(ret, query)
@@ -144,3 +384,180 @@ class RbacTest(testtools.TestCase):
         expected = query
         ret = self.rbac.append_rbac(query, disable_rbac=True)
         self.assertEqual(ret, expected)
+
+    def test_enrich_query_grammar_positions(self):
+        labels = f"project='{self.rbac.project_id}'"
+        test_cases = [
+            (
+                # function names and label names aren't metric names
+                "rate(http_requests[5m])",
+                f"rate(http_requests{{{labels}}}[5m])"
+            ), (
+                "sum by (http_requests) (test_query)",
+                f"sum by (http_requests) (test_query{{{labels}}})"
+            ), (
+                "test_query * on(instance) group_left(http_requests) "
+                "http_requests",
+
+                f"test_query{{{labels}}} * on(instance) "
+                f"group_left(http_requests) http_requests{{{labels}}}"
+            ), (
+                # metric names inside of strings are left alone
+                "test_query{somelabel='http_requests'}",
+                f"test_query{{somelabel='http_requests', {labels}}}"
+            ), (
+                "test_query {somelabel=\"value\",}",
+                f"test_query {{somelabel=\"value\",{labels}}}"
+            ), (
+                "test_query{}",
+                f"test_query{{{labels}}}"
+            ), (
+                "test_query_total + test_query offset 5m",
+                f"test_query_total + test_query{{{labels}}} offset 5m"
+            ), (
+                "test_query # http_requests",
+                f"test_query{{{labels}}} # http_requests"
+            )
+        ]
+
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['test_query', 'http_requests'])
+
+        for query, expected in test_cases:
+            ret = self.rbac.enrich_query(query)
+            self.assertEqual(expected, ret)
+
+    def test_enrich_query_many_metric_names(self):
+        metric_names = [f"metric_{i}" for i in range(40000)]
+        query = "sum(metric_39999) / sum(metric_1{label='value'})"
+        expected = (f"sum(metric_39999{{project='{self.rbac.project_id}'}}) "
+                    f"/ sum(metric_1{{label='value', "
+                    f"project='{self.rbac.project_id}'}})")
+
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=metric_utils.MetricNameIndex(metric_names))
+
+        ret = self.rbac.enrich_query(query)
+        self.assertEqual(expected, ret)
+
+    def test_enrich_query_unterminated_labels(self):
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['test_query'])
+        self.assertRaises(rbac.ObservabilityRbacError,
+                          self.rbac.enrich_query,
+                          "test_query{label='value'")
+
+    def test_enrich_query_replaces_project(self):
+        project = self.rbac.project_id
+        test_cases = [
+            (
+                "up{project='other', job='x', project=~'.*'}",
+                f"up{{project='{project}', job='x'}}"
+            ),
+            (
+                f"up{{job='x', project='{project}'}}",
+                f"up{{job='x', project='{project}'}}"
+            ),
+            (
+                "up{job='x', project!='other'}",
+                f"up{{job='x', project='{project}'}}"
+            ),
+            (
+                "{__name__=~'node.*', job='x'}",
+                f"{{__name__=~'node.*', job='x', project='{project}'}}"
+            ),
+            (
+                "rate(up{project=\"a\"}[5m] offset 1h @ end())",
+                f"rate(up{{project='{project}'}}[5m] offset 1h @ end())"
+            ),
+            (
+                "max_over_time(rate(up[5m])[30m:1m])",
+                f"max_over_time(rate(up{{project='{project}'}}[5m])[30m:1m])"
+            ),
+            (
+                "SUM(up) BY (job)",
+                f"SUM(up{{project='{project}'}}) BY (job)"
+            ),
+        ]
+
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['up'])
+
+        for query, expected in test_cases:
+            ret = self.rbac.enrich_query(query)
+            self.assertEqual(expected, ret)
+
+    def test_enrich_query_parse_errors(self):
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['up'])
+        for query in ["{}", "sum(up", "up +", "up[5m", "rate(up) by",
+                      "up{job=}", "up offset"]:
+            self.assertRaises(rbac.ObservabilityRbacError,
+                              self.rbac.enrich_query, query)
+
+    def test_unquote(self):
+        test_cases = [
+            (r'"\x41"', "A"),
+            (r'"\101"', "A"),
+            (r'"\u00e9"', "\u00e9"),
+            (r'"\U0001f600"', "\U0001f600"),
+            (r'"\xc3\xa9"', "\u00e9"),
+            (r'"\xff"', "\udcff"),
+            (r'"a\tb\\c\"d"', 'a\tb\\c"d'),
+            (r"'a\'b'", "a'b"),
+            (r'`a\x41`', r'a\x41'),
+        ]
+        for text, expected in test_cases:
+            self.assertEqual(expected, rbac._unquote(text), text)
+
+    def test_unquote_errors(self):
+        for text in [r'"\q"', r'"\x4"', r'"\u00e"', r'"\400"', r'"\12"',
+                     r'"\ud800"', r'"\U00110000"', r"'\"'", r'"\'"',
+                     '"a\nb"']:
+            self.assertRaises(rbac.ObservabilityRbacError,
+                              rbac._unquote, text)
+
+    def test_enrich_query_project_escapes(self):
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=['up'])
+        # The matcher selects the right project already
+        query = 'up{project="secret\\x5fid"}'
+        self.assertEqual(query, self.rbac.enrich_query(query))
+        self.assertRaises(rbac.ObservabilityRbacError,
+                          self.rbac.enrich_query, 'up{project="\\q"}')
+
+    def test_enrich_query_fuzz(self):
+        # Where the old string splicing was correct, the parser has
+        # to produce the same queries.
+        metric_names = metric_utils.MetricNameIndex(
+            QueryGenerator.NAMES[:-2])
+        labels = metric_utils.format_labels(self.rbac.default_labels)
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=metric_names)
+        for seed in range(500):
+            query = QueryGenerator(seed).expr()
+            expected = reference_enrich(query, labels, metric_names)
+            ret = self.rbac.enrich_query(query)
+            self.assertEqual(expected, ret, f"query: {query}")
+            self.assertEqual(ret, self.rbac.enrich_query(ret),
+                             f"query: {query}")
+
+    def test_enrich_query_fuzz_project_matchers(self):
+        metric_names = metric_utils.MetricNameIndex(
+            QueryGenerator.NAMES[:-2])
+        self.rbac.client.query.metric_name_index = mock.Mock(
+            return_value=metric_names)
+        for seed in range(500):
+            query = QueryGenerator(seed, project_matchers=True,
+                                   nameless=True).expr()
+            ret = self.rbac.enrich_query(query)
+            self.assertEqual(ret, self.rbac.enrich_query(ret),
+                             f"query: {query}")
+            for selector in rbac._vector_selectors(rbac._parse(ret)):
+                if (selector.name is not None and
+                        selector.name not in metric_names):
+                    continue
+                projects = [(m.op, m.value) for m in selector.matchers
+                            if m.label == 'project']
+                self.assertEqual([('=', self.rbac.project_id)], projects,
+                                 f"query: {query}, enriched: {ret}")
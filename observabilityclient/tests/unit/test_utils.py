@@ -13,11 +13,15 @@
 #   under the License.
 
 import os
+import tempfile
 from unittest import mock
 
 import testtools
+import yaml
 
 from observabilityclient import prometheus_client
+from observabilityclient.utils import cache
+from observabilityclient.utils import disk_cache
 from observabilityclient.utils import metric_utils
 
 
@@ -42,10 +46,50 @@ class GetConfigFileTest(testtools.TestCase):
         m.call_args_list == expected
         self.assertEqual(ret, None)
 
+    def test_default_config_locations(self):
+        with mock.patch.dict(os.environ, {'HOME': '/home/user'}):
+            self.assertEqual(["/home/user/.config/openstack/",
+                              "/etc/openstack/"],
+                             metric_utils.DEFAULT_CONFIG_LOCATIONS)
+
+
+class SharedPrometheusClientsTest(testtools.TestCase):
+    def setUp(self):
+        super(SharedPrometheusClientsTest, self).setUp()
+        metric_utils.clear_prometheus_clients()
+        self.addCleanup(metric_utils.clear_prometheus_clients)
+
+    def test_shared_clients_bounded(self):
+        clients = []
+        with (mock.patch.dict(os.environ, {'PROMETHEUS_HOST': 'somehost'}),
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                'close', autospec=True) as close):
+            for port in range(metric_utils.MAX_SHARED_CLIENTS + 1):
+                with mock.patch.dict(os.environ,
+                                     {'PROMETHEUS_PORT': str(port)}):
+                    clients.append(metric_utils.get_prometheus_client())
+
+            # The least recently used client is closed
+            close.assert_called_once_with(clients[0])
+            self.assertEqual(metric_utils.MAX_SHARED_CLIENTS,
+                             len(metric_utils._clients))
+
+            metric_utils.clear_prometheus_clients()
+            self.assertEqual(len(clients), close.call_count)
+            self.assertEqual(0, len(metric_utils._clients))
+
 
 class GetPrometheusClientTest(testtools.TestCase):
     def setUp(self):
         super(GetPrometheusClientTest, self).setUp()
+        metric_utils.clear_prometheus_clients()
+        self.addCleanup(metric_utils.clear_prometheus_clients)
+        # Some tests create clients without initializing them, which
+        # couldn't be closed.
+        patcher = mock.patch.object(metric_utils, '_clients',
+                                    cache.TTLCache(maxsize=2))
+        self.clients = patcher.start()
+        self.addCleanup(patcher.stop)
         config_data = 'host: "somehost"\nport: "1234"'
         self.config_file = mock.mock_open(read_data=config_data)("name", 'r')
 
@@ -57,6 +101,55 @@ class GetPrometheusClientTest(testtools.TestCase):
             metric_utils.get_prometheus_client()
         m.assert_called_with("somehost:1234")
 
+    def test_get_prometheus_client_options(self):
+        config_data = ('host: "somehost"\nport: "1234"\n'
+                       'pool_maxsize: 50\nretries: 3\n'
+                       'connect_timeout: 2\nread_timeout: 30\n'
+                       'compression: false\nunknown_option: 1')
+        config_file = mock.mock_open(read_data=config_data)("name", 'r')
+        with (mock.patch.object(metric_utils, 'get_config_file',
+                                return_value=config_file),
+              mock.patch.object(prometheus_client.PrometheusAPIClient,
+                                "__init__", return_value=None) as m):
+            metric_utils.get_prometheus_client()
+        m.assert_called_with("somehost:1234", pool_maxsize=50, retries=3,
+                             compression=False, timeout=(2, 30))
+
+    def test_get_prometheus_client_shared(self):
+        with mock.patch.dict(os.environ, {'PROMETHEUS_HOST': 'somehost',
+                                          'PROMETHEUS_PORT': '1234'}):
+            client1 = metric_utils.get_prometheus_client()
+            client2 = metric_utils.get_prometheus_client()
+            self.assertIs(client1, client2)
+            self.assertIsNot(client1, metric_utils.get_prometheus_client(
+                shared=False))
+
+            with mock.patch.dict(os.environ, {'PROMETHEUS_PORT': '4321'}):
+                client3 = metric_utils.get_prometheus_client()
+            self.assertIsNot(client1, client3)
+            self.assertEqual("somehost:4321", client3.host)
+
+    def test_load_config_file_memoized(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        path = os.path.join(tmp.name, metric_utils.CONFIG_FILE_NAME)
+        with open(path, "w") as f:
+            f.write('host: "somehost"\nport: "1234"')
+
+        with mock.patch('yaml.safe_load', wraps=yaml.safe_load) as m:
+            for _ in range(2):
+                with open(path) as f:
+                    conf = metric_utils.load_config_file(f)
+                # Modifications of the result don't leak into the memo
+                conf['port'] = "0"
+            m.assert_called_once()
+
+            os.utime(path, ns=(0, 0))
+            with open(path) as f:
+                conf = metric_utils.load_config_file(f)
+            self.assertEqual(2, m.call_count)
+        self.assertEqual({"host": "somehost", "port": "1234"}, conf)
+
     def test_get_prometheus_client_env_overide(self):
         with (mock.patch.dict(os.environ, {'PROMETHEUS_HOST': 'env_overide'}),
               mock.patch.object(metric_utils, 'get_config_file',
@@ -104,6 +197,190 @@ class FormatLabelsTest(testtools.TestCase):
         self.assertEqual(expected, ret)
 
 
+class MetricNameIndexTest(testtools.TestCase):
+    def test_prefix(self):
+        index = metric_utils.MetricNameIndex(
+            ["node_load1", "node_cpu", "up", "node_load15", "nod"])
+        self.assertEqual(["node_load1", "node_load15"],
+                         index.prefix("node_load"))
+        self.assertEqual(["nod", "node_cpu", "node_load1", "node_load15"],
+                         index.prefix("nod"))
+        self.assertEqual([], index.prefix("x"))
+        self.assertEqual(5, len(index.prefix("")))
+
+    def test_prefix_large(self):
+        names = [f"metric_{i}" for i in range(40000)]
+        index = metric_utils.MetricNameIndex(names)
+        self.assertEqual(["metric_39999"], index.prefix("metric_39999"))
+        self.assertEqual(11, len(index.prefix("metric_1234")))
+
+
+class GetDiskCacheOptionsTest(testtools.TestCase):
+    def test_get_disk_cache_options(self):
+        self.assertIsNone(metric_utils.get_disk_cache_options({}))
+        self.assertIsNone(metric_utils.get_disk_cache_options(
+            {'disk_cache_ttl': 0}))
+        self.assertEqual({'ttl': 300.0}, metric_utils.get_disk_cache_options(
+            {'disk_cache_ttl': '300'}))
+
+        with mock.patch.object(metric_utils, 'get_prometheus_config',
+                               return_value={'disk_cache_ttl': 60}):
+            self.assertEqual({'ttl': 60.0},
+                             metric_utils.get_disk_cache_options())
+
+
+class CompleteMetricNamesTest(testtools.TestCase):
+    def setUp(self):
+        super(CompleteMetricNamesTest, self).setUp()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        cache = disk_cache.DiskCache(tmp.name)
+        cache.store("__name__", "somehost:1234", None, ["up", "node_cpu"])
+        cache.store("__name__", "somehost:1234", "{project='p'}",
+                    ["node_load1"])
+        cache.store("__name__", "otherhost:1234", None, ["node_other"])
+        self.cache_dir = tmp.name
+        patcher = mock.patch.object(disk_cache, 'default_cache_dir',
+                                    return_value=tmp.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(metric_utils, 'get_disk_cache_options',
+                                    return_value={'ttl': 300})
+        self.get_disk_cache_options = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_complete(self):
+        with mock.patch.object(metric_utils, 'get_prometheus_address',
+                               return_value="somehost:1234"):
+            self.assertEqual(
+                ["node_cpu", "node_load1"],
+                metric_utils.complete_metric_names("node"))
+            self.assertEqual(
+                ["sum(rate(node_cpu"],
+                metric_utils.complete_metric_names("sum(rate(node_c"))
+            self.assertEqual(
+                ["sum(node_cpu", "sum(node_load1", "sum(up"],
+                metric_utils.complete_metric_names("sum("))
+
+    def test_complete_address_cached(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        conf = os.path.join(tmp.name, "prometheus.yaml")
+        with open(conf, "w") as f:
+            f.write("host: somehost\nport: 1234\n")
+
+        with (mock.patch.object(metric_utils, 'find_config_file',
+                                return_value=conf),
+              mock.patch.object(metric_utils, 'get_prometheus_address',
+                                return_value="somehost:1234") as m):
+            self.assertEqual(["up"], metric_utils.complete_metric_names("u"))
+            self.assertEqual(["up"], metric_utils.complete_metric_names("u"))
+            self.assertEqual(1, m.call_count)
+
+            # A changed configuration is read again
+            with open(conf, "a") as f:
+                f.write("timeout: 5\n")
+            metric_utils.complete_metric_names("u")
+            self.assertEqual(2, m.call_count)
+
+    def test_complete_fetch(self):
+        prom = mock.Mock()
+        prom.label_values.return_value = ["up", "node_new", "node_cpu"]
+        with (mock.patch.object(metric_utils, 'get_prometheus_address',
+                                return_value="newhost:1234"),
+              mock.patch.object(metric_utils, 'get_prometheus_client',
+                                return_value=prom)):
+            self.assertEqual(["node_cpu", "node_new"],
+                             metric_utils.complete_metric_names("node"))
+            # The names are fetched only once
+            self.assertEqual(["up"], metric_utils.complete_metric_names("u"))
+
+        prom.label_values.assert_called_once_with("__name__")
+
+    def test_complete_cache_disabled(self):
+        self.get_disk_cache_options.return_value = None
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        conf = os.path.join(tmp.name, "prometheus.yaml")
+        with open(conf, "w") as f:
+            f.write("host: somehost\nport: 1234\n")
+        files = sorted(os.listdir(self.cache_dir))
+        prom = mock.Mock()
+        prom.label_values.return_value = ["up", "node_new"]
+
+        with (mock.patch.object(metric_utils, 'find_config_file',
+                                return_value=conf),
+              mock.patch.object(metric_utils, 'get_prometheus_client',
+                                return_value=prom)):
+            self.assertEqual(["node_new"],
+                             metric_utils.complete_metric_names("node"))
+            self.assertEqual(["up"], metric_utils.complete_metric_names("u"))
+
+        # The names aren't served from nor written to the disk cache
+        self.assertEqual(2, prom.label_values.call_count)
+        self.assertEqual(files, sorted(os.listdir(self.cache_dir)))
+
+    def test_complete_fetch_error(self):
+        prom = mock.Mock()
+        prom.label_values.side_effect = Exception("connection refused")
+        with (mock.patch.object(metric_utils, 'get_prometheus_address',
+                                return_value="newhost:1234"),
+              mock.patch.object(metric_utils, 'get_prometheus_client',
+                                return_value=prom)):
+            self.assertEqual([], metric_utils.complete_metric_names("node"))
+
+    def test_complete_no_config(self):
+        with mock.patch.object(metric_utils, 'get_prometheus_address',
+                               side_effect=metric_utils.ConfigurationError):
+            self.assertEqual([], metric_utils.complete_metric_names("up"))
+
+
+class Metrics2RowsTest(testtools.TestCase):
+    def test_metrics2rows_series(self):
+        first = prometheus_client.RangeSeries({"a": "1", "b": "2"})
+        first.extend([[1, "10"], [2, "11"]])
+        second = prometheus_client.RangeSeries({"b": "3", "c": "4"})
+        second.extend([[1, "20"]])
+
+        columns, rows = metric_utils.metrics2rows(iter([first, second]))
+
+        self.assertEqual(["a", "b", "timestamp", "value"], columns)
+        self.assertEqual([["1", "2", 1.0, 10.0], ["1", "2", 2.0, 11.0],
+                          ["", "3", 1.0, 20.0]], list(rows))
+
+    def test_metrics2rows(self):
+        schemas = {}
+        metrics = [
+            prometheus_client.PrometheusMetric(
+                {"metric": {"a": "1", "b": "2"}, "value": [1, "10"]},
+                schemas),
+            prometheus_client.PrometheusMetric(
+                {"metric": {"a": "3", "b": "4"}, "value": [1, "20"]},
+                schemas),
+            prometheus_client.PrometheusMetric(
+                {"metric": {"b": "5", "c": "6"}, "value": [1, "30"]},
+                schemas),
+        ]
+        consumed = []
+
+        def stream():
+            for metric in metrics:
+                consumed.append(metric)
+                yield metric
+
+        columns, rows = metric_utils.metrics2rows(stream())
+        self.assertEqual(["a", "b", "value"], columns)
+        # Only the first metric is read before the rows are requested
+        self.assertEqual(1, len(consumed))
+        self.assertEqual([["1", "2", "10"], ["3", "4", "20"],
+                          ["", "5", "30"]], list(rows))
+
+    def test_metrics2rows_empty(self):
+        columns, rows = metric_utils.metrics2rows(iter([]))
+        self.assertEqual([], columns)
+        self.assertEqual([], list(rows))
+
+
 class Metrics2ColsTest(testtools.TestCase):
     def setUp(self):
         super(Metrics2ColsTest, self).setUp()
@@ -124,3 +401,84 @@ class Metrics2ColsTest(testtools.TestCase):
 
         ret = metric_utils.metrics2cols(input_metrics)
         self.assertEqual(expected, ret)
+
+    def test_metrics2cols_different_labels(self):
+        schemas = {}
+        input_metrics = [
+            prometheus_client.PrometheusMetric(
+                {'value': [1, '1'], 'metric': {'a': 'a1', 'b': 'b1'}},
+                schemas),
+            prometheus_client.PrometheusMetric(
+                {'value': [1, '2'], 'metric': {'b': 'b2', 'c': 'c2'}},
+                schemas),
+            prometheus_client.PrometheusMetric(
+                {'value': [1, '3'], 'metric': {'a': 'a3', 'b': 'b3'}}),
+            prometheus_client.PrometheusMetric(
+                {'value': [1, '4'], 'metric': {'c': 'c4', 'a': 'a4',
+                                               'b': 'b4'}}),
+        ]
+        expected = (['a', 'b', 'c', 'value'],
+                    [['a1', 'b1', '', '1'],
+                     ['', 'b2', 'c2', '2'],
+                     ['a3', 'b3', '', '3'],
+                     ['a4', 'b4', 'c4', '4']])
+
+        self.assertEqual(expected, metric_utils.metrics2cols(input_metrics))
+        self.assertEqual(expected,
+                         metric_utils.metrics2cols(iter(input_metrics)))
+        self.assertEqual(([], []), metric_utils.metrics2cols([]))
+
+    def test_metrics2cols_large(self):
+        schemas = {}
+        input_metrics = [
+            prometheus_client.PrometheusMetric(
+                {'value': [1, str(i)],
+                 'metric': ({'job': 'a', 'instance': str(i)} if i % 2 else
+                            {'job': 'b', 'pod': str(i)})},
+                schemas)
+            for i in range(100000)]
+
+        cols, rows = metric_utils.metrics2cols(input_metrics)
+
+        self.assertEqual(['job', 'pod', 'instance', 'value'], cols)
+        self.assertEqual(100000, len(rows))
+        self.assertEqual(['a', '', '99999', '99999'], rows[-1])
+        self.assertEqual(['b', '99998', '', '99998'], rows[-2])
+
+
+class Range2ColsTest(testtools.TestCase):
+    def setUp(self):
+        super(Range2ColsTest, self).setUp()
+
+    def test_range2cols(self):
+        result = prometheus_client.RangeResult([{
+            'metric': {'label1': 'value1'},
+            'values': [[1234567, '5'], [1234582, '6']]
+        }, {
+            'metric': {'label1': 'value2'},
+            'values': [[1234567, '7']]
+        }])
+        expected = (['label1', 'timestamp', 'value'],
+                    [['value1', 1234567.0, 5.0],
+                     ['value1', 1234582.0, 6.0],
+                     ['value2', 1234567.0, 7.0]])
+
+        ret = metric_utils.range2cols(result)
+        self.assertEqual(expected, ret)
+
+    def test_range2cols_different_labels(self):
+        result = prometheus_client.RangeResult([{
+            'metric': {'a': '1', 'b': '2'},
+            'values': [[1, '5']]
+        }, {
+            'metric': {'b': '3', 'c': '4'},
+            'values': [[1, '6'], [2, '7']]
+        }])
+        expected = (['a', 'b', 'c', 'timestamp', 'value'],
+                    [['1', '2', '', 1.0, 5.0],
+                     ['', '3', '4', 1.0, 6.0],
+                     ['', '3', '4', 2.0, 7.0]])
+
+        self.assertEqual(expected, metric_utils.range2cols(result))
+        self.assertEqual(([], []), metric_utils.range2cols(
+            prometheus_client.RangeResult()))
@@ -0,0 +1,178 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import collections
+import sys
+import threading
+import time
+
+
+class TTLCache(object):
+    """Thread safe LRU cache with expiring entries.
+
+    :param maxsize: Maximum number of entries. The least recently used
+                    entry is evicted when the cache is full.
+    :type maxsize: int
+    :param ttl: Number of seconds after which an entry expires.
+                None for entries, which never expire.
+    :type ttl: float
+    :param timer: Function returning the current time in seconds
+    :type timer: callable
+    :param max_bytes: Memory budget of the cache. Least recently used
+                      entries are evicted when the summed weight of
+                      the entries exceeds it. None for no budget.
+    :type max_bytes: int
+    :param weigher: Function returning the approximate size of a value
+                    in bytes
+    :type weigher: callable
+    :param on_remove: Function called with the key and value of every
+                      entry removed from the cache, e.g. for releasing
+                      resources held by the value. It's called with the
+                      cache locked, so it must not use the cache.
+    :type on_remove: callable
+    """
+
+    def __init__(self, maxsize=128, ttl=None, timer=time.monotonic,
+                 max_bytes=None, weigher=sys.getsizeof, on_remove=None):
+        if maxsize < 1:
+            raise ValueError("maxsize must be at least 1")
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._timer = timer
+        self._weigher = weigher
+        self._on_remove = on_remove
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._lookup(key) is not None
+
+    def _lookup(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires = entry[0]
+        if expires is not None and expires <= self._timer():
+            self._remove(key)
+            return None
+        return entry
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+            if self._on_remove is not None:
+                self._on_remove(key, entry[1])
+
+    def get(self, key, default=None):
+        """Return the value stored under key or default on a miss."""
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        """Store value under key, evicting the least recently used entry."""
+        expires = None
+        if self.ttl is not None:
+            expires = self._timer() + self.ttl
+        weight = 0
+        if self.max_bytes is not None:
+            weight = self._weigher(value)
+        with self._lock:
+            self._remove(key)
+            if self.max_bytes is not None and weight > self.max_bytes:
+                # It would evict everything else and still not fit
+                return
+            self._entries[key] = (expires, value, weight)
+            self.bytes += weight
+            while (len(self._entries) > self.maxsize or
+                   (self.max_bytes is not None and
+                    self.bytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key=None):
+        """Drop the entry stored under key, or all entries if key is None."""
+        with self._lock:
+            if key is None:
+                entries = self._entries
+                self._entries = collections.OrderedDict()
+                self.bytes = 0
+                if self._on_remove is not None:
+                    for key, entry in entries.items():
+                        self._on_remove(key, entry[1])
+            else:
+                self._remove(key)
+
+    def stats(self):
+        """Return a dict with the cache size and hit / miss counters."""
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+class QueryCache(TTLCache):
+    """Cache of instant query results.
+
+    Besides the TTLCache parameters it accepts align, the number of
+    seconds to which evaluation times are rounded down. Queries sent
+    within the same interval are then evaluated at the same time,
+    so they can be answered from the cache.
+
+    :param align: Evaluation time alignment in seconds, None to keep
+                  evaluation times as they are
+    :type align: float
+    :param clock: Function returning the current unix time
+    :type clock: callable
+    """
+
+    def __init__(self, maxsize=256, ttl=30, align=None, clock=time.time,
+                 **kwargs):
+        super(QueryCache, self).__init__(maxsize=maxsize, ttl=ttl, **kwargs)
+        self.align = align
+        self._clock = clock
+
+    def eval_time(self, timestamp=None):
+        """Return the evaluation time to send with a query.
+
+        :param timestamp: Requested evaluation time as a unix
+                          timestamp, None for the current time
+        :type timestamp: float
+        """
+        if not self.align:
+            return timestamp
+        if timestamp is None:
+            timestamp = self._clock()
+        return timestamp - timestamp % self.align
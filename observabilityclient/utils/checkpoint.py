@@ -0,0 +1,93 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+
+LOG = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+class Checkpoint(object):
+    """Set of finished work items of a long running task kept in a file.
+
+    The file is tied to the task by a key, e.g. the task's arguments.
+    A file written for a different key is ignored, so a changed task
+    starts from scratch. The file is replaced atomically after every
+    item, an interrupted task resumes from the last finished one.
+
+    :param path: Path of the checkpoint file
+    :type path: str
+    :param key: JSON serializable description of the task
+    :type key: object
+    """
+
+    def __init__(self, path, key):
+        self.path = path
+        self.key = hashlib.sha256(
+            json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+        self.done = set()
+
+    def load(self):
+        """Read the finished items from the file and return them."""
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return self.done
+        except (OSError, ValueError) as exc:
+            LOG.warning("Ignoring unreadable checkpoint %s: %s",
+                        self.path, exc)
+            return self.done
+        if (not isinstance(state, dict) or
+                state.get("version") != FORMAT_VERSION or
+                state.get("key") != self.key or
+                not isinstance(state.get("done"), list)):
+            LOG.warning("Ignoring checkpoint %s of a different task",
+                        self.path)
+            return self.done
+        self.done = set(state["done"])
+        return self.done
+
+    def add(self, item):
+        """Mark an item as finished and write the file.
+
+        :param item: JSON serializable item, e.g. an index
+        :type item: object
+        """
+        self.done.add(item)
+        state = {"version": FORMAT_VERSION, "key": self.key,
+                 "done": sorted(self.done)}
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def remove(self):
+        """Remove the file once the task is finished."""
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.done = set()
@@ -0,0 +1,176 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import time
+
+
+LOG = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def default_cache_dir():
+    """Return the directory for cache files of the current user."""
+    base = os.environ.get("XDG_CACHE_HOME")
+    if not base:
+        base = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "observabilityclient")
+
+
+class DiskCache(object):
+    """Cache of label values shared between processes.
+
+    Every entry is stored in its own file. The first line of the file
+    is a JSON header describing the entry, the second line is a JSON
+    list of the values. Files are replaced atomically, so concurrent
+    readers see either the old or the new entry. Entries, which can't
+    be read, don't match the header or are expired are ignored.
+
+    :param directory: Directory of the cache files, default_cache_dir()
+                      if None
+    :type directory: str
+    :param ttl: Number of seconds after which an entry expires
+    :type ttl: float
+    :param clock: Function returning the current unix time
+    :type clock: callable
+    """
+
+    def __init__(self, directory=None, ttl=300, clock=time.time):
+        self.directory = directory or default_cache_dir()
+        self.ttl = ttl
+        self._clock = clock
+
+    def _header(self, label, host, project):
+        return {"version": FORMAT_VERSION, "label": label,
+                "host": host, "project": project}
+
+    def _path(self, label, host, project):
+        key = json.dumps([label, host, project])
+        name = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        return os.path.join(self.directory, f"{name}.cache")
+
+    def load(self, label, host, project=None):
+        """Return the cached values of a label or None on a miss.
+
+        :param label: Name of the label, "__name__" for metric names
+        :type label: str
+        :param host: Prometheus host and port the values come from
+        :type host: str
+        :param project: Series selector, which restricted the values
+        :type project: str
+        """
+        path = self._path(label, host, project)
+        try:
+            with open(path, encoding='utf-8') as f:
+                header = json.loads(f.readline())
+                values = json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+        expected = self._header(label, host, project)
+        if (not isinstance(header, dict) or
+                any(header.get(k) != v for k, v in expected.items()) or
+                not isinstance(values, list) or
+                header.get("count") != len(values)):
+            LOG.debug("Ignoring invalid cache file %s", path)
+            return None
+        created = header.get("created")
+        if (not isinstance(created, (int, float)) or
+                created + self.ttl <= self._clock()):
+            return None
+        return values
+
+    def store(self, label, host, project, values):
+        """Store values of a label.
+
+        Failures to write the file are logged and ignored.
+
+        :param label: Name of the label, "__name__" for metric names
+        :type label: str
+        :param host: Prometheus host and port the values come from
+        :type host: str
+        :param project: Series selector, which restricted the values
+        :type project: str
+        :param values: Values of the label, stored sorted and
+                       without duplicates
+        :type values: [str]
+        """
+        # NOTE Sorted values let readers build indexes cheaply
+        values = sorted(set(values))
+        header = self._header(label, host, project)
+        header["created"] = self._clock()
+        header["count"] = len(values)
+        path = self._path(label, host, project)
+        try:
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory,
+                                            suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    f.write(json.dumps(header))
+                    f.write("\n")
+                    f.write(json.dumps(values))
+                    f.write("\n")
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as exc:
+            LOG.debug("Failed to write cache file %s: %s", path, exc)
+
+    def load_all(self, label, host):
+        """Return the cached values of a label for any project.
+
+        It's meant for callers, which don't know the project, like
+        shell completion. The values of all valid entries are merged.
+
+        :param label: Name of the label, "__name__" for metric names
+        :type label: str
+        :param host: Prometheus host and port the values come from
+        :type host: str
+        """
+        try:
+            file_names = os.listdir(self.directory)
+        except OSError:
+            return []
+        entries = []
+        for file_name in file_names:
+            if not file_name.endswith(".cache"):
+                continue
+            path = os.path.join(self.directory, file_name)
+            try:
+                with open(path, encoding='utf-8') as f:
+                    header = json.loads(f.readline())
+            except (OSError, ValueError):
+                continue
+            if (isinstance(header, dict) and header.get("label") == label and
+                    header.get("host") == host):
+                entry = self.load(label, host, header.get("project"))
+                if entry is not None:
+                    entries.append(entry)
+        if len(entries) == 1:
+            return entries[0]
+        return sorted(set(itertools.chain.from_iterable(entries)))
+
+    def invalidate(self, label, host, project=None):
+        """Remove the cached values of a label."""
+        try:
+            os.unlink(self._path(label, host, project))
+        except FileNotFoundError:
+            pass
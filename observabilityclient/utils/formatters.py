@@ -0,0 +1,34 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import json
+
+from cliff.formatters import base
+
+
+class NDJSONFormatter(base.ListFormatter):
+    """Newline delimited JSON, one object per row.
+
+    Rows are written as they are produced, so the output of streamed
+    results starts right away and isn't kept in memory.
+    """
+
+    def add_argument_group(self, parser):
+        pass
+
+    def emit_list(self, column_names, data, stdout, parsed_args):
+        column_names = list(column_names)
+        for row in data:
+            stdout.write(json.dumps(dict(zip(column_names, row))))
+            stdout.write("\n")
@@ -12,58 +12,217 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import bisect
+import copy
+import io
+import itertools
+import json
 import logging
+import operator
 import os
+import re
+import threading
 
-import yaml
+from observabilityclient.utils.cache import TTLCache
+from observabilityclient.utils.disk_cache import DiskCache
 
-from observabilityclient.prometheus_client import PrometheusAPIClient
+# NOTE yaml and the prometheus client are imported in the functions
+#      using them. This module is imported by the CLI commands, which
+#      are loaded for every openstack command, not just the metric ones.
 
-
-DEFAULT_CONFIG_LOCATIONS = [os.environ["HOME"] + "/.config/openstack/",
-                            "/etc/openstack/"]
 CONFIG_FILE_NAME = "prometheus.yaml"
+# Optional prometheus.yaml keys passed to PrometheusAPIClient
+CLIENT_OPTIONS = ('pool_connections', 'pool_maxsize', 'timeout', 'retries',
+                  'backoff_factor', 'compression', 'keep_alive',
+                  'max_range_points', 'range_split_interval', 'max_workers',
+                  'post_threshold', 'range_cache_size',
+                  'range_cache_freshness')
 LOG = logging.getLogger(__name__)
 
+# Parsed configuration files, keyed by path and modification time
+_configs = {}
+_config_lock = threading.Lock()
+# Shared PrometheusAPIClients, keyed by the resolved configuration.
+# The connections of the least recently used clients are closed.
+MAX_SHARED_CLIENTS = 8
+_clients = TTLCache(maxsize=MAX_SHARED_CLIENTS,
+                    on_remove=lambda key, client: client.close())
+_clients_lock = threading.Lock()
+
+# Metric name being typed at the end of a query
+_PARTIAL_NAME_REGEX = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*$')
+
 
 class ConfigurationError(Exception):
     pass
 
 
-def get_config_file():
+def get_default_config_locations():
+    """Return the directories searched for the configuration file."""
+    return [os.path.expanduser("~") + "/.config/openstack/",
+            "/etc/openstack/"]
+
+
+def __getattr__(name):
+    # NOTE DEFAULT_CONFIG_LOCATIONS depends on the environment, so it's
+    #      computed on access instead of at import time.
+    if name == "DEFAULT_CONFIG_LOCATIONS":
+        return get_default_config_locations()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def find_config_file():
+    """Return the path of the configuration file or None."""
     if os.path.exists(CONFIG_FILE_NAME):
-        LOG.debug("Using %s as prometheus configuration", CONFIG_FILE_NAME)
-        return open(CONFIG_FILE_NAME, "r")
-    for path in DEFAULT_CONFIG_LOCATIONS:
+        return CONFIG_FILE_NAME
+    for path in get_default_config_locations():
         full_filename = path + CONFIG_FILE_NAME
         if os.path.exists(full_filename):
-            LOG.debug("Using %s as prometheus configuration", full_filename)
-            return open(full_filename, "r")
+            return full_filename
     return None
 
 
-def get_prometheus_client():
-    host = None
-    port = None
+def get_config_file():
+    path = find_config_file()
+    if path is None:
+        return None
+    LOG.debug("Using %s as prometheus configuration", path)
+    return open(path, "r")
+
+
+def _config_file_key(conf_file):
+    try:
+        stat = os.fstat(conf_file.fileno())
+    except (OSError, TypeError, ValueError, io.UnsupportedOperation):
+        return None
+    return (conf_file.name, stat.st_dev, stat.st_ino,
+            stat.st_mtime_ns, stat.st_size)
+
+
+def load_config_file(conf_file):
+    """Parse an open prometheus.yaml file.
+
+    The parsed configuration is memoized by the file's path and
+    modification time, so the file is parsed again only after
+    it changes.
+    """
+    import yaml
+
+    key = _config_file_key(conf_file)
+    with _config_lock:
+        conf = _configs.get(key) if key is not None else None
+    if conf is None:
+        conf = yaml.safe_load(conf_file) or {}
+        if key is not None:
+            with _config_lock:
+                _configs.clear()
+                _configs[key] = conf
+    return copy.deepcopy(conf)
+
+
+def get_prometheus_config():
+    conf = {}
     conf_file = get_config_file()
     if conf_file is not None:
-        conf = yaml.safe_load(conf_file)
-        if 'host' in conf:
-            host = conf['host']
-        if 'port' in conf:
-            port = conf['port']
-        conf_file.close()
+        try:
+            conf = load_config_file(conf_file)
+        finally:
+            conf_file.close()
 
     # NOTE(jwysogla): We allow to overide the prometheus.yaml by
     #                 the environment variables
     if 'PROMETHEUS_HOST' in os.environ:
-        host = os.environ['PROMETHEUS_HOST']
+        conf['host'] = os.environ['PROMETHEUS_HOST']
     if 'PROMETHEUS_PORT' in os.environ:
-        port = os.environ['PROMETHEUS_PORT']
+        conf['port'] = os.environ['PROMETHEUS_PORT']
+    return conf
+
+
+def get_prometheus_address(conf=None):
+    if conf is None:
+        conf = get_prometheus_config()
+    host = conf.get('host')
+    port = conf.get('port')
     if host is None or port is None:
         raise ConfigurationError("Can't find prometheus host and "
                                  "port configuration.")
-    return PrometheusAPIClient(f"{host}:{port}")
+    return f"{host}:{port}"
+
+
+def get_prometheus_client_options(conf):
+    """Return PrometheusAPIClient keyword arguments set in conf."""
+    options = {key: conf[key] for key in CLIENT_OPTIONS if key in conf}
+    if 'connect_timeout' in conf or 'read_timeout' in conf:
+        options['timeout'] = (conf.get('connect_timeout'),
+                              conf.get('read_timeout'))
+    return options
+
+
+def get_disk_cache_options(conf=None):
+    """Return DiskCache keyword arguments set in conf.
+
+    The disk cache is enabled by a positive disk_cache_ttl, None is
+    returned if it's disabled.
+    """
+    if conf is None:
+        conf = get_prometheus_config()
+    ttl = conf.get('disk_cache_ttl')
+    if not ttl or float(ttl) <= 0:
+        return None
+    return {'ttl': float(ttl)}
+
+
+def get_prometheus_client(shared=True):
+    """Return a client for the configured prometheus.
+
+    Clients created from the same resolved configuration are shared
+    within the process, so they reuse the pooled connections. Changes
+    to a shared client, like set_ca_cert(), affect all of its users.
+    Up to MAX_SHARED_CLIENTS configurations are kept, the connections
+    of the least recently used one are closed when there are more.
+    clear_prometheus_clients() closes the connections of all of them.
+
+    :param shared: Create a new client instead of the shared one
+                   if set to False
+    :type shared: boolean
+    """
+    from observabilityclient.prometheus_client import PrometheusAPIClient
+
+    conf = get_prometheus_config()
+    address = get_prometheus_address(conf)
+    if not shared:
+        return PrometheusAPIClient(address,
+                                   **get_prometheus_client_options(conf))
+    key = (address, tuple(sorted((str(k), repr(v))
+                                 for k, v in conf.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = PrometheusAPIClient(
+                address, **get_prometheus_client_options(conf))
+            _clients.put(key, client)
+    return client
+
+
+def clear_prometheus_clients():
+    """Close and forget the shared clients and the memoized configuration.
+
+    The clients stay usable by their current users, they just don't
+    keep idle connections open anymore.
+    """
+    with _clients_lock:
+        _clients.invalidate()
+    with _config_lock:
+        _configs.clear()
+
+
+def get_async_prometheus_client(**kwargs):
+    # NOTE: aiohttp is an optional dependency, so the async client
+    #       is imported only when it's requested.
+    from observabilityclient.async_prometheus_client import (
+        AsyncPrometheusAPIClient
+    )
+    return AsyncPrometheusAPIClient(get_prometheus_address(), **kwargs)
 
 
 def get_client(obj):
@@ -89,19 +248,259 @@ def format_labels(d: dict) -> str:
     return ret
 
 
+class MetricNameIndex(object):
+    """Sorted, immutable collection of metric names.
+
+    :param names: Metric names, duplicates are removed
+    :type names: iterable of str
+    :param version: Number identifying this snapshot of metric names,
+                    a new unique number is assigned if None
+    :type version: int
+    """
+
+    _versions = itertools.count(1)
+
+    def __init__(self, names, version=None):
+        self.names = tuple(sorted(set(names)))
+        if version is None:
+            version = next(self._versions)
+        self.version = version
+        self._lookup = frozenset(self.names)
+
+    def __contains__(self, name):
+        return name in self._lookup
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def prefix(self, prefix):
+        """Return the names starting with prefix in sorted order."""
+        return prefix_search(self.names, prefix)
+
+
+def prefix_search(names, prefix):
+    """Return the strings starting with prefix from a sorted sequence."""
+    first = bisect.bisect_left(names, prefix)
+    # NOTE Every name starting with prefix sorts before prefix
+    #      followed by the highest code point.
+    last = bisect.bisect_left(names, prefix + chr(0x10ffff), first)
+    return list(names[first:last])
+
+
+def _completion_config(cache):
+    """Return the prometheus address and the disk cache options.
+
+    Importing yaml takes longer than the rest of the completion, so
+    when the disk cache is enabled, both are remembered in it for every
+    version of the configuration file.
+    """
+    key = [os.environ.get('PROMETHEUS_HOST'),
+           os.environ.get('PROMETHEUS_PORT')]
+    path = find_config_file()
+    if path is not None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            path = None
+        else:
+            key += [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+    key = json.dumps(key)
+    cached = cache.load("completion", key) if path is not None else None
+    if cached:
+        return tuple(json.loads(cached[0]))
+    conf = get_prometheus_config()
+    address = get_prometheus_address(conf)
+    options = get_disk_cache_options(conf)
+    if options is not None and path is not None:
+        cache.store("completion", key, None,
+                    [json.dumps([address, options])])
+    return address, options
+
+
+def complete_metric_names(prefix):
+    """Complete the metric name at the end of prefix.
+
+    With the disk cache enabled by disk_cache_ttl, the names are served
+    from it. When it has no names for the configured prometheus yet,
+    they're fetched once with label_values("__name__") and stored, so
+    later completions don't contact prometheus and stay fast even for
+    large catalogs. Without the disk cache, the names are fetched for
+    every completion and nothing is written to disk.
+
+    :param prefix: Text of the argument typed so far
+    :type prefix: str
+    """
+    try:
+        host, options = _completion_config(DiskCache())
+    except ConfigurationError:
+        return []
+    match = _PARTIAL_NAME_REGEX.search(prefix)
+    partial = match.group() if match else ""
+    head = prefix[:len(prefix) - len(partial)]
+    cache = DiskCache(**options) if options is not None else None
+    # The cached names are sorted, building an index isn't worth it
+    names = cache.load_all("__name__", host) if cache is not None else []
+    if not names:
+        try:
+            names = get_prometheus_client().label_values("__name__")
+        except Exception as exc:  # noqa: B902
+            # Completion must not fail the shell
+            LOG.debug("Failed to fetch metric names: %s", exc)
+            return []
+        if cache is not None:
+            cache.store("__name__", host, None, names)
+        names = sorted(set(names))
+    return [head + name for name in prefix_search(names, partial)]
+
+
+def metrics2rows(metrics):
+    """Return column names and a generator of rows of metrics.
+
+    Unlike metrics2cols(), the metrics are consumed one at a time while
+    the rows are read, so streamed results are never held in memory.
+    The columns are the labels of the first metric. Labels missing in
+    later metrics are left empty, additional labels are left out.
+    Series of matrix results are turned into a row per sample with
+    the timestamp and value columns, like in range2cols().
+
+    :param metrics: Metrics, e.g. returned by QueryManager.query_iter()
+    :type metrics: iterable of PrometheusMetric or RangeSeries
+    :returns: Tuple of the column names and a generator of rows
+    """
+    from observabilityclient.prometheus_client import RangeSeries
+
+    metrics = iter(metrics)
+    first = next(metrics, None)
+    if first is None:
+        return [], iter(())
+    if isinstance(first, RangeSeries):
+        return _series2rows(first, metrics)
+    keys = first.label_keys
+
+    def rows():
+        yield list(first.label_values) + [first.value]
+        warned = False
+        for metric in metrics:
+            if metric.label_keys == keys:
+                yield list(metric.label_values) + [metric.value]
+                continue
+            labels = metric.labels
+            if not warned and not labels.keys() <= set(keys):
+                LOG.warning("Metrics have different labels, labels "
+                            "missing in the first metric aren't shown")
+                warned = True
+            yield [labels.get(key, '') for key in keys] + [metric.value]
+
+    return list(keys) + ["value"], rows()
+
+
+def _series2rows(first, series_iter):
+    keys = list(first.labels)
+
+    def rows():
+        warned = False
+        for series in itertools.chain([first], series_iter):
+            labels = series.labels
+            if not warned and not labels.keys() <= set(keys):
+                LOG.warning("Series have different labels, labels "
+                            "missing in the first series aren't shown")
+                warned = True
+            prefix = [labels.get(key, '') for key in keys]
+            for timestamp, value in series.samples():
+                yield prefix + [timestamp, value]
+
+    return keys + ["timestamp", "value"], rows()
+
+
 def metrics2cols(m):
-    cols = []
+    """Convert metrics into column names and rows.
+
+    The columns are the union of the labels of all metrics in the order,
+    in which they're first seen, followed by the value. Labels missing
+    in a metric are left empty. The column positions are computed once
+    per distinct set of labels, metrics sharing their label keys, like
+    the ones returned by a single query, are converted without looking
+    at the labels at all.
+
+    :param m: Metrics to convert
+    :type m: iterable of PrometheusMetric
+    :returns: Tuple of the column names and a list of rows
+    """
+    metrics = m if isinstance(m, list) else list(m)
+    if not metrics:
+        return [], []
+
+    # NOTE The key tuples are usually shared between the metrics of
+    #      a result, so they're looked up by identity first. The
+    #      metrics keep the tuples alive, so the ids stay unique.
+    schemas_by_id = {}
+    schemas = {}
+    union = {}
+    for metric in metrics:
+        keys = metric.label_keys
+        if id(keys) in schemas_by_id:
+            continue
+        schemas_by_id[id(keys)] = keys
+        if keys not in schemas:
+            schemas[keys] = None
+            for key in keys:
+                union.setdefault(key, len(union))
+
+    width = len(union)
+    for keys in schemas:
+        if list(keys) == list(union):
+            # The metric has all of the labels in the column order
+            schemas[keys] = None
+            continue
+        # Index of each column in the label values, missing labels
+        # point past the values to the padding
+        index = {key: i for i, key in enumerate(keys)}
+        gather = [index.get(key, len(keys)) for key in union]
+        if width > 1:
+            schemas[keys] = operator.itemgetter(*gather)
+        else:
+            schemas[keys] = lambda values, i=gather[0]: (values[i],)
+    getters_by_id = {key_id: schemas[keys]
+                     for key_id, keys in schemas_by_id.items()}
+
     fields = []
-    first = True
-    for metric in m:
-        row = []
-        for key, value in metric.labels.items():
-            if first:
-                cols.append(key)
-            row.append(value)
-        if first:
-            cols.append("value")
+    for metric in metrics:
+        getter = getters_by_id[id(metric.label_keys)]
+        if getter is None:
+            row = list(metric.label_values)
+        else:
+            row = list(getter(metric.label_values + ('',)))
         row.append(metric.value)
         fields.append(row)
-        first = False
-    return cols, fields
+    return list(union) + ["value"], fields
+
+
+def range2cols(result):
+    """Convert a matrix result into column names and rows.
+
+    Every sample is a row. Like in metrics2cols(), the columns are the
+    union of the labels of all series in the order, in which they're
+    first seen, followed by the timestamp and the value. Labels missing
+    in a series are left empty.
+
+    :param result: Result of a range query
+    :type result: RangeResult
+    :returns: Tuple of the column names and a list of rows
+    """
+    series_list = list(result)
+    if not series_list:
+        return [], []
+    union = {}
+    for series in series_list:
+        for key in series.labels:
+            union.setdefault(key, len(union))
+    fields = []
+    for series in series_list:
+        labels = series.labels
+        prefix = [labels.get(key, '') for key in union]
+        for timestamp, value in series.samples():
+            fields.append(prefix + [timestamp, value])
+    return list(union) + ["timestamp", "value"], fields
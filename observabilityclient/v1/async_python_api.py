@@ -0,0 +1,185 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import asyncio
+
+from observabilityclient.utils import metric_utils
+from observabilityclient.utils.metric_utils import MetricNameIndex
+from observabilityclient.v1.python_api import metric_name_match
+from observabilityclient.v1.python_api import QueryResult
+
+
+class AsyncQueryManager(object):
+    """Asyncio variant of the QueryManager.
+
+    The rbac settings and the metric name cache are shared with
+    the synchronous client.
+
+    :param client: Client providing rbac and the metric name cache
+    :type client: observabilityclient.v1.client.Client
+    :param prometheus_client: Client used to talk to prometheus.
+                              Created from the configuration if None.
+    :type prometheus_client: AsyncPrometheusAPIClient
+    """
+
+    def __init__(self, client, prometheus_client=None):
+        self.client = client
+        if prometheus_client is None:
+            prometheus_client = metric_utils.get_async_prometheus_client()
+        self.prom = prometheus_client
+
+    async def close(self):
+        """Close the connections of the prometheus client."""
+        await self.prom.close()
+
+    async def metric_name_index(self, disable_rbac=False):
+        """Return an index of metric names.
+
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        """
+        match = metric_name_match(self.client, disable_rbac)
+        cache = self.client.metric_name_cache
+        index = cache.get(match)
+        if index is None:
+            metric_names = await self.prom.label_values("__name__",
+                                                        matches=match)
+            index = MetricNameIndex(metric_names)
+            cache.put(match, index)
+        return index
+
+    async def _enrich_query(self, query, disable_rbac):
+        if disable_rbac:
+            return query
+        index = await self.metric_name_index()
+        return self.client.rbac.enrich_query(query, metric_names=index)
+
+    async def _optimize(self, query):
+        optimizer = self.client.query_optimizer
+        if optimizer is None:
+            return query
+        # NOTE The series estimates are fetched with the synchronous
+        #      client, so they mustn't block the event loop.
+        loop = asyncio.get_running_loop()
+        plan = await loop.run_in_executor(None, optimizer.optimize, query)
+        return plan.query
+
+    async def list(self, disable_rbac=False):
+        """List metric names.
+
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        """
+        return list(await self.metric_name_index(disable_rbac=disable_rbac))
+
+    async def show(self, name, disable_rbac=False, time=None):
+        """Show current values for metrics of a specified name.
+
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :param time: Evaluation time, None for the current time
+        :type time: rfc3339 or unix_timestamp
+        """
+        enriched = self.client.rbac.append_rbac(name,
+                                                disable_rbac=disable_rbac)
+        last_metric_query = await self._optimize(
+            f"last_over_time({enriched}[5m])")
+        return await self.prom.query(last_metric_query, time=time)
+
+    async def query(self, query, disable_rbac=False, time=None):
+        """Send a query to prometheus.
+
+        See QueryManager.query() for details about the rbac enrichment.
+
+        :param query: Custom query string
+        :type query: str
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :param time: Evaluation time, None for the current time
+        :type time: rfc3339 or unix_timestamp
+        """
+        query = await self._enrich_query(query, disable_rbac)
+        query = await self._optimize(query)
+        return await self.prom.query(query, time=time)
+
+    async def query_many(self, queries, max_concurrency=8,
+                         disable_rbac=False):
+        """Send multiple queries to prometheus concurrently.
+
+        See QueryManager.query_many() for details.
+
+        :param queries: Custom query strings
+        :type queries: [str]
+        :param max_concurrency: Maximum number of queries sent at once
+        :type max_concurrency: int
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :returns: List of QueryResult in the order of queries
+        """
+        metric_names = None
+        if not disable_rbac:
+            metric_names = await self.metric_name_index()
+        semaphore = asyncio.Semaphore(max(max_concurrency, 1))
+
+        async def run(query):
+            try:
+                enriched = self.client.rbac.enrich_query(
+                    query, disable_rbac=disable_rbac,
+                    metric_names=metric_names)
+                enriched = await self._optimize(enriched)
+                async with semaphore:
+                    result = await self.prom.query(enriched)
+                return QueryResult(query, result, None)
+            except Exception as exc:  # noqa: B902
+                return QueryResult(query, None, exc)
+
+        return list(await asyncio.gather(*[run(q) for q in queries]))
+
+    async def query_range(self, query, start, end, step, disable_rbac=False):
+        """Send a range query to prometheus.
+
+        :param query: Custom query string
+        :type query: str
+        :param start: Timestamp of the first evaluation
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp of the last evaluation
+        :type end: rfc3339 or unix_timestamp
+        :param step: Evaluation step, duration or number of seconds
+        :type step: str or float
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        """
+        query = await self._enrich_query(query, disable_rbac)
+        query = await self._optimize(query)
+        return await self.prom.query_range(query, start, end, step)
+
+    async def delete(self, matches, start=None, end=None):
+        """Delete metrics from Prometheus.
+
+        :param matches: List of matches to match which metrics to delete
+        :type matches: [str]
+        :param start: timestamp from which to start deleting
+        :type start: rfc3339 or unix_timestamp
+        :param end: timestamp until which to delete
+        :type end: rfc3339 or unix_timestamp
+        """
+        return await self.prom.delete(matches, start, end)
+
+    async def clean_tombstones(self):
+        """Instruct prometheus to clean tombstones."""
+        return await self.prom.clean_tombstones()
+
+    async def snapshot(self):
+        """Create a snapshot of the current data."""
+        return await self.prom.snapshot()
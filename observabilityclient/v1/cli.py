@@ -14,12 +14,18 @@
 
 from cliff import lister
 
+from osc_lib import exceptions
 from osc_lib.i18n import _
 
 from observabilityclient.utils import metric_utils
 from observabilityclient.v1 import base
 
 
+# Defaults of the bulk delete options
+_BATCH_SIZE = 100
+_PARALLEL = 4
+
+
 class List(base.ObservabilityBaseCommand, lister.Lister):
     """Query prometheus for list of all metrics."""
 
@@ -37,10 +43,22 @@ class Show(base.ObservabilityBaseCommand, lister.Lister):
         parser.add_argument(
             'name',
             help=_("Name of the metric to show"))
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help=_("Print metrics as they are received instead of after "
+                   "the whole result is parsed. Use with a streaming "
+                   "formatter, e.g. -f csv or -f ndjson. The columns are "
+                   "the labels of the first metric."))
         return parser
 
     def take_action(self, parsed_args):
         client = metric_utils.get_client(self)
+        if parsed_args['stream']:
+            metrics = client.query.show_iter(
+                parsed_args['name'],
+                disable_rbac=parsed_args['disable_rbac'])
+            return metric_utils.metrics2rows(metrics)
         metric = client.query.show(parsed_args['name'],
                                    disable_rbac=parsed_args['disable_rbac'])
         ret = metric_utils.metrics2cols(metric)
@@ -55,12 +73,63 @@ class Query(base.ObservabilityBaseCommand, lister.Lister):
         parser.add_argument(
             'query',
             help=_("Custom PromQL query"))
+        parser.add_argument(
+            '--range',
+            action='store_true',
+            help=_("Evaluate the query over a range of time. "
+                   "Requires --start, --end and --step."))
+        parser.add_argument(
+            '--start',
+            help=_("Start timestamp of a range query in rfc3339 "
+                   "or unix timestamp."))
+        parser.add_argument(
+            '--end',
+            help=_("End timestamp of a range query in rfc3339 "
+                   "or unix timestamp."))
+        parser.add_argument(
+            '--step',
+            help=_("Evaluation step of a range query as a duration "
+                   "or number of seconds."))
+        parser.add_argument(
+            '--stream',
+            action='store_true',
+            help=_("Print metrics as they are received instead of after "
+                   "the whole result is parsed. Use with a streaming "
+                   "formatter, e.g. -f csv or -f ndjson. The columns are "
+                   "the labels of the first metric."))
         return parser
 
     def take_action(self, parsed_args):
         client = metric_utils.get_client(self)
+        if parsed_args['range']:
+            if parsed_args['stream']:
+                raise exceptions.CommandError(
+                    _("--stream can't be used with --range"))
+            if (parsed_args['start'] is None or parsed_args['end'] is None or
+                    parsed_args['step'] is None):
+                raise exceptions.CommandError(
+                    _("--start, --end and --step are required "
+                      "with --range"))
+            result = client.query.query_range(
+                parsed_args['query'],
+                parsed_args['start'],
+                parsed_args['end'],
+                parsed_args['step'],
+                disable_rbac=parsed_args['disable_rbac'])
+            return metric_utils.range2cols(result)
+        if parsed_args['stream']:
+            metrics = client.query.query_iter(
+                parsed_args['query'],
+                disable_rbac=parsed_args['disable_rbac'])
+            return metric_utils.metrics2rows(metrics)
         metric = client.query.query(parsed_args['query'],
                                     disable_rbac=parsed_args['disable_rbac'])
+        # NOTE The prometheus client is imported only when a command
+        #      runs, see metric_utils.
+        from observabilityclient.prometheus_client import RangeResult
+        if isinstance(metric, RangeResult):
+            # Queries of range vectors, e.g. "up[5m]", return a matrix
+            return metric_utils.range2cols(metric)
         ret = metric_utils.metrics2cols(metric)
         return ret
 
@@ -85,13 +154,146 @@ class Delete(base.ObservabilityBaseCommand):
             '--end',
             help=_("End timestamp in rfc3339 or unix timestamp. "
                    "Defaults to maximum possible timestamp."))
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=_BATCH_SIZE,
+            help=_("Delete the series in batches of at most this many "
+                   "selectors per request. Defaults to %d.") % _BATCH_SIZE)
+        parser.add_argument(
+            '--parallel',
+            type=int,
+            default=_PARALLEL,
+            help=_("Number of batches deleted concurrently. "
+                   "Defaults to %d.") % _PARALLEL)
+        parser.add_argument(
+            '--time-chunk',
+            help=_("Delete the time range in chunks of at most this "
+                   "duration or number of seconds. Requires --start "
+                   "and --end."))
+        parser.add_argument(
+            '--checkpoint',
+            help=_("File recording the deleted batches. Running the "
+                   "same delete again skips them. The file is removed "
+                   "once everything is deleted."))
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help=_("Don't delete anything, print the number of series "
+                   "matched by each selector and an estimate of their "
+                   "samples instead."))
+        parser.add_argument(
+            '--count-only',
+            action='store_true',
+            help=_("With --dry-run, count the series with count() "
+                   "queries instead of listing them. It's cheaper, but "
+                   "counts only series with a sample at the end time."))
+        parser.add_argument(
+            '--scrape-interval',
+            help=_("With --dry-run, the interval between two samples "
+                   "of a series used for estimating the samples. "
+                   "Defaults to 60 seconds."))
         return parser
 
     def take_action(self, parsed_args):
         client = metric_utils.get_client(self)
-        return client.query.delete(parsed_args['matches'],
-                                   parsed_args['start'],
-                                   parsed_args['end'])
+        # The selectors are collected by an appending, multi value
+        # argument, so they come as a list of lists.
+        matches = []
+        for match in parsed_args['matches']:
+            if isinstance(match, str):
+                matches.append(match)
+            else:
+                matches.extend(match)
+
+        self._check_options(parsed_args)
+        if parsed_args['dry_run']:
+            estimates = client.query.delete(
+                matches, parsed_args['start'], parsed_args['end'],
+                dry_run=True, count_only=parsed_args['count_only'],
+                scrape_interval=parsed_args['scrape_interval'] or 60)
+            series = 0
+            samples = 0
+            for estimate in estimates:
+                self.app.stdout.write(
+                    f"{estimate.match}: {estimate.series} series, "
+                    f"{self._samples(estimate.samples)} samples\n")
+                series += estimate.series
+                if samples is not None and estimate.samples is not None:
+                    samples += estimate.samples
+                else:
+                    samples = None
+            self.app.stdout.write(f"Total: {series} series, "
+                                  f"{self._samples(samples)} samples\n")
+            return
+
+        # A single batch is sent as a plain delete
+        if (len(matches) <= parsed_args['batch_size'] and
+                parsed_args['time_chunk'] is None and
+                parsed_args['checkpoint'] is None):
+            return client.query.delete(matches,
+                                       parsed_args['start'],
+                                       parsed_args['end'])
+        if (parsed_args['time_chunk'] is not None and
+                (parsed_args['start'] is None or parsed_args['end'] is None)):
+            raise exceptions.CommandError(
+                _("--start and --end are required with --time-chunk"))
+
+        def progress(result, finished, total):
+            if result.error is not None:
+                self.app.stderr.write(
+                    f"Failed to delete {len(result.matches)} selectors "
+                    f"from {result.start} to {result.end}: "
+                    f"{result.error}\n")
+            self.app.stderr.write(f"Deleted {finished}/{total} batches\n")
+
+        results = client.query.bulk_delete(
+            matches, parsed_args['start'], parsed_args['end'],
+            batch_size=parsed_args['batch_size'],
+            parallel=parsed_args['parallel'],
+            time_chunk=parsed_args['time_chunk'],
+            checkpoint=parsed_args['checkpoint'],
+            progress=progress)
+        failed = sum(1 for result in results if result.error is not None)
+        if failed:
+            raise exceptions.CommandError(
+                _("Failed to delete %(failed)d of %(total)d batches") %
+                {'failed': failed, 'total': len(results)})
+
+    @staticmethod
+    def _check_options(parsed_args):
+        for option in ('batch_size', 'parallel'):
+            if parsed_args[option] < 1:
+                raise exceptions.CommandError(
+                    _("--%s must be at least 1") % option.replace('_', '-'))
+        if parsed_args['dry_run']:
+            bulk_options = [
+                option for option, given in (
+                    ('--batch-size', parsed_args['batch_size'] != _BATCH_SIZE),
+                    ('--parallel', parsed_args['parallel'] != _PARALLEL),
+                    ('--time-chunk', parsed_args['time_chunk'] is not None),
+                    ('--checkpoint', parsed_args['checkpoint'] is not None))
+                if given]
+            if bulk_options:
+                raise exceptions.CommandError(
+                    _("%s can't be used with --dry-run") %
+                    ", ".join(bulk_options))
+        else:
+            dry_run_options = [
+                option for option, given in (
+                    ('--count-only', parsed_args['count_only']),
+                    ('--scrape-interval',
+                     parsed_args['scrape_interval'] is not None))
+                if given]
+            if dry_run_options:
+                raise exceptions.CommandError(
+                    _("%s can only be used with --dry-run") %
+                    ", ".join(dry_run_options))
+
+    @staticmethod
+    def _samples(samples):
+        # Without --start the length of the range isn't known
+        return "unknown" if samples is None else f"~{samples}"
 
 
 class CleanTombstones(base.ObservabilityBaseCommand):
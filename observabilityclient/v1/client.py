@@ -14,8 +14,14 @@
 
 import keystoneauth1.session
 
+from observabilityclient.prometheus_client import result_nbytes
+from observabilityclient.utils.cache import QueryCache
+from observabilityclient.utils.cache import TTLCache
+from observabilityclient.utils.disk_cache import DiskCache
 from observabilityclient.utils.metric_utils import get_prometheus_client
+from observabilityclient.v1 import async_python_api
 from observabilityclient.v1 import python_api
+from observabilityclient.v1 import query_optimizer
 from observabilityclient.v1 import rbac
 
 
@@ -23,10 +29,34 @@ class Client(object):
     """Client for the observabilityclient api."""
 
     def __init__(self, session=None, adapter_options=None,
-                 session_options=None, disable_rbac=False):
-        """Initialize a new client for the Observabilityclient v1 API."""
+                 session_options=None, disable_rbac=False,
+                 metric_name_cache_options=None, query_cache_options=None,
+                 disk_cache_options=None, query_optimizer_options=None):
+        """Initialize a new client for the Observabilityclient v1 API.
+
+        :param metric_name_cache_options: Keyword arguments for the
+            TTLCache of metric names, e.g. {'ttl': 60, 'maxsize': 16}
+        :type metric_name_cache_options: dict
+        :param query_cache_options: Keyword arguments for the QueryCache
+            of instant query results, e.g. {'ttl': 30, 'align': 15,
+            'max_bytes': 64 * 1024 * 1024}. None disables the cache.
+        :type query_cache_options: dict
+        :param disk_cache_options: Keyword arguments for the DiskCache
+            of metric names and label values shared between processes,
+            e.g. {'ttl': 300}. None disables the cache.
+        :type disk_cache_options: dict
+        :param query_optimizer_options: Keyword arguments for the
+            QueryOptimizer normalizing instant queries, e.g.
+            {'max_series': 10000}. None disables the optimizer.
+        :type query_optimizer_options: dict
+        """
         session_options = session_options or {}
         adapter_options = adapter_options or {}
+        # NOTE The option dicts are copied, so that adding the defaults
+        #      doesn't change the dicts of the caller.
+        metric_name_cache_options = dict(metric_name_cache_options or {})
+        metric_name_cache_options.setdefault('ttl', 60)
+        metric_name_cache_options.setdefault('maxsize', 16)
 
         adapter_options.setdefault('service_type', "metric")
 
@@ -39,5 +69,28 @@ class Client(object):
         self.session = session
 
         self.prometheus_client = get_prometheus_client()
+        self.metric_name_cache = TTLCache(**metric_name_cache_options)
+        self.disk_cache = None
+        if disk_cache_options is not None:
+            self.disk_cache = DiskCache(**disk_cache_options)
+        self.query_cache = None
+        if query_cache_options is not None:
+            query_cache_options = dict(query_cache_options)
+            query_cache_options.setdefault('weigher', result_nbytes)
+            self.query_cache = QueryCache(**query_cache_options)
+        self.query_optimizer = None
+        if query_optimizer_options is not None:
+            self.query_optimizer = query_optimizer.QueryOptimizer(
+                self.prometheus_client, **query_optimizer_options)
         self.query = python_api.QueryManager(self)
         self.rbac = rbac.Rbac(self, self.session, disable_rbac)
+
+    def get_async_query_manager(self, prometheus_client=None):
+        """Return a query manager with coroutine methods.
+
+        It requires the aiohttp library if prometheus_client isn't given.
+
+        :param prometheus_client: Client used to talk to prometheus
+        :type prometheus_client: AsyncPrometheusAPIClient
+        """
+        return async_python_api.AsyncQueryManager(self, prometheus_client)
@@ -12,40 +12,259 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import collections
+from concurrent import futures
+import time
+
+from observabilityclient.prometheus_client import to_seconds
+from observabilityclient.prometheus_client import to_timestamp
+from observabilityclient.utils.checkpoint import Checkpoint
 from observabilityclient.utils.metric_utils import format_labels
+from observabilityclient.utils.metric_utils import MetricNameIndex
 from observabilityclient.v1 import base
+from observabilityclient.v1.query_optimizer import QueryOptimizer
+
+
+def metric_name_match(client, disable_rbac=False):
+    """Return the series selector restricting metric names to the project.
+
+    None is returned if the metric names shouldn't be restricted.
+    """
+    if disable_rbac or client.rbac.disable_rbac:
+        return None
+    return f"{{{format_labels(client.rbac.default_labels)}}}"
+
+
+class QueryResult(collections.namedtuple('QueryResult',
+                                         ['query', 'result', 'error'])):
+    """Outcome of a single query sent by query_many().
+
+    Exactly one of result and error is set.
+    """
+
+    __slots__ = ()
+
+
+class DeleteResult(collections.namedtuple('DeleteResult',
+                                          ['matches', 'start', 'end',
+                                           'error'])):
+    """Outcome of a single chunk deleted by bulk_delete().
+
+    error is None if the chunk was deleted.
+    """
+
+    __slots__ = ()
+
+
+def delete_chunks(matches, start=None, end=None, batch_size=100,
+                  time_chunk=None):
+    """Split a delete request into chunks.
+
+    :param matches: Series selectors of the series to delete
+    :type matches: [str]
+    :param start: Timestamp from which to start deleting
+    :type start: rfc3339 or unix_timestamp
+    :param end: Timestamp until which to delete
+    :type end: rfc3339 or unix_timestamp
+    :param batch_size: Maximum number of selectors per chunk
+    :type batch_size: int
+    :param time_chunk: Maximum time range of a chunk, None to delete
+                       the whole range at once. It requires start
+                       and end.
+    :type time_chunk: str or float
+    :returns: List of (matches, start, end) tuples
+    """
+    if batch_size < 1:
+        raise ValueError("batch_size must be at least 1")
+    batches = [matches[i:i + batch_size]
+               for i in range(0, len(matches), batch_size)]
+    if time_chunk is None:
+        return [(batch, start, end) for batch in batches]
+    if start is None or end is None:
+        raise ValueError("time_chunk requires start and end")
+    start = to_timestamp(start)
+    end = to_timestamp(end)
+    time_chunk = to_seconds(time_chunk)
+    if time_chunk <= 0:
+        raise ValueError("time_chunk must be positive")
+    ranges = []
+    chunk_start = start
+    while True:
+        chunk_end = min(chunk_start + time_chunk, end)
+        ranges.append((chunk_start, chunk_end))
+        if chunk_end >= end:
+            break
+        chunk_start = chunk_end
+    return [(batch, chunk_start, chunk_end)
+            for batch in batches
+            for chunk_start, chunk_end in ranges]
+
+
+class DeleteEstimate(collections.namedtuple('DeleteEstimate',
+                                            ['match', 'series', 'samples'])):
+    """Estimated size of the data a selector would delete.
+
+    samples is None if the time range has no start.
+    """
+
+    __slots__ = ()
+
+
+def estimate_samples(series, start=None, end=None, scrape_interval=60):
+    """Estimate the number of samples of series in a time range.
+
+    :param series: Number of series
+    :type series: int
+    :param start: Start of the range, None for an open range
+    :type start: rfc3339 or unix_timestamp
+    :param end: End of the range, None for now
+    :type end: rfc3339 or unix_timestamp
+    :param scrape_interval: Seconds between two samples of a series
+    :type scrape_interval: str or float
+    """
+    if start is None:
+        return None
+    end = time.time() if end is None else to_timestamp(end)
+    span = max(end - to_timestamp(start), 0)
+    return round(series * span / to_seconds(scrape_interval))
 
 
 class QueryManager(base.Manager):
+    def metric_name_index(self, disable_rbac=False):
+        """Return an index of metric names.
+
+        The index is served from the client's metric name cache and
+        is fetched from prometheus only after the cached one expires.
+        Between processes the names are shared with the disk cache
+        if it's enabled.
+
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        """
+        match = metric_name_match(self.client, disable_rbac)
+        cache = self.client.metric_name_cache
+        index = cache.get(match)
+        if index is None:
+            index = MetricNameIndex(self._label_values("__name__", match))
+            cache.put(match, index)
+        return index
+
+    def _label_values(self, label, match):
+        disk_cache = self.client.disk_cache
+        if disk_cache is not None:
+            values = disk_cache.load(label, self.prom.host, match)
+            if values is not None:
+                return values
+        if match is None:
+            values = self.prom.label_values(label)
+        else:
+            values = self.prom.label_values(label, matches=match)
+        if disk_cache is not None:
+            disk_cache.store(label, self.prom.host, match, values)
+        return values
+
+    def label_values(self, label, disable_rbac=False):
+        """List values of a label.
+
+        The values are served from the client's disk cache if enabled.
+
+        :param label: Name of the label
+        :type label: str
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        """
+        match = metric_name_match(self.client, disable_rbac)
+        return self._label_values(label, match)
+
+    def invalidate_metric_names(self):
+        """Drop all cached metric names."""
+        self.client.metric_name_cache.invalidate()
+        disk_cache = self.client.disk_cache
+        if disk_cache is not None:
+            for match in {None, metric_name_match(self.client)}:
+                disk_cache.invalidate("__name__", self.prom.host, match)
+
+    def metric_name_cache_stats(self):
+        """Return size and hit / miss counters of the metric name cache."""
+        return self.client.metric_name_cache.stats()
+
+    def _cached_query(self, query, time=None, disable_rbac=False):
+        # NOTE Cached results are shared between the callers,
+        #      they must not be modified.
+        cache = self.client.query_cache
+        if cache is not None:
+            if time is not None:
+                time = to_timestamp(time)
+            time = cache.eval_time(time)
+            key = (query, time, metric_name_match(self.client, disable_rbac))
+            result = cache.get(key)
+            if result is not None:
+                return result
+        if time is None:
+            result = self.prom.query(query)
+        else:
+            result = self.prom.query(query, time=time)
+        if cache is not None:
+            cache.put(key, result)
+        return result
+
+    def _optimize(self, query):
+        optimizer = self.client.query_optimizer
+        if optimizer is None:
+            return query
+        return optimizer.optimize(query).query
+
+    def query_cache_stats(self):
+        """Return size and hit / miss counters of the query cache.
+
+        None is returned when the query cache isn't enabled.
+        """
+        if self.client.query_cache is None:
+            return None
+        return self.client.query_cache.stats()
+
+    def invalidate_query_cache(self):
+        """Drop all cached query results."""
+        if self.client.query_cache is not None:
+            self.client.query_cache.invalidate()
+
     def list(self, disable_rbac=False):
         """List metric names.
 
         :param disable_rbac: Disables rbac injection if set to True
         :type disable_rbac: boolean
         """
-        if disable_rbac or self.client.rbac.disable_rbac:
-            metric_names = self.prom.label_values("__name__")
-            return sorted(metric_names)
-        else:
-            match = f"{{{format_labels(self.client.rbac.default_labels)}}}"
-            metrics = self.prom.series(match)
-            if metrics == []:
-                return []
-            unique_metric_names = list(set([m['__name__'] for m in metrics]))
-            return sorted(unique_metric_names)
-
-    def show(self, name, disable_rbac=False):
+        return list(self.metric_name_index(disable_rbac=disable_rbac))
+
+    def show(self, name, disable_rbac=False, time=None):
         """Show current values for metrics of a specified name.
 
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :param time: Evaluation time, None for the current time
+        :type time: rfc3339 or unix_timestamp
+        """
+        enriched = self.client.rbac.append_rbac(name,
+                                                disable_rbac=disable_rbac)
+        last_metric_query = self._optimize(
+            f"last_over_time({enriched}[5m])")
+        return self._cached_query(last_metric_query, time, disable_rbac)
+
+    def show_iter(self, name, disable_rbac=False):
+        """Show current values of a metric and stream the result.
+
+        Same as show(), but the metrics are yielded one at a time.
+
         :param disable_rbac: Disables rbac injection if set to True
         :type disable_rbac: boolean
         """
         enriched = self.client.rbac.append_rbac(name,
                                                 disable_rbac=disable_rbac)
-        last_metric_query = f"last_over_time({enriched}[5m])"
-        return self.prom.query(last_metric_query)
+        last_metric_query = self._optimize(
+            f"last_over_time({enriched}[5m])")
+        return self.prom.query_iter(last_metric_query)
 
-    def query(self, query, disable_rbac=False):
+    def query(self, query, disable_rbac=False, time=None):
         """Send a query to prometheus.
 
         The query can be any PromQL query. Labels for enforcing
@@ -58,28 +277,158 @@ class QueryManager(base.Manager):
         "sum(name1{rbac='rbac_value'}) -
         sum(name2{label1='value', rbac='rbac_value'})"
 
+        When the client has a query cache, results are cached by
+        the enriched query, the evaluation time and the project.
+        When it has a query optimizer, the selectors of the query are
+        normalized and queries selecting more series than its budget
+        are rejected before they're sent. The optimizer is applied
+        the same way by all of the query and show methods.
+
         :param query: Custom query string
         :type query: str
         :param disable_rbac: Disables rbac injection if set to True
         :type disable_rbac: boolean
+        :param time: Evaluation time, None for the current time
+        :type time: rfc3339 or unix_timestamp
+        :raises QueryBudgetError: if the query selects more series
+                                  than the optimizer's budget
         """
         query = self.client.rbac.enrich_query(query, disable_rbac=disable_rbac)
-        return self.prom.query(query)
+        query = self._optimize(query)
+        return self._cached_query(query, time, disable_rbac)
 
-    def delete(self, matches, start=None, end=None):
+    def explain(self, query, disable_rbac=False):
+        """Return the plan of a query without sending it.
+
+        The query is enriched with rbac labels and normalized like in
+        query() and the series selected by each of its selectors are
+        estimated, even if the client's optimizer doesn't do it for
+        every query.
+
+        :param query: Custom query string
+        :type query: str
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :returns: QueryPlan
+        :raises QueryBudgetError: if the query selects more series
+                                  than the optimizer's budget
+        """
+        query = self.client.rbac.enrich_query(query, disable_rbac=disable_rbac)
+        optimizer = self.client.query_optimizer
+        if optimizer is None:
+            optimizer = QueryOptimizer(self.prom)
+        return optimizer.optimize(query, estimate=True)
+
+    def query_iter(self, query, disable_rbac=False):
+        """Send a query to prometheus and stream the result.
+
+        Same as query(), but the response is decoded incrementally
+        and the metrics are yielded one at a time.
+
+        :param query: Custom query string
+        :type query: str
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :raises QueryBudgetError: if the query selects more series
+                                  than the optimizer's budget
+        """
+        query = self.client.rbac.enrich_query(query, disable_rbac=disable_rbac)
+        query = self._optimize(query)
+        return self.prom.query_iter(query)
+
+    def query_many(self, queries, max_concurrency=8, disable_rbac=False):
+        """Send multiple queries to prometheus concurrently.
+
+        All queries are enriched with rbac labels against the same
+        snapshot of metric names. A failure of one query, including
+        a QueryBudgetError, doesn't affect the other ones.
+
+        :param queries: Custom query strings
+        :type queries: [str]
+        :param max_concurrency: Maximum number of queries sent at once
+        :type max_concurrency: int
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :returns: List of QueryResult in the order of queries
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+        metric_names = None
+        if not disable_rbac:
+            metric_names = self.metric_name_index()
+
+        def run(query):
+            try:
+                enriched = self.client.rbac.enrich_query(
+                    query, disable_rbac=disable_rbac,
+                    metric_names=metric_names)
+                enriched = self._optimize(enriched)
+                result = self._cached_query(enriched,
+                                            disable_rbac=disable_rbac)
+                return QueryResult(query, result, None)
+            except Exception as exc:  # noqa: B902
+                return QueryResult(query, None, exc)
+
+        workers = max(min(max_concurrency, len(queries)), 1)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(run, queries))
+
+    def query_range(self, query, start, end, step, disable_rbac=False):
+        """Send a range query to prometheus.
+
+        Rbac labels are added to the query the same way as in query().
+        The result is a RangeResult, which keeps the samples of each
+        series in float arrays.
+
+        :param query: Custom query string
+        :type query: str
+        :param start: Timestamp of the first evaluation
+        :type start: rfc3339 or unix_timestamp
+        :param end: Timestamp of the last evaluation
+        :type end: rfc3339 or unix_timestamp
+        :param step: Evaluation step, duration or number of seconds
+        :type step: str or float
+        :param disable_rbac: Disables rbac injection if set to True
+        :type disable_rbac: boolean
+        :raises QueryBudgetError: if the query selects more series
+                                  than the optimizer's budget
+        """
+        query = self.client.rbac.enrich_query(query, disable_rbac=disable_rbac)
+        query = self._optimize(query)
+        return self.prom.query_range(query, start, end, step)
+
+    def delete(self, matches, start=None, end=None, dry_run=False,
+               count_only=False, scrape_interval=60):
         """Delete metrics from Prometheus.
 
         The metrics aren't deleted immediately. Do a call to clean_tombstones()
         to speed up the deletion. If start and end isn't specified, then
         minimum and maximum timestamps are used.
 
+        With dry_run, nothing is deleted. The series matched by each
+        selector are counted instead, see estimate_delete().
+
         :param matches: List of matches to match which metrics to delete
         :type matches: [str]
         :param start: timestamp from which to start deleting
         :type start: rfc3339 or unix_timestamp
         :param end: timestamp until which to delete
         :type end: rfc3339 or unix_timestamp
+        :param dry_run: Return the estimates instead of deleting
+        :type dry_run: boolean
+        :param count_only: Count the series with count() queries,
+                           only used with dry_run
+        :type count_only: boolean
+        :param scrape_interval: Seconds between two samples of a series,
+                                only used with dry_run
+        :type scrape_interval: str or float
+        :returns: None or a list of DeleteEstimate with dry_run
         """
+        if dry_run:
+            return self.estimate_delete(matches, start, end,
+                                        count_only=count_only,
+                                        scrape_interval=scrape_interval)
         # TODO(jwysogla) Do we want to restrict access to the admin api
         #                endpoints? We could either try to inject
         #                the project label like in query. We could also
@@ -87,6 +436,134 @@ class QueryManager(base.Manager):
         #                it gets to prometheus.
         return self.prom.delete(matches, start, end)
 
+    def estimate_delete(self, matches, start=None, end=None,
+                        count_only=False, scrape_interval=60,
+                        max_concurrency=8):
+        """Estimate how much data a delete would remove.
+
+        The series matched by each selector are counted by streaming
+        them from the /series endpoint, so they're never held in memory.
+        With count_only, a count() query is sent instead, which avoids
+        transferring the series, but counts only the ones having
+        a sample at the end of the range. The samples are estimated
+        from the series, the length of the range and scrape_interval.
+
+        :param matches: Series selectors of a delete
+        :type matches: [str]
+        :param start: timestamp from which the delete would start
+        :type start: rfc3339 or unix_timestamp
+        :param end: timestamp until which the delete would go
+        :type end: rfc3339 or unix_timestamp
+        :param count_only: Count the series with count() queries
+        :type count_only: boolean
+        :param scrape_interval: Seconds between two samples of a series
+        :type scrape_interval: str or float
+        :param max_concurrency: Maximum number of selectors counted
+                                at once
+        :type max_concurrency: int
+        :returns: List of DeleteEstimate in the order of matches
+        """
+        matches = list(matches)
+        if not matches:
+            return []
+
+        def count(match):
+            if count_only:
+                if end is None:
+                    result = self.prom.query(f"count({match})")
+                else:
+                    result = self.prom.query(f"count({match})", time=end)
+                series = int(float(result[0].value)) if result else 0
+            else:
+                series = sum(1 for _ in self.prom.series_iter(
+                    [match], start=start, end=end))
+            samples = estimate_samples(series, start, end, scrape_interval)
+            return DeleteEstimate(match, series, samples)
+
+        workers = max(min(max_concurrency, len(matches)), 1)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(count, matches))
+
+    def bulk_delete(self, matches, start=None, end=None, batch_size=100,
+                    parallel=4, time_chunk=None, checkpoint=None,
+                    progress=None):
+        """Delete metrics from Prometheus in concurrent chunks.
+
+        It's meant for long lists of selectors, which don't fit into
+        a single delete() request. The selectors are split into batches
+        and optionally the time range into chunks, which are deleted
+        by a bounded pool of threads. A failure of one chunk doesn't
+        affect the other ones.
+
+        With a checkpoint file, finished chunks are recorded and skipped
+        when the same delete is run again, e.g. after an interruption.
+        The file is removed once all chunks are deleted.
+
+        :param matches: List of matches to match which metrics to delete
+        :type matches: [str]
+        :param start: timestamp from which to start deleting
+        :type start: rfc3339 or unix_timestamp
+        :param end: timestamp until which to delete
+        :type end: rfc3339 or unix_timestamp
+        :param batch_size: Maximum number of selectors per request
+        :type batch_size: int
+        :param parallel: Maximum number of requests sent at once
+        :type parallel: int
+        :param time_chunk: Maximum time range per request, duration or
+                           number of seconds. Requires start and end.
+        :type time_chunk: str or float
+        :param checkpoint: Path of the checkpoint file
+        :type checkpoint: str
+        :param progress: Function called with the DeleteResult, the
+                         number of finished chunks and the number of
+                         all chunks after every chunk
+        :type progress: callable
+        :returns: List of DeleteResult of the chunks sent, in order
+        """
+        matches = list(matches)
+        chunks = delete_chunks(matches, start, end, batch_size, time_chunk)
+        state = None
+        done = set()
+        if checkpoint is not None:
+            state = Checkpoint(checkpoint, [matches, start, end,
+                                            batch_size, time_chunk])
+            done = state.load()
+        pending = [index for index in range(len(chunks))
+                   if index not in done]
+        finished = len(chunks) - len(pending)
+
+        def run(chunk):
+            chunk_matches, chunk_start, chunk_end = chunk
+            try:
+                self.prom.delete(chunk_matches, chunk_start, chunk_end)
+                return DeleteResult(chunk_matches, chunk_start, chunk_end,
+                                    None)
+            except Exception as exc:  # noqa: B902
+                return DeleteResult(chunk_matches, chunk_start, chunk_end,
+                                    exc)
+
+        results = {}
+        workers = max(min(parallel, len(pending)), 1)
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            submitted = {executor.submit(run, chunks[index]): index
+                         for index in pending}
+            # NOTE The checkpoint and the progress are updated by this
+            #      thread only, the workers just send the requests.
+            for future in futures.as_completed(submitted):
+                index = submitted[future]
+                result = future.result()
+                results[index] = result
+                if result.error is None and state is not None:
+                    state.add(index)
+                finished += 1
+                if progress is not None:
+                    progress(result, finished, len(chunks))
+
+        ordered = [results[index] for index in sorted(results)]
+        if state is not None and all(r.error is None for r in ordered):
+            state.remove()
+        return ordered
+
     def clean_tombstones(self):
         """Instruct prometheus to clean tombstones."""
         return self.prom.clean_tombstones()
@@ -0,0 +1,241 @@
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+import collections
+import logging
+import re
+
+from observabilityclient.utils.cache import TTLCache
+from observabilityclient.v1 import rbac
+
+
+LOG = logging.getLogger(__name__)
+
+_METRIC_NAME_REGEX = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*\Z')
+_LABEL_NAME_REGEX = re.compile(r'[a-zA-Z_][a-zA-Z0-9_]*\Z')
+_IDENT_CHAR_REGEX = re.compile(r'[a-zA-Z0-9_:]')
+
+_QUOTE_ESCAPES = {'"': '\\"', '\\': '\\\\', '\a': '\\a', '\b': '\\b',
+                  '\f': '\\f', '\n': '\\n', '\r': '\\r', '\t': '\\t',
+                  '\v': '\\v'}
+
+# Identifiers, which would be read as keywords in front of a selector
+_KEYWORDS = rbac._AGGREGATORS | frozenset([
+    'and', 'or', 'unless', 'atan2', 'bool', 'by', 'without', 'on',
+    'ignoring', 'group_left', 'group_right', 'offset', 'inf', 'nan',
+    'start', 'end'
+])
+
+
+class QueryBudgetError(Exception):
+    """The query selects more series than the configured budget.
+
+    :param message: Description of the error
+    :type message: str
+    :param plan: Plan of the rejected query
+    :type plan: QueryPlan
+    """
+
+    def __init__(self, message, plan):
+        super().__init__(message)
+        self.plan = plan
+
+
+class SelectorEstimate(collections.namedtuple(
+        'SelectorEstimate', ['selector', 'occurrences', 'series'])):
+    """Distinct vector selector of a query.
+
+    series is the estimated number of series the selector matches,
+    or None if it wasn't estimated.
+    """
+
+    __slots__ = ()
+
+
+class QueryPlan(collections.namedtuple('QueryPlan',
+                                       ['query', 'selectors', 'series'])):
+    """Outcome of QueryOptimizer.optimize().
+
+    query is the normalized query, selectors a list of SelectorEstimate
+    in the order of their first occurrence and series the estimated
+    number of series selected by the whole query, or None if it wasn't
+    estimated.
+    """
+
+    __slots__ = ()
+
+
+def _quote(value):
+    """Return value as a double quoted PromQL string.
+
+    It's the inverse of rbac._unquote, bytes which aren't valid UTF-8
+    are written as hex escapes again.
+    """
+    parts = ['"']
+    for char in value:
+        if char in _QUOTE_ESCAPES:
+            parts.append(_QUOTE_ESCAPES[char])
+        elif '\udc80' <= char <= '\udcff':
+            parts.append(f"\\x{ord(char) - 0xdc00:02x}")
+        elif not char.isprintable():
+            code = ord(char)
+            parts.append(f"\\u{code:04x}" if code < 0x10000
+                         else f"\\U{code:08x}")
+        else:
+            parts.append(char)
+    parts.append('"')
+    return "".join(parts)
+
+
+def normalize_selector(selector):
+    """Return the canonical text of a vector selector.
+
+    Duplicate matchers are dropped, the rest is sorted and their values
+    are double quoted. A single {__name__="name"} matcher is turned into
+    a metric name, so all spellings of a selector get the same text.
+
+    :param selector: Vector selector of a parsed query
+    :type selector: rbac._VectorSelector
+    """
+    matchers = sorted({(m.label, m.op, m.value) for m in selector.matchers})
+    name = selector.name
+    if name is None:
+        names = [m for m in matchers if m[0] == '__name__']
+        if (len(names) == 1 and names[0][1] == '=' and
+                _METRIC_NAME_REGEX.match(names[0][2]) and
+                names[0][2].lower() not in _KEYWORDS):
+            name = names[0][2]
+            matchers.remove(names[0])
+    text = ", ".join(
+        f"{label if _LABEL_NAME_REGEX.match(label) else _quote(label)}"
+        f"{op}{_quote(value)}"
+        for label, op, value in matchers)
+    if name is None:
+        return f"{{{text}}}"
+    if not matchers:
+        return name
+    return f"{name}{{{text}}}"
+
+
+def _selector_end(selector):
+    if selector.close is None:
+        return selector.end
+    return selector.close + 1
+
+
+class QueryOptimizer(object):
+    """Normalizes queries and estimates how many series they select.
+
+    PromQL can't bind a subexpression to a name, so repeated selectors
+    are evaluated by prometheus once per occurrence. The optimizer
+    gives all occurrences of a selector the same canonical text, which
+    lets them share cached results and the series estimate, and
+    reports the fan-out of the query before it's sent.
+
+    The series are estimated with count(selector) queries, which are
+    cached for estimate_ttl seconds.
+
+    :param prometheus_client: Client for sending the estimate queries
+    :type prometheus_client: PrometheusAPIClient
+    :param estimate_series: Estimate the series of every query
+    :type estimate_series: boolean
+    :param max_series: Maximum number of series a query may select,
+                       None for no budget. Setting it implies
+                       estimate_series.
+    :type max_series: int
+    :param estimate_ttl: Number of seconds estimates are cached
+    :type estimate_ttl: float
+    :param estimate_cache_size: Maximum number of cached estimates
+    :type estimate_cache_size: int
+    """
+
+    def __init__(self, prometheus_client, estimate_series=False,
+                 max_series=None, estimate_ttl=300,
+                 estimate_cache_size=1024):
+        self.prom = prometheus_client
+        self.max_series = max_series
+        self.estimate_series = estimate_series or max_series is not None
+        self.estimate_cache = TTLCache(maxsize=estimate_cache_size,
+                                       ttl=estimate_ttl)
+
+    def estimate(self, selector):
+        """Return the number of series matched by a selector.
+
+        :param selector: Normalized vector selector
+        :type selector: str
+        """
+        series = self.estimate_cache.get(selector)
+        if series is None:
+            result = self.prom.query(f"count({selector})")
+            series = int(float(result[0].value)) if result else 0
+            self.estimate_cache.put(selector, series)
+        return series
+
+    def optimize(self, query, estimate=None):
+        """Normalize the selectors of a query and estimate its fan-out.
+
+        :param query: The query, already enriched with rbac labels
+        :type query: str
+        :param estimate: Whether to estimate the series, the configured
+                         estimate_series if None
+        :type estimate: boolean
+        :returns: QueryPlan
+        :raises ObservabilityRbacError: if the query can't be parsed
+        :raises QueryBudgetError: if the query selects more than
+                                  max_series series
+        """
+        if estimate is None:
+            estimate = self.estimate_series
+        tree = rbac._parse(query)
+        # NOTE Only the selectors are replaced, the formatting and
+        #      comments of the rest of the query are kept.
+        parts = []
+        copied = 0
+        occurrences = collections.OrderedDict()
+        for selector in rbac._vector_selectors(tree):
+            text = normalize_selector(selector)
+            occurrences[text] = occurrences.get(text, 0) + 1
+            parts.append(query[copied:selector.start])
+            copied = _selector_end(selector)
+            # NOTE A braced selector collapsed into a bare metric name
+            #      would merge with an adjacent identifier, e.g.
+            #      {__name__="up"}offset 5m
+            if (_IDENT_CHAR_REGEX.match(text[0]) and
+                    _IDENT_CHAR_REGEX.match(query[selector.start - 1:
+                                                  selector.start])):
+                parts.append(" ")
+            parts.append(text)
+            if (_IDENT_CHAR_REGEX.match(text[-1]) and
+                    _IDENT_CHAR_REGEX.match(query[copied:copied + 1])):
+                parts.append(" ")
+        parts.append(query[copied:])
+        normalized = "".join(parts)
+
+        selectors = []
+        total = 0 if estimate else None
+        for text, count in occurrences.items():
+            series = self.estimate(text) if estimate else None
+            if estimate:
+                # Every occurrence is evaluated separately
+                total += series * count
+            selectors.append(SelectorEstimate(text, count, series))
+        plan = QueryPlan(normalized, selectors, total)
+        LOG.debug("Query plan: %s", plan)
+
+        if (self.max_series is not None and total is not None and
+                total > self.max_series):
+            raise QueryBudgetError(
+                f"Query selects about {total} series, more than the "
+                f"budget of {self.max_series}: {query}", plan)
+        return plan
@@ -12,10 +12,12 @@
 #   License for the specific language governing permissions and limitations
 #   under the License.
 
+import collections
 import re
 
 from keystoneauth1.exceptions.auth_plugins import MissingAuthPlugin
 
+from observabilityclient.utils.cache import TTLCache
 from observabilityclient.utils.metric_utils import format_labels
 
 
@@ -23,11 +25,430 @@ class ObservabilityRbacError(Exception):
     pass
 
 
+_Token = collections.namedtuple('_Token', ['kind', 'text', 'start', 'end'])
+
+# One alternative per token kind, the group name is the kind. Punctuation
+# tokens use the punctuation itself as the kind.
+_TOKEN_REGEX = re.compile(r"""
+    (?P<space>\s+)
+  | (?P<comment>\#[^\n]*)
+  | (?P<string>"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|`[^`]*`)
+  | (?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?[a-zA-Z0-9_]*)
+  | (?P<ident>[a-zA-Z_:][a-zA-Z0-9_:]*)
+  | (?P<punct>[{}()\[\],])
+  | (?P<operator>=~|!~|!=|==|<=|>=|[-+*/%^=<>@:])
+  | (?P<other>.)
+""", re.VERBOSE | re.DOTALL)
+
+_AGGREGATORS = frozenset([
+    'sum', 'min', 'max', 'avg', 'group', 'stddev', 'stdvar', 'count',
+    'count_values', 'bottomk', 'topk', 'quantile', 'limitk', 'limit_ratio'
+])
+
+# Binary operators and their precedence, higher binds stronger
+_BINARY_OPERATORS = {
+    'or': 1,
+    'and': 2, 'unless': 2,
+    '==': 3, '!=': 3, '<=': 3, '<': 3, '>=': 3, '>': 3,
+    '+': 4, '-': 4,
+    '*': 5, '/': 5, '%': 5, 'atan2': 5,
+    '^': 6,
+}
+
+_MATCH_OPERATORS = frozenset(['=', '!=', '=~', '!~'])
+
+_STRING_ESCAPES = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n',
+                   'r': '\r', 't': '\t', 'v': '\v'}
+
+# Escape sequences of quoted strings, as accepted by Go's strconv.Unquote
+_ESCAPE_REGEX = re.compile(r"""\\(?:
+    (?P<char>[abfnrtv\\'"])
+  | x(?P<byte>[0-9a-fA-F]{2})
+  | (?P<octal>[0-7]{3})
+  | u(?P<short>[0-9a-fA-F]{4})
+  | U(?P<long>[0-9a-fA-F]{8})
+  | (?P<invalid>.?)
+)""", re.VERBOSE | re.DOTALL)
+
+
+def _tokenize(query):
+    """Split a PromQL query into a list of tokens in a single pass."""
+    tokens = []
+    for match in _TOKEN_REGEX.finditer(query):
+        kind = match.lastgroup
+        text = match.group()
+        if kind == 'punct':
+            kind = text
+        tokens.append(_Token(kind, text, match.start(), match.end()))
+    return tokens
+
+
+def _unquote(text):
+    """Return the value of a PromQL string literal.
+
+    Escapes are decoded like Go's strconv.Unquote, which is used by
+    prometheus. Hex and octal escapes are bytes of the UTF-8 encoded
+    value, bytes which aren't valid UTF-8 are kept as surrogate escapes.
+
+    :raises ObservabilityRbacError: if the string has a malformed escape
+    """
+    quote = text[0]
+    if quote == '`':
+        return text[1:-1]
+    if '\n' in text:
+        raise ObservabilityRbacError(f"Newline in string {text}")
+    value = bytearray()
+    copied = 1
+    for match in _ESCAPE_REGEX.finditer(text, 1, len(text) - 1):
+        value += text[copied:match.start()].encode('utf-8')
+        copied = match.end()
+        char = match.group('char')
+        if char is not None and char in '\'"' and char != quote:
+            char = None
+        if char is not None:
+            value += _STRING_ESCAPES.get(char, char).encode('utf-8')
+        elif match.group('byte') is not None:
+            value.append(int(match.group('byte'), 16))
+        elif (match.group('octal') is not None and
+                int(match.group('octal'), 8) < 256):
+            value.append(int(match.group('octal'), 8))
+        elif match.group('short') or match.group('long'):
+            code = int(match.group('short') or match.group('long'), 16)
+            if code > 0x10ffff or 0xd800 <= code <= 0xdfff:
+                raise ObservabilityRbacError(
+                    f"Invalid unicode escape {match.group()} in string "
+                    f"{text}")
+            value += chr(code).encode('utf-8')
+        else:
+            raise ObservabilityRbacError(
+                f"Invalid escape {match.group()} in string {text}")
+    value += text[copied:-1].encode('utf-8')
+    return value.decode('utf-8', 'surrogateescape')
+
+
+# Nodes of the syntax tree. Only vector selectors keep the details
+# needed for rewriting, the other nodes keep just their children.
+_Node = collections.namedtuple('_Node', ['kind', 'value', 'children'])
+
+_Matcher = collections.namedtuple('_Matcher', ['label', 'op', 'value',
+                                               'start', 'end'])
+
+_VectorSelector = collections.namedtuple('_VectorSelector', [
+    'start',       # Position of the first token of the selector
+    'name',        # Metric name in front of the braces or None
+    'matchers',    # Tuple of _Matcher
+    'end',         # Position after the name if there are no braces
+    'open',        # Position after "{" or None
+    'close',       # Position of "}" or None
+    'separated',   # Whether the last token before "}" is "{" or ","
+])
+
+
+class _Parser(object):
+    """Recursive descent parser of PromQL expressions."""
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = [token for token in _tokenize(query)
+                       if token.kind not in ('space', 'comment')]
+        self.pos = 0
+
+    def error(self, message):
+        token = self.peek()
+        where = "the end" if token is None else f"position {token.start}"
+        raise ObservabilityRbacError(
+            f"Can't parse query {self.query!r}: {message} at {where}")
+
+    def peek(self, offset=0):
+        pos = self.pos + offset
+        if pos < len(self.tokens):
+            return self.tokens[pos]
+        return None
+
+    def peek_kind(self, offset=0):
+        token = self.peek(offset)
+        return None if token is None else token.kind
+
+    def peek_keyword(self, offset=0):
+        token = self.peek(offset)
+        if token is None or token.kind != 'ident':
+            return None
+        return token.text.lower()
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            self.error("unexpected end of query")
+        self.pos += 1
+        return token
+
+    def expect(self, kind):
+        if self.peek_kind() != kind:
+            self.error(f"expected {kind!r}")
+        return self.next()
+
+    def parse(self):
+        expr = self.parse_expr(0)
+        if self.peek() is not None:
+            self.error(f"unexpected {self.peek().text!r}")
+        return expr
+
+    def binary_operator(self):
+        token = self.peek()
+        if token is None:
+            return None
+        if token.kind == 'operator' and token.text in _BINARY_OPERATORS:
+            return token.text
+        keyword = self.peek_keyword()
+        if keyword in ('and', 'or', 'unless', 'atan2'):
+            return keyword
+        return None
+
+    def parse_expr(self, min_precedence):
+        lhs = self.parse_unary()
+        while True:
+            op = self.binary_operator()
+            if op is None or _BINARY_OPERATORS[op] < min_precedence:
+                return lhs
+            self.next()
+            if self.peek_keyword() == 'bool':
+                self.next()
+            if self.peek_keyword() in ('on', 'ignoring'):
+                self.next()
+                self.parse_label_list()
+            if self.peek_keyword() in ('group_left', 'group_right'):
+                self.next()
+                if self.peek_kind() == '(':
+                    self.parse_label_list()
+            precedence = _BINARY_OPERATORS[op]
+            # "^" is right associative, the other operators are left
+            # associative
+            rhs = self.parse_expr(precedence if op == '^'
+                                  else precedence + 1)
+            lhs = _Node('binary', op, (lhs, rhs))
+
+    def parse_unary(self):
+        token = self.peek()
+        if (token is not None and token.kind == 'operator' and
+                token.text in ('+', '-')):
+            self.next()
+            return _Node('unary', token.text, (self.parse_unary(),))
+        return self.parse_postfix(self.parse_primary())
+
+    def parse_primary(self):
+        token = self.peek()
+        kind = self.peek_kind()
+        if kind in ('number', 'string'):
+            self.next()
+            return _Node(kind, token.text, ())
+        if kind == '(':
+            self.next()
+            expr = self.parse_expr(0)
+            self.expect(')')
+            return _Node('paren', None, (expr,))
+        if kind == '{':
+            return self.parse_selector(None)
+        if kind != 'ident':
+            self.error("expected an expression")
+        keyword = token.text.lower()
+        if keyword in _AGGREGATORS and (
+                self.peek_kind(1) == '(' or
+                self.peek_keyword(1) in ('by', 'without')):
+            return self.parse_aggregation()
+        if self.peek_kind(1) == '(':
+            self.next()
+            return _Node('call', token.text, self.parse_arguments())
+        if keyword in ('inf', 'nan'):
+            self.next()
+            return _Node('number', token.text, ())
+        if keyword in _BINARY_OPERATORS or keyword in ('by', 'without',
+                                                       'offset', 'bool'):
+            self.error(f"unexpected keyword {token.text!r}")
+        return self.parse_selector(self.next())
+
+    def parse_aggregation(self):
+        op = self.next().text
+        if self.peek_keyword() in ('by', 'without'):
+            self.next()
+            self.parse_label_list()
+        args = self.parse_arguments()
+        if self.peek_keyword() in ('by', 'without'):
+            self.next()
+            self.parse_label_list()
+        return _Node('aggregation', op, args)
+
+    def parse_arguments(self):
+        self.expect('(')
+        args = []
+        while self.peek_kind() != ')':
+            args.append(self.parse_expr(0))
+            if self.peek_kind() != ',':
+                break
+            self.next()
+        self.expect(')')
+        return tuple(args)
+
+    def parse_label_list(self):
+        self.expect('(')
+        while self.peek_kind() in ('ident', 'string'):
+            self.next()
+            if self.peek_kind() != ',':
+                break
+            self.next()
+        self.expect(')')
+
+    def parse_postfix(self, expr):
+        while True:
+            token = self.peek()
+            if token is None:
+                return expr
+            if token.kind == '[':
+                # Ranges and subquery steps are durations, which
+                # don't contain anything to rewrite.
+                self.next()
+                while self.peek_kind() not in (']', None):
+                    self.next()
+                close = self.expect(']')
+                text = self.query[token.end:close.start]
+                kind = 'subquery' if ':' in text else 'range'
+                expr = _Node(kind, text.strip(), (expr,))
+            elif self.peek_keyword() == 'offset':
+                self.next()
+                if self.peek_kind() == 'operator' and \
+                        self.peek().text in ('+', '-'):
+                    self.next()
+                self.expect('number')
+            elif token.kind == 'operator' and token.text == '@':
+                self.next()
+                if self.peek_keyword() in ('start', 'end'):
+                    self.next()
+                    self.expect('(')
+                    self.expect(')')
+                else:
+                    if self.peek_kind() == 'operator' and \
+                            self.peek().text in ('+', '-'):
+                        self.next()
+                    self.expect('number')
+            else:
+                return expr
+
+    def parse_selector(self, name_token):
+        name = None if name_token is None else name_token.text
+        if self.peek_kind() != '{':
+            return _VectorSelector(name_token.start, name, (),
+                                   name_token.end, None, None, False)
+        open_token = self.next()
+        matchers = []
+        separated = True
+        while True:
+            token = self.peek()
+            if token is None:
+                raise ObservabilityRbacError(
+                    f"Unterminated label section in query: {self.query}")
+            if token.kind == '}':
+                close = self.next()
+                break
+            if token.kind not in ('ident', 'string'):
+                self.error("expected a label matcher")
+            self.next()
+            label = token.text
+            if token.kind == 'string':
+                label = _unquote(label)
+            if token.kind == 'string' and self.peek_kind() in (',', '}'):
+                # A quoted metric name, e.g. {"metric.name"}
+                matchers.append(_Matcher('__name__', '=', label,
+                                         token.start, token.end))
+            else:
+                op = self.peek()
+                if (op is None or op.kind != 'operator' or
+                        op.text not in _MATCH_OPERATORS):
+                    self.error("expected a match operator")
+                self.next()
+                value = self.expect('string')
+                matchers.append(_Matcher(label, op.text,
+                                         _unquote(value.text),
+                                         token.start, value.end))
+            separated = self.peek_kind() == ','
+            if separated:
+                self.next()
+            elif self.peek_kind() not in ('}', None):
+                self.error("expected ',' or '}'")
+        if not matchers and name is None:
+            raise ObservabilityRbacError(
+                f"Empty vector selector in query: {self.query}")
+        start = open_token.start if name_token is None else name_token.start
+        return _VectorSelector(start, name, tuple(matchers), None,
+                               open_token.end, close.start, separated)
+
+
+def _parse(query):
+    """Parse a PromQL query into a syntax tree.
+
+    :raises ObservabilityRbacError: if the query isn't valid PromQL
+    """
+    return _Parser(query).parse()
+
+
+def _vector_selectors(node):
+    """Yield the vector selectors of a syntax tree in query order."""
+    if isinstance(node, _VectorSelector):
+        yield node
+        return
+    for child in node.children:
+        yield from _vector_selectors(child)
+
+
+def _rewrite_selector(query, selector, labels):
+    """Return an edit enforcing labels on a single vector selector.
+
+    Matchers of the enforced labels are replaced, so every label ends up
+    matched exactly once with "=". The edit is a (start, end, text)
+    tuple of the query slice to replace, or None if the selector
+    already matches exactly the labels.
+    """
+    enforced = [m for m in selector.matchers if m.label in labels]
+    if not enforced:
+        injected = format_labels(labels)
+        if selector.open is None:
+            return (selector.end, selector.end, f"{{{injected}}}")
+        if not selector.separated:
+            injected = f", {injected}"
+        return (selector.close, selector.close, injected)
+
+    seen = set()
+    unchanged = True
+    parts = []
+    for matcher in selector.matchers:
+        if matcher.label not in labels:
+            parts.append(query[matcher.start:matcher.end])
+        elif matcher.label in seen:
+            unchanged = False
+        else:
+            seen.add(matcher.label)
+            value = labels[matcher.label]
+            if matcher.op == '=' and matcher.value == value:
+                parts.append(query[matcher.start:matcher.end])
+            else:
+                parts.append(format_labels({matcher.label: value}))
+                unchanged = False
+    missing = {k: v for k, v in labels.items() if k not in seen}
+    if missing:
+        parts.append(format_labels(missing))
+        unchanged = False
+    if unchanged:
+        return None
+    return (selector.open, selector.close, ", ".join(parts))
+
+
 class Rbac():
-    def __init__(self, client, session, disable_rbac=False):
+    def __init__(self, client, session, disable_rbac=False,
+                 enrich_cache_size=1024):
         self.client = client
         self.session = session
         self.disable_rbac = disable_rbac
+        self.enrich_cache = None
+        if enrich_cache_size:
+            self.enrich_cache = TTLCache(maxsize=enrich_cache_size)
         try:
             self.project_id = self.session.get_project_id()
             self.default_labels = {
@@ -41,96 +462,77 @@ class Rbac():
             }
             self.rbac_init_successful = False
 
-    def _find_label_value_end(self, query, start, quote_char):
-        end = start
-        while (end == start or
-               query[end - 1] == '\\'):
-            # Looking for first unescaped quotes
-            end = query.find(quote_char, end + 1)
-        # returns the quote position or -1
-        return end
-
-    def _find_match_operator(self, query, start):
-        eq_sign_pos = query.find('=', start)
-        tilde_pos = query.find('~', start)
-        if eq_sign_pos == -1:
-            return tilde_pos
-        if tilde_pos == -1:
-            return eq_sign_pos
-        return min(eq_sign_pos, tilde_pos)
-
-    def _find_label_pair_end(self, query, start):
-        match_operator_pos = self._find_match_operator(query, start)
-        quote_char = "'"
-        quote_start_pos = query.find(quote_char, match_operator_pos)
-        if quote_start_pos == -1:
-            quote_char = '"'
-            quote_start_pos = query.find(quote_char, match_operator_pos)
-        end = self._find_label_value_end(query, quote_start_pos, quote_char)
-        # returns the pair end or -1
-        return end
-
-    def _find_label_section_end(self, query, start):
-        nearest_curly_brace_pos = None
-        while nearest_curly_brace_pos != -1:
-            pair_end = self._find_label_pair_end(query, start)
-            nearest_curly_brace_pos = query.find("}", pair_end)
-            nearest_match_operator_pos = self._find_match_operator(query,
-                                                                   pair_end)
-            if (nearest_curly_brace_pos < nearest_match_operator_pos or
-                    nearest_match_operator_pos == -1):
-                # If we have "}" before the nearest "=" or "~",
-                # then we must be at the end of the label section
-                # and the "=" or "~" is a part of the next section.
-                return nearest_curly_brace_pos
-            start = pair_end
-        return -1
-
-    def enrich_query(self, query, disable_rbac=False):
+    def enrich_query(self, query, disable_rbac=False, metric_names=None):
         """Add rbac labels to queries.
 
+        The query is parsed and every vector selector of a known metric
+        name, or without a metric name, is restricted to match the rbac
+        labels exactly once. Existing matchers of the rbac labels are
+        replaced. The rest of the query is kept as it was written.
+
         :param query: The query to enrich
         :type query: str
         :param disable_rbac: Disables rbac injection if set to True
         :type disable_rbac: boolean
+        :param metric_names: Metric names to look for in the query.
+                             Fetched with the query manager if None.
+        :type metric_names: MetricNameIndex
+        :raises ObservabilityRbacError: if the query can't be parsed
         """
-        # TODO(jwysogla): This should be properly tested
         if disable_rbac:
             return query
-        labels = self.default_labels
+        labels = format_labels(self.default_labels)
 
-        # We need to get all metric names, no matter the rbac
-        metric_names = self.client.query.list(disable_rbac=False)
-
-        # We need to detect the locations of metric names
-        # inside the query
-        # NOTE the locations are the locations within the original query
-        name_end_locations = []
-        for name in metric_names:
-            # Regex for a metric name is: [a-zA-Z_:][a-zA-Z0-9_:]*
-            # We need to make sure, that "name" isn't just a part
-            # of a longer word, so we try to expand it by "name_regex"
-            name_regex = "[a-zA-Z_:]?[a-zA-Z0-9_:]*" + name + "[a-zA-Z0-9_:]*"
-            potential_names = re.finditer(name_regex, query)
-            for potential_name in potential_names:
-                if potential_name.group(0) == name:
-                    name_end_locations.append(potential_name.end())
-
-        name_end_locations = sorted(name_end_locations, reverse=True)
-        for name_end_location in name_end_locations:
-            if (name_end_location < len(query) and
-               query[name_end_location] == "{"):
-                # There already are some labels
-                labels_end = self._find_label_section_end(query,
-                                                          name_end_location)
-                query = (f"{query[:labels_end]}, "
-                         f"{format_labels(labels)}"
-                         f"{query[labels_end:]}")
-            else:
-                query = (f"{query[:name_end_location]}"
-                         f"{{{format_labels(labels)}}}"
-                         f"{query[name_end_location:]}")
-        return query
+        if metric_names is None:
+            # We need to get all metric names, no matter the rbac
+            metric_names = self.client.query.metric_name_index(
+                disable_rbac=False)
+
+        # NOTE Only indexes have a version, which changes with the names.
+        #      Results for other collections of names can't be reused.
+        key = None
+        version = getattr(metric_names, 'version', None)
+        if self.enrich_cache is not None and version is not None:
+            key = (query, labels, version)
+            enriched = self.enrich_cache.get(key)
+            if enriched is not None:
+                return enriched
+
+        enriched = self._enrich(query, self.default_labels, metric_names)
+        if key is not None:
+            self.enrich_cache.put(key, enriched)
+        return enriched
+
+    def enrich_cache_stats(self):
+        """Return size and hit / miss counters of the enriched query cache.
+
+        None is returned when the cache is disabled.
+        """
+        if self.enrich_cache is None:
+            return None
+        return self.enrich_cache.stats()
+
+    def _enrich(self, query, labels, metric_names):
+        tree = _parse(query)
+        # NOTE the enriched query is assembled from slices of the
+        #      original one, so the formatting and comments are kept.
+        parts = []
+        copied = 0
+        for selector in _vector_selectors(tree):
+            # Selectors without a metric name can select any metric,
+            # so they're always restricted.
+            if (selector.name is not None and
+                    selector.name not in metric_names):
+                continue
+            edit = _rewrite_selector(query, selector, labels)
+            if edit is None:
+                continue
+            start, end, text = edit
+            parts.append(query[copied:start])
+            parts.append(text)
+            copied = end
+        parts.append(query[copied:])
+        return "".join(parts)
 
     def append_rbac(self, query, disable_rbac=False):
         """Append rbac labels to queries.
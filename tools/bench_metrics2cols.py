@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+#   Copyright 2023 Red Hat, Inc.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License"); you may
+#   not use this file except in compliance with the License. You may obtain
+#   a copy of the License at
+#
+#        http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#   WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#   License for the specific language governing permissions and limitations
+#   under the License.
+
+"""Benchmark metrics2cols() on large vector results.
+
+Usage: python tools/bench_metrics2cols.py [rows] [repeats]
+"""
+
+import sys
+import timeit
+
+from observabilityclient.prometheus_client import PrometheusMetric
+from observabilityclient.utils.metric_utils import metrics2cols
+
+
+def make_metrics(rows, schemas_count):
+    schemas = {}
+    metrics = []
+    for i in range(rows):
+        labels = {"__name__": "node_cpu_seconds_total",
+                  "instance": f"host-{i % 1000}",
+                  "job": "node",
+                  "project": "c0ffee"}
+        labels[f"extra_{i % schemas_count}"] = str(i)
+        metrics.append(PrometheusMetric({"metric": labels,
+                                         "value": [1700000000, str(i)]},
+                                        schemas))
+    return metrics
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    for schemas_count in (1, 10):
+        metrics = make_metrics(rows, schemas_count)
+        best = min(timeit.repeat(lambda: metrics2cols(metrics),
+                                 number=1, repeat=repeats))
+        print(f"{rows} rows, {schemas_count} label sets: "
+              f"{best * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()